@@ -0,0 +1,20 @@
+"""Shared setup for the benchmark scripts.
+
+Makes bot.py importable from benchmarks/ and points it at a throwaway working
+directory, so benchmarks never touch the real bot.db.
+"""
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+os.environ.setdefault("BOT_TOKEN", "123456:benchmark")
+os.environ.setdefault("TOKEN", os.environ["BOT_TOKEN"])
+
+# the directory the script was started from, for resolving output paths given on the command line
+INVOKED_FROM = os.getcwd()
+WORKDIR = tempfile.mkdtemp(prefix="bot-bench-")
+os.chdir(WORKDIR)
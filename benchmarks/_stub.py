@@ -0,0 +1,54 @@
+"""In-process stand-ins for the Bot API used by the load scripts."""
+import json
+from datetime import datetime, timezone
+
+from telegram import CallbackQuery, Chat, Message, Update, User
+from telegram.request import BaseRequest
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+SENT_MESSAGE = {"message_id": 1, "date": 0, "chat": {"id": 1, "type": "private"}, "text": "…"}
+
+
+def fake_response(url):
+    """A successful Bot API response for the method at the end of ``url``."""
+    method = url.rsplit("/", 1)[-1]
+    if method == "getMe":
+        result = BOT_USER
+    elif method == "getChatMember":
+        result = {"status": "member", "user": BOT_USER}
+    elif method == "sendMediaGroup":
+        result = [SENT_MESSAGE, SENT_MESSAGE]
+    elif method.startswith(("send", "edit", "copy", "forward")):
+        result = SENT_MESSAGE
+    else:
+        result = True
+    return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+class StubRequest(BaseRequest):
+    """Answers every Bot API call locally without touching the network."""
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        return fake_response(url)
+
+
+def make_update(update_id, user_id, text):
+    user = User(id=user_id, first_name=f"u{user_id}", is_bot=False)
+    chat = Chat(id=user_id, type=Chat.PRIVATE)
+    message = Message(message_id=update_id, date=datetime.now(timezone.utc), chat=chat, from_user=user, text=text)
+    return Update(update_id=update_id, message=message)
+
+
+def make_callback_update(update_id, user_id, data):
+    user = User(id=user_id, first_name=f"u{user_id}", is_bot=False)
+    chat = Chat(id=user_id, type=Chat.PRIVATE)
+    message = Message(message_id=update_id, date=datetime.now(timezone.utc), chat=chat, text="…")
+    query = CallbackQuery(id=str(update_id), from_user=user, chat_instance=str(user_id), data=data, message=message)
+    return Update(update_id=update_id, callback_query=query)
@@ -0,0 +1,80 @@
+"""Logging cost on the calling (event loop) thread: direct stream handler vs. the queue.
+
+The sink is a stream whose writes take --write-ms (a slow or blocked stderr pipe).
+For each setup the time spent inside logger calls on the calling thread is reported:
+
+- direct:       the old basicConfig-style StreamHandler, writing in the caller;
+- queue:        bot.configure_logging()'s DeferredQueueHandler + QueueListener;
+- queue, flood: the same message repeated, so RateLimitFilter drops most records.
+
+    python benchmarks/bench_logging.py [--records 500] [--write-ms 2]
+"""
+import argparse
+import logging
+import queue
+import time
+from logging.handlers import QueueListener
+
+import _env  # noqa: F401  (must come before importing bot)
+import bot
+
+
+class SlowStream:
+    def __init__(self, write_seconds):
+        self.write_seconds = write_seconds
+        self.lines = 0
+
+    def write(self, text):
+        time.sleep(self.write_seconds)
+        self.lines += text.count("\n")
+
+    def flush(self):
+        pass
+
+
+def timed_calls(log, records, same_message):
+    start = time.perf_counter()
+    for i in range(records):
+        if same_message:
+            log.warning("Error checking membership for channel %s: %r", "@broken", TimeoutError())
+        else:
+            log.info("update %s handled in %.1f ms", i, 1.5)
+    return (time.perf_counter() - start) / records
+
+
+def run(setup, records, write_seconds):
+    stream = SlowStream(write_seconds)
+    log = logging.getLogger(f"bench.{setup}")
+    log.propagate = False
+    log.setLevel(logging.INFO)
+    listener = None
+    if setup == "direct":
+        handler = logging.StreamHandler(stream)
+        handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
+    else:
+        sink = logging.StreamHandler(stream)
+        sink.setFormatter(bot.JsonFormatter())
+        log_queue = queue.SimpleQueue()
+        handler = bot.DeferredQueueHandler(log_queue)
+        handler.addFilter(bot.RateLimitFilter())
+        listener = QueueListener(log_queue, sink)
+        listener.start()
+    log.addHandler(handler)
+    per_call = timed_calls(log, records, same_message=setup == "queue, flood")
+    if listener:
+        listener.stop()  # waits until every queued record is written
+    return per_call, stream.lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--records", type=int, default=500)
+    parser.add_argument("--write-ms", type=float, default=2.0)
+    args = parser.parse_args()
+    for setup in ("direct", "queue", "queue, flood"):
+        per_call, lines = run(setup, args.records, args.write_ms / 1000)
+        print(f"{setup:14s} {per_call * 1e6:9.1f} µs per logger call on the caller  ({lines} lines written)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""Instrumentation overhead: measured cost of the /metrics bookkeeping per update.
+
+Each instrumented piece is timed against its uninstrumented counterpart (the raw
+coroutine behind @timed, a plain sqlite3 connection, HTTPXRequest.do_request with
+the network call replaced by an instant stub). The per-call overheads are then
+combined into a typical update -- one update timing, two handler/route timings,
+four DB executes, two fetches, one commit and two Bot API calls -- and compared to
+bot.METRICS_BUDGET_US. Exits with status 1 when the budget is exceeded.
+
+    python benchmarks/bench_metrics.py [--number N]
+"""
+import argparse
+import asyncio
+import sqlite3
+import sys
+import time
+
+import _env  # noqa: F401  (must come before importing bot)
+import bot
+from telegram.request import HTTPXRequest
+
+# calls of each kind made while handling a typical update
+PROFILE = {"update": 1, "handler": 2, "db_execute": 4, "db_fetch": 2, "db_commit": 1, "api_call": 2}
+
+
+def per_call(func, number):
+    start = time.perf_counter()
+    func(number)
+    return (time.perf_counter() - start) / number
+
+
+def async_per_call(make_coro, number):
+    async def run():
+        start = time.perf_counter()
+        for _ in range(number):
+            await make_coro()
+        return (time.perf_counter() - start) / number
+    return asyncio.run(run())
+
+
+def overhead(instrumented, plain, number):
+    # best of three to keep scheduler noise out of the comparison
+    return min(instrumented(number) - plain(number) for _ in range(3))
+
+
+def bench_handler(number):
+    @bot.timed
+    async def handler(update, context):
+        return None
+
+    raw = handler.__wrapped__
+    return overhead(lambda n: async_per_call(lambda: handler(None, None), n),
+                    lambda n: async_per_call(lambda: raw(None, None), n), number)
+
+
+def bench_update(number):
+    def observed(n):
+        for _ in range(n):
+            start = time.perf_counter()
+            bot.UPDATE_LATENCY.observe(time.perf_counter() - start)
+
+    def bare(n):
+        for _ in range(n):
+            pass
+
+    return overhead(lambda n: per_call(observed, n), lambda n: per_call(bare, n), number)
+
+
+def bench_db(number):
+    bot.set_setting("bench", "1")
+    instrumented = bot.db_connect()
+    plain = sqlite3.connect(bot.DB_PATH)
+    sql = "SELECT value FROM settings WHERE key = ?"
+
+    def execute(conn):
+        def run(n):
+            for _ in range(n):
+                conn.execute(sql, ("bench",))
+        return lambda n: per_call(run, n)
+
+    def fetch(conn):
+        def run(n):
+            cur = conn.cursor()
+            for _ in range(n):
+                cur.execute(sql, ("bench",))
+                cur.fetchone()
+        return lambda n: per_call(run, n)
+
+    def commit(conn):
+        def run(n):
+            for _ in range(n):
+                conn.commit()
+        return lambda n: per_call(run, n)
+
+    execute_cost = overhead(execute(instrumented), execute(plain), number)
+    # fetch is measured together with its execute; subtract the execute overhead
+    fetch_cost = overhead(fetch(instrumented), fetch(plain), number) - execute_cost
+    commit_cost = overhead(commit(instrumented), commit(plain), number)
+    instrumented.close()
+    plain.close()
+    return execute_cost, fetch_cost, commit_cost
+
+
+def bench_api(number):
+    async def instant(self, url, method, request_data=None, **kwargs):
+        return 200, b'{"ok":true,"result":true}'
+
+    HTTPXRequest.do_request = instant  # no network: only the wrapper is measured
+    request = bot.InstrumentedRequest()
+    url = "https://api.telegram.org/bot123456:bench/sendMessage"
+    return overhead(lambda n: async_per_call(lambda: request.do_request(url, "POST"), n),
+                    lambda n: async_per_call(lambda: instant(request, url, "POST"), n), number)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=50000)
+    args = parser.parse_args()
+
+    bot.init_db()
+    execute_cost, fetch_cost, commit_cost = bench_db(args.number)
+    costs = {
+        "update": bench_update(args.number),
+        "handler": bench_handler(args.number),
+        "db_execute": execute_cost,
+        "db_fetch": fetch_cost,
+        "db_commit": commit_cost,
+        "api_call": bench_api(args.number),
+    }
+    total = 0.0
+    for kind, cost in costs.items():
+        cost = max(cost, 0.0)
+        total += cost * PROFILE[kind]
+        print(f"{kind:12s} {cost * 1e6:7.2f} µs/call  x{PROFILE[kind]}")
+    total_us = total * 1e6
+    print(f"{'per update':12s} {total_us:7.2f} µs  (budget {bot.METRICS_BUDGET_US} µs)")
+    if total_us > bot.METRICS_BUDGET_US:
+        print("❌ instrumentation overhead exceeds the budget")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
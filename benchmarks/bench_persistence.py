@@ -0,0 +1,88 @@
+"""Flush cost of SQLitePersistence versus rewriting everything, by number of users.
+
+For each population size, every user starts with a stored user_data entry (a
+newpost draft and a few flags, like an admin mid-conversation). One flush interval
+is then simulated: PTB hands over the entries of the users that had updates
+(--active of them), of which --changed really changed. Measured per flush:
+
+- sqlite   SQLitePersistence.update_user_data for the active users + write_pending;
+- rewrite  pickling every user's data into one file, as PicklePersistence does.
+
+    python benchmarks/bench_persistence.py [--users 1000 10000 100000] [--active 500] [--changed 50]
+"""
+import argparse
+import asyncio
+import os
+import pickle
+import time
+
+import _env  # noqa: F401  (must come before importing bot)
+import bot
+
+
+def user_data(user_id, version=0):
+    return {
+        "prev_menu": "posts_menu",
+        "main_file": {"type": "photo", "file_id": f"AgACAgQAAxkBAAI{user_id:012d}" * 2},
+        "intro_file": {"type": "text", "text": "معرفی پست " * 10},
+        "title": f"post draft {user_id}",
+        "version": version,
+    }
+
+
+def reset_tables():
+    conn = bot.db_connect()
+    conn.execute("DELETE FROM user_data")
+    conn.commit()
+    conn.close()
+
+
+async def bench_sqlite(users, active, changed):
+    reset_tables()
+    persistence = bot.SQLitePersistence()
+    data = {user_id: user_data(user_id) for user_id in range(users)}
+    for user_id, value in data.items():
+        await persistence.update_user_data(user_id, value)
+    persistence.write_pending()
+
+    for user_id in range(changed):
+        data[user_id] = user_data(user_id, version=1)
+    start = time.perf_counter()
+    for user_id in range(active):
+        await persistence.update_user_data(user_id, data[user_id])
+    written = persistence.write_pending()
+    elapsed = time.perf_counter() - start
+    assert written == changed, (written, changed)
+    return elapsed
+
+
+def bench_rewrite(users, changed):
+    data = {user_id: user_data(user_id) for user_id in range(users)}
+    for user_id in range(changed):
+        data[user_id] = user_data(user_id, version=1)
+    path = os.path.join(_env.WORKDIR, "persistence.pickle")
+    start = time.perf_counter()
+    with open(path, "wb") as f:
+        pickle.dump({"user_data": data, "conversations": {}}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--active", type=int, default=500, help="users with updates in the interval")
+    parser.add_argument("--changed", type=int, default=50, help="active users whose data changed")
+    args = parser.parse_args()
+
+    bot.init_db()
+    print(f"{'users':>8s} {'sqlite ms':>10s} {'rewrite ms':>11s}   ({args.active} active, {args.changed} changed per flush)")
+    for users in args.users:
+        active = min(args.active, users)
+        changed = min(args.changed, active)
+        sqlite_s = asyncio.run(bench_sqlite(users, active, changed))
+        rewrite_s = bench_rewrite(users, changed)
+        print(f"{users:8d} {sqlite_s * 1e3:10.2f} {rewrite_s * 1e3:11.2f}")
+
+
+if __name__ == "__main__":
+    main()
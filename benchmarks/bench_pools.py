@@ -0,0 +1,109 @@
+"""Connection pool benchmark against the local fake Bot API (run in a child process).
+
+Two scenarios, both with a fixed server-side latency per call:
+
+1. pool size sweep: N concurrent interactive sends, throughput per pool size;
+2. lanes: a broadcast-style flood of bulk sends running next to interactive sends,
+   once with one shared pool (the old single request object) and once with
+   separate interactive/bulk pools as built by bot.build_requests().
+
+    python benchmarks/bench_pools.py [--latency-ms 100] [--seconds 3]
+"""
+import argparse
+import asyncio
+import json
+import time
+import urllib.request
+
+import _env  # noqa: F401  (must come before importing bot)
+import bot
+import fake_bot_api
+from telegram import Bot
+
+bot.load_telegram()  # make_request() builds InstrumentedRequest without an Application
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+async def make_bot(base_url, lanes):
+    tg_bot = Bot("123456:bench", base_url=base_url, request=bot.LaneRequest(lanes))
+    await tg_bot.initialize()
+    return tg_bot
+
+
+async def sender(tg_bot, lane, stop_at, latencies, errors):
+    bot.request_lane.set(lane)
+    while time.perf_counter() < stop_at:
+        start = time.perf_counter()
+        try:
+            await tg_bot.send_message(chat_id=1, text="bench")
+            latencies.append(time.perf_counter() - start)
+        except Exception:
+            errors.append(lane)
+
+
+async def run_senders(tg_bot, seconds, interactive, bulk):
+    start = time.perf_counter()
+    stop_at = start + seconds
+    results = {"interactive": ([], []), "bulk": ([], [])}
+    tasks = [sender(tg_bot, "interactive", stop_at, *results["interactive"]) for _ in range(interactive)]
+    tasks += [sender(tg_bot, "bulk", stop_at, *results["bulk"]) for _ in range(bulk)]
+    await asyncio.gather(*(asyncio.create_task(t) for t in tasks))
+    # calls already waiting for a connection finish after stop_at; rates use the real duration
+    return results, time.perf_counter() - start
+
+
+async def pool_sweep(base_url, args):
+    print(f"pool size sweep: {args.concurrency} concurrent interactive senders, {args.latency_ms:g} ms per call")
+    for pool_size in (1, 4, 16, 64, 128):
+        lanes = {"interactive": bot.make_request("interactive", pool_size)}
+        tg_bot = await make_bot(base_url, lanes)
+        results, elapsed = await run_senders(tg_bot, args.seconds, args.concurrency, 0)
+        await tg_bot.shutdown()
+        latencies, errors = results["interactive"]
+        print(f"  pool={pool_size:4d}  {len(latencies) / elapsed:8.0f} calls/s  "
+              f"p99={percentile(latencies, 99) * 1000:7.1f} ms  pool timeouts={len(errors)}")
+
+
+async def lanes_compare(base_url, args):
+    print(f"lanes: {args.bulk} bulk senders flooding next to {args.interactive} interactive senders")
+    shared = bot.make_request("interactive", bot.BOT_API_POOL_SIZE // 8)
+    setups = {
+        f"shared pool ({bot.BOT_API_POOL_SIZE // 8})": {"interactive": shared, "bulk": shared},
+        "separate lanes": bot.build_requests()[0].lanes,
+    }
+    for name, lanes in setups.items():
+        tg_bot = await make_bot(base_url, lanes)
+        results, elapsed = await run_senders(tg_bot, args.seconds, args.interactive, args.bulk)
+        await tg_bot.shutdown()
+        (interactive, i_errors), (bulk, b_errors) = results["interactive"], results["bulk"]
+        print(f"  {name:20s} interactive p50={percentile(interactive, 50) * 1000:6.1f} ms "
+              f"p99={percentile(interactive, 99) * 1000:7.1f} ms  {len(interactive) / elapsed:6.0f}/s  "
+              f"bulk {len(bulk) / elapsed:6.0f}/s  errors={len(i_errors) + len(b_errors)}")
+
+
+async def main(args):
+    process, base_url = fake_bot_api.spawn(args.latency_ms)
+    try:
+        await pool_sweep(base_url, args)
+        await lanes_compare(base_url, args)
+        with urllib.request.urlopen(base_url.rsplit("/", 1)[0] + "/stats") as response:
+            stats = json.load(response)
+        print(f"peak requests in flight at the fake API: {stats['peak_in_flight']}")
+    finally:
+        process.terminate()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--latency-ms", type=float, default=100.0)
+    parser.add_argument("--seconds", type=float, default=3.0)
+    parser.add_argument("--concurrency", type=int, default=128)
+    parser.add_argument("--interactive", type=int, default=8)
+    parser.add_argument("--bulk", type=int, default=64)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,166 @@
+"""Dispatch micro-benchmark: routing table vs. the old menu_callback if/elif chain.
+
+Only the routing decision is timed (no handler runs). ``legacy_route`` replays the
+comparisons the old chain made, in the same order, until it reached a branch.
+
+    python benchmarks/bench_routing.py [--number N]
+"""
+import argparse
+import timeit
+
+import _env  # noqa: F401  (must come before importing bot)
+import bot
+
+SIGNAL_TEXTS = ("⚙️ تنظیم سیگنال رایگان", "تنظیم سیگنال رایگان", "Set Free Signal", "Free Signal")
+VIEW_SIGNAL = ("دیدن سیگنال", "👁 دیدن سیگنال", "👁️ دیدن سیگنال", "👁️️ دیدن سیگنال", "View Signal", "See Signal")
+ORDER = ("سفارش ممبر واقعی", "👥 سفارش ممبر واقعی", "👥 Order Real Members", "Order Real Members")
+FREE_ADS = ("تبلیغات رایگان", "🆓 تبلیغات رایگان", "🆓 Free Ads", "Free Ads")
+SUPPORT = ("صحبت با پشتیبان", "💬 صحبت با پشتیبان", "Contact Support", "💬 Contact Support")
+BUY = ("خرید این ربات یا ربات دیگر", "🤖 خرید این ربات یا ربات دیگر", "خرید ربات", "🤖 خرید ربات",
+       "Buy this bot", "Buy Bot", "🤖 Buy Bot")
+POPULAR = ("📱 پست های پرطرفدار", "پست های پرطرفدار", "📱 Popular Posts", "Popular Posts")
+
+
+def legacy_route(data, is_callback, user_data):
+    """The old chain's routing decision, comparison for comparison."""
+    if data.startswith("signal_post_"):
+        return "signal_post"
+    if not is_callback:
+        txt = data.strip()
+        if txt in SIGNAL_TEXTS:
+            data = "admin_signal_menu"
+        elif txt in VIEW_SIGNAL:
+            data = "دیدن سیگنال"
+        elif txt in ("🔙 برگشت", "برگشت"):
+            data = "back_to_main"
+        elif txt in ("آمار ربات", "📊 آمار ربات"):
+            return "stats"
+        elif txt in ("ارسال به همه", "📤 ارسال به همه"):
+            return "broadcast_prompt"
+        elif txt in ("📚 پست ها", "پست ها"):
+            data = "show_posts_menu"
+        elif txt in ("📢 تبلیغات", "تبلیغات"):
+            data = "admin_ads_menu"
+        elif txt in ("ℹ️ اطلاعات و ویرایش", "اطلاعات و ویرایش"):
+            data = "admin_listposts"
+        elif txt in ("📤 پست های ارسالی", "پست های ارسالی"):
+            data = "admin_post_sent"
+        elif txt in ("تبلیغات",):
+            data = "admin_ads_menu"
+        elif txt in ("آیدی ادمین", "آیدی ادمین تنظیم تبلیغات"):
+            data = "ads_admin_id"
+        elif txt in ("تنظیم تبلیغات", "تنظیم تبلیغات دکمه"):
+            data = "ads_set"
+        elif txt in ORDER:
+            return "order_member"
+        elif txt in FREE_ADS:
+            return "free_ads"
+        elif txt in SUPPORT:
+            return "contact_support"
+        elif txt in BUY:
+            return "buy_bot"
+    if data == "admin_post_sent" or (not is_callback and data == "📤 پست های ارسالی"):
+        return "admin_post_sent"
+    if data == "admin_ads_menu" or (not is_callback and data in ("📢 تبلیغات", "تبلیغات")):
+        return "admin_ads_menu"
+    if data in ("آیدی پشتیبان", "👤 آیدی پشتیبان"):
+        return "support_menu"
+    elif data in ("تنظیم آیدی پشتیبان", "✏️ تنظیم آیدی پشتیبان"):
+        return "ask_support_id"
+    elif data in ("❌ لغو تنظیم آیدی پشتیبان", "لغو تنظیم آیدی پشتیبان"):
+        return "cancel_support_id"
+    elif data in ("دیدن آیدی پشتیبان", "👁️ دیدن آیدی پشتیبان"):
+        return "show_support_id"
+    if not is_callback and user_data.get("awaiting_support_id"):
+        return "save_support_id"
+    if not is_callback and user_data.get("awaiting_broadcast_text"):
+        return "receive_broadcast_message"
+    if data == "show_posts_menu":
+        return "show_posts_menu"
+    if data == "admin_signal_menu":
+        return "show_signal_menu"
+    if data == "back_to_main":
+        return "back_to_main"
+    if data in ("ثبت سیگنال", "📝 ثبت سیگنال"):
+        return "register_signal_menu"
+    if data == "دیدن سیگنال":
+        return "view_signal"
+    if data == "📈 سیگنال رایگان" or (not is_callback and data in ("📈 سیگنال رایگان", "📈 Free Signal", "Free Signal")):
+        return "free_signal"
+    if data == "broadcast_confirm":
+        return "broadcast_confirm"
+    if data == "cancel_broadcast":
+        return "cancel_broadcast"
+    keep = (data.startswith("delete_post_") or data.startswith("edit_post_") or data.startswith("edit_field_")
+            or data.startswith("confirm_delete_") or data.startswith("cancel_delete_"))
+    if data.startswith("edit_field_"):
+        return "edit_field"
+    if not is_callback and user_data.get("editing_post_id") and user_data.get("editing_field"):
+        return "save_edited_field"
+    if data.startswith("delete_post_"):
+        return "delete_post"
+    if data.startswith("confirm_delete_"):
+        return "confirm_delete"
+    if data.startswith("cancel_delete_"):
+        return "cancel_delete"
+    if data.startswith("edit_post_"):
+        return "edit_post"
+    if data == "admin_listposts":
+        return "admin_listposts"
+    if data in POPULAR or (not is_callback and data in POPULAR):
+        return "popular_posts"
+    return None if keep else "delete_message"
+
+
+def router_route(data, is_callback, user_data):
+    handler, _arg = bot.menu_routes.resolve(data if is_callback else data.strip(), allow_prefix=is_callback)
+    if handler is None and not is_callback:
+        handler = bot.menu_routes.resolve_pending(user_data)
+    return handler
+
+
+# a mix of typical traffic: user menu taps, admin menus and post callbacks
+WORKLOAD = [
+    ("📈 Free Signal", False), ("📱 Popular Posts", False), ("🤖 Buy Bot", False),
+    ("💬 Contact Support", False), ("📚 پست ها", False), ("🔙 برگشت", False),
+    ("ℹ️ اطلاعات و ویرایش", False), ("some free text", False),
+    ("edit_post_1234", True), ("confirm_delete_1234:0", True), ("edit_field_1234_title", True),
+    ("signal_post_77", True), ("cancel_delete_1234:0", True),
+]
+
+
+def time_route(route, rows, user_data, number):
+    """Best ns per dispatch of ``route`` over ``rows``."""
+    def loop():
+        for data, is_callback in rows:
+            route(data, is_callback, user_data)
+    best = min(timeit.repeat(loop, number=number, repeat=5))
+    return best / (number * len(rows)) * 1e9
+
+
+def run(number):
+    user_data = {}
+    routes = (("legacy_chain", legacy_route), ("routing_table", router_route))
+    results = {name: time_route(route, WORKLOAD, user_data, number) for name, route in routes}
+    # each row repeated, so the loop's own overhead is spread like in the mixed workload
+    per_row = {row: [time_route(route, [row] * len(WORKLOAD), user_data, number) for _name, route in routes]
+               for row in WORKLOAD}
+    return results, per_row
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=20000)
+    args = parser.parse_args()
+    results, per_row = run(args.number)
+    print(f"{'':24s} {'legacy ns':>10s} {'table ns':>10s}")
+    for (data, is_callback), (legacy_ns, table_ns) in per_row.items():
+        kind = "callback" if is_callback else "text"
+        print(f"{data[:24]:24s} {legacy_ns:10.1f} {table_ns:10.1f}  {legacy_ns / table_ns:5.2f}x  {kind}")
+    for name, ns in results.items():
+        print(f"{name:14s} {ns:8.1f} ns/dispatch")
+    print(f"speedup        {results['legacy_chain'] / results['routing_table']:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
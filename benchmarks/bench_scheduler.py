@@ -0,0 +1,108 @@
+"""Outbound scheduler benchmark: interactive sends during a broadcast flood.
+
+Several broadcast-style bulk senders push messages to distinct chats as fast as the
+scheduler lets them, while interactive replies arrive at a steady rate and an admin
+listing sends a batch of messages into one chat. Runs once
+without a rate limiter and once with bot.OutboundScheduler, against the local fake
+Bot API (in a child process), and reports:
+
+- interactive latency p50/p99 (queueing + the call itself);
+- bulk throughput;
+- the peak number of message calls the fake API saw within one second, overall and
+  in a single chat (Telegram allows ~30/s overall).
+
+    python benchmarks/bench_scheduler.py [--seconds 5] [--bulk 4] [--interactive-rate 5] [--listing 20]
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+import urllib.request
+
+import _env  # noqa: F401  (must come before importing bot)
+import bot
+import fake_bot_api
+from telegram.ext import ExtBot
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def fetch_stats(base_url):
+    with urllib.request.urlopen(base_url.rsplit("/", 1)[0] + "/stats") as response:
+        return json.load(response)
+
+
+async def bulk_sender(tg_bot, chats, stop_at, sent):
+    bot.request_lane.set("bulk")
+    while time.perf_counter() < stop_at:
+        await tg_bot.send_message(chat_id=next(chats), text="broadcast")
+        sent.append(1)
+
+
+async def interactive_sender(tg_bot, rate, stop_at, latencies):
+    rng = random.Random(7)
+    tasks = []
+
+    async def reply(chat_id):
+        start = time.perf_counter()
+        await tg_bot.send_message(chat_id=chat_id, text="reply")
+        latencies.append(time.perf_counter() - start)
+
+    while time.perf_counter() < stop_at:
+        tasks.append(asyncio.create_task(reply(rng.randrange(10**6, 2 * 10**6))))
+        await asyncio.sleep(1.0 / rate)
+    await asyncio.gather(*tasks)
+
+
+async def listing(tg_bot, count):
+    for i in range(count):
+        await tg_bot.send_message(chat_id=42, text=f"post {i}")
+
+
+async def run(base_url, rate_limiter, args):
+    requests, _ = bot.build_requests()
+    tg_bot = ExtBot("123456:bench", base_url=base_url, request=requests, rate_limiter=rate_limiter)
+    await tg_bot.initialize()
+    chats = itertools.count(100)
+    sent, latencies = [], []
+    start = time.perf_counter()
+    stop_at = start + args.seconds
+    await asyncio.gather(
+        interactive_sender(tg_bot, args.interactive_rate, stop_at, latencies),
+        listing(tg_bot, args.listing),
+        *(bulk_sender(tg_bot, chats, stop_at, sent) for _ in range(args.bulk)),
+    )
+    elapsed = time.perf_counter() - start
+    await tg_bot.shutdown()
+    return latencies, len(sent) / elapsed
+
+
+async def main(args):
+    for name, make_limiter in (("no rate limiter", lambda: None), ("OutboundScheduler", bot.OutboundScheduler)):
+        # a fresh fake API per run, so the peaks belong to this run only
+        process, base_url = fake_bot_api.spawn(args.latency_ms)
+        try:
+            latencies, bulk_rate = await run(base_url, make_limiter(), args)
+            stats = fetch_stats(base_url)
+        finally:
+            process.terminate()
+        print(f"{name:18s} interactive p50={percentile(latencies, 50) * 1000:7.1f} ms "
+              f"p99={percentile(latencies, 99) * 1000:7.1f} ms  bulk {bulk_rate:6.1f}/s  "
+              f"peak {stats['peak_per_second']}/s overall, {stats['peak_chat_per_second']}/s in one chat")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--bulk", type=int, default=4, help="concurrent bulk senders")
+    parser.add_argument("--interactive-rate", type=float, default=5.0, help="interactive sends per second")
+    parser.add_argument("--listing", type=int, default=20, help="messages sent into one chat")
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    asyncio.run(main(parser.parse_args()))
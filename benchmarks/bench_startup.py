@@ -0,0 +1,95 @@
+"""Cold-start benchmark: process start -> bot imported -> Application built -> first update handled.
+
+Each run is a fresh interpreter (``--child``) that imports bot, gets the Application
+through bot.get_application() and handles one /start update end to end. Bot API calls
+are answered by patching HTTPXRequest.do_request, so the real request classes are built
+but nothing touches the network. The parent reports the median of every stage and the
+total wall time including interpreter start-up.
+
+    python benchmarks/bench_startup.py [--runs 5] [--max-ms N]
+"""
+import time
+
+CHILD_START = time.perf_counter()
+
+import argparse  # noqa: E402
+import asyncio  # noqa: E402
+import json  # noqa: E402
+import statistics  # noqa: E402
+import subprocess  # noqa: E402
+import sys  # noqa: E402
+
+STAGES = ("import_ms", "build_ms", "first_update_ms")
+
+
+def child():
+    import _env  # noqa: F401  (must come before importing bot)
+    import bot
+    imported = time.perf_counter()
+
+    from _stub import fake_response, make_update
+    from telegram import Update
+    from telegram.ext import TypeHandler
+    from telegram.request import HTTPXRequest
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        return fake_response(url)
+
+    HTTPXRequest.do_request = do_request
+
+    async def run():
+        application = bot.get_application()
+        built = time.perf_counter()
+        handled = asyncio.Event()
+
+        async def mark_handled(update, context):
+            handled.set()
+
+        # runs after the regular handlers of group 0
+        application.add_handler(TypeHandler(Update, mark_handled), group=100)
+        await application.initialize()
+        await application.start()
+        await application.update_queue.put(make_update(1, 1000, "/start"))
+        await handled.wait()
+        done = time.perf_counter()
+        await application.stop()
+        await application.shutdown()
+        return built, done
+
+    built, done = asyncio.run(run())
+    print(json.dumps({
+        "import_ms": (imported - CHILD_START) * 1000,
+        "build_ms": (built - imported) * 1000,
+        "first_update_ms": (done - built) * 1000,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-ms", type=float, help="fail when the median total exceeds this")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child()
+        return
+
+    results = []
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        out = subprocess.run([sys.executable, __file__, "--child"], check=True, capture_output=True, text=True).stdout
+        total = (time.perf_counter() - start) * 1000
+        result = json.loads(out.strip().splitlines()[-1])
+        result["total_ms"] = total
+        results.append(result)
+
+    for stage in STAGES + ("total_ms",):
+        print(f"{stage:16s} {statistics.median(r[stage] for r in results):8.1f}")
+    median_total = statistics.median(r["total_ms"] for r in results)
+    if args.max_ms is not None and median_total > args.max_ms:
+        print(f"❌ cold start {median_total:.1f} ms exceeds {args.max_ms} ms")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
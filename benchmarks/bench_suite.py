@@ -0,0 +1,186 @@
+"""Micro-benchmark suite for the bot's hot functions, with machine-readable results.
+
+Each case is timed with timeit (the loop count is calibrated per case, the best of
+--repeat runs is kept) against a throwaway database:
+
+- parse_channels_text on a 1000-line channel list;
+- decode_post on a stored row (JSON channels, and legacy plain-line channels);
+- get_post_db / get_setting round trips;
+- add_user_to_db for new users;
+- menu routing (the MenuRouter lookup menu_callback does per update);
+- join_keyboard and post_info_caption, as built when delivering a post;
+- search_posts (FTS5) over 20000 posts, a selective and a broad query;
+- inline mode's TitleIndex.match on the same posts (one page of results);
+- "📈 Free Signal": the cached pick versus rendering the payload from the database.
+
+Results can be written as JSON and compared against an earlier run, e.g. the
+previous commit's; the exit status is 1 when any case got slower by more than
+--tolerance, so the suite can gate a deploy.
+
+    python benchmarks/bench_suite.py [--json out.json] [--compare baseline.json] [--tolerance 0.25]
+                                     [--repeat 5] [--only NAME ...]
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import timeit
+from itertools import count
+from types import SimpleNamespace
+
+import _env
+import bot
+from bench_routing import WORKLOAD, router_route
+
+bot.load_telegram()  # the cases call keyboard builders directly, without an Application
+
+CHANNEL_LINES = [
+    "My Channel | @mychannel{i}",
+    "Another Channel | https://t.me/another{i}",
+    "SimpleName @simple{i}",
+    "Split name | channel_{i}",
+    "plain{i}",
+]
+CHANNELS = [{"name": f"Channel {i}", "username": f"channel{i}"} for i in range(10)]
+SEARCH_CORPUS = 20000
+
+
+def git_revision():
+    try:
+        rev = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=_env.ROOT,
+                             capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=_env.ROOT,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return rev + ("-dirty" if dirty else "")
+
+
+def build_cases():
+    """name -> (callable, operations per call)."""
+    bot.init_db()
+    channels_text = "\n".join(CHANNEL_LINES[i % len(CHANNEL_LINES)].format(i=i) for i in range(1000))
+    post_id = bot.save_post_db({
+        "title": "benchmark post",
+        "description": "a description " * 20,
+        "main_file": {"type": "photo", "file_id": "AgACAgQAAxkBAAI" * 4},
+        "intro_file": {"type": "text", "text": "intro"},
+        "channels": json.dumps(CHANNELS),
+    })
+    row = bot.get_post_db(post_id)
+    legacy_row = dict(row, channels="\n".join("@" + item["username"] for item in CHANNELS))
+    bot.set_setting("bench_key", "value")
+    bot.save_posts_db([{
+        "title": f"signal {i} {'gold' if i % 10 else 'bitcoin'}",
+        "description": f"daily market analysis number {i}",
+        "main_file": {"type": "text", "text": "body"},
+        "intro_file": {},
+        "channels": "[]",
+    } for i in range(SEARCH_CORPUS)])
+    bot.set_signal_posts([(post_id, 1)])
+    user_ids = count(1_000_000)
+
+    def render_signal():
+        cap, _channels = bot.decode_post(bot.get_post_db(post_id))
+        return bot.signal_payload(post_id, cap, "bench_bot")
+    inline_index = asyncio.run(bot.title_index("bench_bot"))
+    user_data = {}
+
+    def route_workload():
+        for data, is_callback in WORKLOAD:
+            router_route(data, is_callback, user_data)
+
+    return {
+        "parse_channels_text_1000_lines": (lambda: bot.parse_channels_text(channels_text), 1),
+        "decode_post": (lambda: bot.decode_post(row), 1),
+        "decode_post_legacy_channels": (lambda: bot.decode_post(legacy_row), 1),
+        "get_post_db": (lambda: bot.get_post_db(post_id), 1),
+        "get_setting": (lambda: bot.get_setting("bench_key"), 1),
+        "add_user_to_db": (lambda: bot.add_user_to_db(SimpleNamespace(id=next(user_ids), username="bench")), 1),
+        "menu_route": (route_workload, len(WORKLOAD)),
+        "join_keyboard_10_channels": (lambda: bot.join_keyboard(CHANNELS, post_id), 1),
+        "post_info_caption": (lambda: bot.post_info_caption("benchmark post", "a description"), 1),
+        "free_signal_pick": (lambda: bot.pick_signal("bench_bot"), 1),
+        "free_signal_render": (render_signal, 1),
+        "inline_match_selective": (lambda: inline_index.match("signal 1234", 51), 1),
+        "inline_match_broad": (lambda: inline_index.match("bitcoin", 51), 1),
+        "search_posts_selective": (lambda: bot.search_posts("signal 1234"), 1),
+        "search_posts_broad": (lambda: bot.search_posts("bitcoin"), 1),
+    }
+
+
+def run_case(func, ops, repeat):
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    best = min(timer.repeat(repeat=repeat, number=number))
+    ns = best / (number * ops) * 1e9
+    return {"ns_per_op": round(ns, 1), "ops_per_s": round(1e9 / ns, 1), "loops": number * ops}
+
+
+def compare(results, baseline, tolerance):
+    """Print the change per case; return the names that regressed beyond ``tolerance``."""
+    regressed = []
+    print(f"\ncompared with {baseline.get('revision') or 'baseline'}:")
+    for name, result in results.items():
+        before = baseline["results"].get(name)
+        if not before:
+            print(f"  {name:32s} (new)")
+            continue
+        change = result["ns_per_op"] / before["ns_per_op"] - 1
+        flag = ""
+        if change > tolerance:
+            flag = "  ❌ regression"
+            regressed.append(name)
+        print(f"  {name:32s} {before['ns_per_op']:12.1f} -> {result['ns_per_op']:12.1f} ns  {change:+7.1%}{flag}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--compare", help="baseline results file from an earlier run")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown (0.25 = 25%%)")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--only", nargs="+", metavar="NAME")
+    args = parser.parse_args()
+    for attr in ("json", "compare"):
+        if getattr(args, attr):
+            setattr(args, attr, os.path.join(_env.INVOKED_FROM, getattr(args, attr)))
+
+    cases = build_cases()
+    if args.only:
+        unknown = set(args.only) - set(cases)
+        if unknown:
+            parser.error(f"unknown case(s): {', '.join(sorted(unknown))}; known: {', '.join(cases)}")
+        cases = {name: cases[name] for name in args.only}
+
+    results = {}
+    for name, (func, ops) in cases.items():
+        results[name] = run_case(func, ops, args.repeat)
+        print(f"{name:32s} {results[name]['ns_per_op']:12.1f} ns/op  {results[name]['ops_per_s']:14.1f} ops/s")
+
+    report = {
+        "revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "results": results,
+    }
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressed = compare(results, json.load(f), args.tolerance)
+        if regressed:
+            print(f"❌ {len(regressed)} case(s) slower than the baseline by more than {args.tolerance:.0%}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+"""Local fake Telegram Bot API server (aiohttp) for benchmarks and load tests.
+
+Answers ``/bot<token>/<method>`` for the methods bot.py uses (getMe, getUpdates,
+getChatMember, send*/edit*/copy*/forward*, answerCallbackQuery, deleteMessage,
+deleteWebhook, ...) after a configurable delay, and counts requests per method
+along with the peak number of requests in flight (which shows how many
+connections the client really used). For message calls it also tracks the
+highest number seen within any one second, overall and in a single chat, to
+check rate limiting. All counts are served as JSON at ``/stats``.
+
+Faults can be injected into a share of the calls: ``--error-rate`` answers with
+500, ``--rate-limit-rate`` with 429 and ``retry_after``. Start-up and polling
+methods (getMe, getUpdates, deleteWebhook, ...) are never failed.
+
+getUpdates is a real long poll over updates queued with ``push_update()``, so a
+bot started with ``--polling`` can be driven end to end (see loadgen.py).
+
+    python benchmarks/fake_bot_api.py [--port 8081] [--latency-ms 50] [--jitter-ms 0]
+                                      [--error-rate 0] [--rate-limit-rate 0] [--retry-after 1]
+
+then run the bot with BOT_API_BASE_URL=http://127.0.0.1:8081/bot
+"""
+import argparse
+import asyncio
+import json
+import random
+import subprocess
+import sys
+import time
+from collections import Counter, defaultdict, deque
+from itertools import islice
+
+from _stub import fake_response
+from aiohttp import web
+
+MESSAGE_METHODS = ("send", "edit", "copy", "forward")
+# never failed on purpose: the bot could not start or poll at all
+FAULT_EXEMPT = {"getMe", "getUpdates", "deleteWebhook", "setWebhook", "getWebhookInfo", "close", "logOut"}
+
+
+def error_body(code, description, **parameters):
+    body = {"ok": False, "error_code": code, "description": description}
+    if parameters:
+        body["parameters"] = parameters
+    return json.dumps(body).encode()
+
+
+class FakeBotAPI:
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, rate_limit_rate=0.0,
+                 retry_after=1, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self.injected = Counter()
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.recent = deque()  # message call times within the last second
+        self.recent_by_chat = defaultdict(deque)
+        self.peak_per_second = 0
+        self.peak_chat_per_second = 0
+        self.updates = deque()
+        self.next_update_id = 1
+        self.new_update = asyncio.Event()
+        # called as on_message(method, chat_id) after each successful message call
+        self.on_message = None
+        self.runner = None
+
+    def track_rate(self, chat_id):
+        now = time.monotonic()
+        for window in (self.recent, self.recent_by_chat[chat_id]):
+            window.append(now)
+            while window[0] < now - 1.0:
+                window.popleft()
+        self.peak_per_second = max(self.peak_per_second, len(self.recent))
+        self.peak_chat_per_second = max(self.peak_chat_per_second, len(self.recent_by_chat[chat_id]))
+
+    def push_update(self, update):
+        """Queue an update (a Bot API Update dict without update_id) for getUpdates."""
+        update = dict(update, update_id=self.next_update_id)
+        self.next_update_id += 1
+        self.updates.append(update)
+        self.new_update.set()
+        return update["update_id"]
+
+    async def get_updates(self, form):
+        offset = int(form.get("offset") or 0)
+        limit = int(form.get("limit") or 100)
+        timeout = float(form.get("timeout") or 0)
+        # an offset confirms every earlier update
+        while self.updates and self.updates[0]["update_id"] < offset:
+            self.updates.popleft()
+        if not self.updates and timeout:
+            self.new_update.clear()
+            try:
+                await asyncio.wait_for(self.new_update.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return json.dumps({"ok": True, "result": list(islice(self.updates, limit))}).encode()
+
+    def delay(self):
+        if not self.jitter:
+            return self.latency
+        return max(0.0, self.random.uniform(self.latency - self.jitter, self.latency + self.jitter))
+
+    def fault(self, method):
+        if method in FAULT_EXEMPT:
+            return None
+        draw = self.random.random()
+        if draw < self.rate_limit_rate:
+            self.injected["rate_limited"] += 1
+            return 429, error_body(429, f"Too Many Requests: retry after {self.retry_after}",
+                                   retry_after=self.retry_after)
+        if draw < self.rate_limit_rate + self.error_rate:
+            self.injected["error"] += 1
+            return 500, error_body(500, "Internal Server Error")
+        return None
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        self.calls[method] += 1
+        form = await request.post()
+        if method == "getUpdates":
+            return web.Response(body=await self.get_updates(form), content_type="application/json")
+        if method == "deleteWebhook" and form.get("drop_pending_updates") in ("true", "True"):
+            self.updates.clear()
+        is_message = method.startswith(MESSAGE_METHODS)
+        if is_message:
+            self.track_rate(form.get("chat_id"))
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            delay = self.delay()
+            if delay:
+                await asyncio.sleep(delay)
+            status, body = self.fault(method) or fake_response(request.path)
+        finally:
+            self.in_flight -= 1
+        if status == 200 and is_message and self.on_message:
+            self.on_message(method, form.get("chat_id"))
+        return web.Response(status=status, body=body, content_type="application/json")
+
+    async def stats(self, request):
+        return web.json_response({
+            "calls": self.calls,
+            "injected": self.injected,
+            "peak_in_flight": self.peak_in_flight,
+            "peak_per_second": self.peak_per_second,
+            "peak_chat_per_second": self.peak_chat_per_second,
+        })
+
+    async def start(self, host="127.0.0.1", port=0):
+        """Start serving; returns the base URL to pass as the bot's base_url."""
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self.handle)
+        app.router.add_get("/stats", self.stats)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = self.runner.addresses[0][1]
+        return f"http://{host}:{port}/bot"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+def spawn(latency_ms=0.0, error_rate=0.0, rate_limit_rate=0.0):
+    """Run the fake API in a child process, so it does not share the benchmark's CPU.
+
+    Returns (process, base_url); terminate the process when done.
+    """
+    process = subprocess.Popen(
+        [sys.executable, __file__, "--port", "0", "--latency-ms", str(latency_ms),
+         "--error-rate", str(error_rate), "--rate-limit-rate", str(rate_limit_rate)],
+        stdout=subprocess.PIPE, text=True,
+    )
+    line = process.stdout.readline()
+    return process, line.rsplit("=", 1)[-1].strip()
+
+
+async def serve(args):
+    api = FakeBotAPI(latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000,
+                     error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate,
+                     retry_after=args.retry_after)
+    base_url = await api.start(port=args.port)
+    print(f"fake Bot API listening, BOT_API_BASE_URL={base_url}", flush=True)
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=50.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of calls answered with 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="share of calls answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    asyncio.run(serve(parser.parse_args()))
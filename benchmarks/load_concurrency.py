@@ -0,0 +1,97 @@
+"""Load test: update latency under mixed traffic, sequential vs. per-user concurrent.
+
+Drives a PerUserSerialApplication (and, for comparison, a sequential Application)
+with a mix of fast updates (/start, menu taps) and slow ones (membership checks that
+take up to seconds), then reports p50/p99 latency of the fast updates and verifies
+that every user's updates completed in the order they were sent.
+
+No network is used: Bot API calls are answered by an in-process stub.
+
+    python benchmarks/load_concurrency.py [--users 200] [--rate 200] [--slow-share 0.05]
+"""
+import argparse
+import asyncio
+import random
+import time
+
+import _env  # noqa: F401  (must come before importing bot)
+import bot
+from _stub import StubRequest, make_update
+from telegram import Update
+from telegram.ext import Application, ApplicationBuilder, TypeHandler
+
+
+async def drive(app, args):
+    sent_at = {}
+    latencies = {"fast": [], "slow": []}
+    order_violations = 0
+    last_seq = {}
+
+    async def handler(update, context):
+        nonlocal order_violations
+        # "slow" stands in for check_join_status timing out on a broken channel
+        slow = update.message.text == "slow"
+        await asyncio.sleep(args.slow_seconds if slow else args.fast_seconds)
+        uid = update.effective_user.id
+        if last_seq.get(uid, -1) > update.update_id:
+            order_violations += 1
+        last_seq[uid] = update.update_id
+        latencies["slow" if slow else "fast"].append(time.perf_counter() - sent_at[update.update_id])
+
+    app.add_handler(TypeHandler(Update, handler))
+    await app.initialize()
+    await app.start()
+
+    rng = random.Random(42)
+    interval = 1.0 / args.rate
+    for update_id in range(args.updates):
+        uid = rng.randrange(args.users)
+        text = "slow" if rng.random() < args.slow_share else "/start"
+        sent_at[update_id] = time.perf_counter()
+        await app.update_queue.put(make_update(update_id, uid, text))
+        await asyncio.sleep(interval)
+
+    while len(latencies["fast"]) + len(latencies["slow"]) < args.updates:
+        await asyncio.sleep(0.05)
+    await app.stop()
+    await app.shutdown()
+    return latencies, order_violations
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def build(concurrent):
+    builder = ApplicationBuilder().token("123456:bench").request(StubRequest()).get_updates_request(StubRequest())
+    if concurrent:
+        builder = builder.application_class(bot.PerUserSerialApplication).concurrent_updates(bot.CONCURRENT_UPDATES)
+    else:
+        builder = builder.application_class(Application)
+    return builder.updater(None).build()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--updates", type=int, default=1000)
+    parser.add_argument("--rate", type=float, default=200.0, help="updates per second")
+    parser.add_argument("--slow-share", type=float, default=0.02)
+    parser.add_argument("--slow-seconds", type=float, default=1.0)
+    parser.add_argument("--fast-seconds", type=float, default=0.002)
+    args = parser.parse_args()
+
+    for name, concurrent in (("sequential", False), ("per-user concurrent", True)):
+        latencies, violations = asyncio.run(drive(build(concurrent), args))
+        fast = latencies["fast"]
+        print(
+            f"{name:20s} fast p50={percentile(fast, 50) * 1000:8.1f} ms  p99={percentile(fast, 99) * 1000:8.1f} ms  "
+            f"slow={len(latencies['slow'])}  order violations={violations}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+"""End-to-end load generator: the real bot in polling mode against the fake Bot API.
+
+Seeds a throwaway database with a few posts (photo, document, text and album main files,
+each behind one required channel), starts the fake Bot API in this process and
+bot.py --polling in a child process pointed at it, then injects synthetic traffic
+at a target rate through getUpdates: ``/start get_<id>`` deep links and
+``continue_get_`` / ``receive_get_`` callbacks, every request from a fresh user.
+
+A request's latency is the time from queuing its update to the first message the
+bot sends back to that user (as seen by the fake API). Reports throughput, latency
+percentiles, unanswered requests and the Bot API calls made, including injected
+faults.
+
+The bot process inherits the environment, so its settings can be changed as
+usual, e.g. ``SEND_GLOBAL_RATE=1000`` to lift the outbound send cap.
+
+    python benchmarks/loadgen.py [--rate 50] [--seconds 10] [--callback-share 0.5]
+                                 [--latency-ms 50] [--error-rate 0] [--rate-limit-rate 0]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import time
+from collections import Counter
+
+import _env
+import bot
+from fake_bot_api import FakeBotAPI
+
+CHANNELS = json.dumps([{"name": "Bench channel", "username": "bench_channel"}])
+MAIN_FILES = [
+    {"type": "photo", "file_id": "bench-photo"},
+    {"type": "document", "file_id": "bench-document"},
+    {"type": "text", "text": "bench signal"},
+    {"type": "album", "items": [{"type": "photo", "file_id": f"bench-chart-{i}"} for i in range(4)]},
+]
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def seed_posts():
+    bot.init_db()
+    return [
+        bot.save_post_db({
+            "title": f"bench {main_file['type']}",
+            "description": "load test post",
+            "main_file": main_file,
+            "intro_file": {"type": "text", "text": "intro"},
+            "channels": CHANNELS,
+        })
+        for main_file in MAIN_FILES
+    ]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_bot(base_url, log_path):
+    env = dict(os.environ, BOT_API_BASE_URL=base_url, PORT=str(free_port()))
+    env.pop("WEBHOOK_URL", None)
+    env.pop("RENDER_EXTERNAL_URL", None)
+    with open(log_path, "w") as log:
+        return subprocess.Popen(
+            [sys.executable, os.path.join(_env.ROOT, "bot.py"), "--polling"],
+            cwd=_env.WORKDIR, env=env, stdout=log, stderr=subprocess.STDOUT,
+        )
+
+
+def make_user(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"u{user_id}"}
+
+
+def start_update(n, user_id, post_id):
+    text = f"/start get_{post_id}"
+    return {"message": {
+        "message_id": n, "date": int(time.time()), "text": text,
+        "chat": {"id": user_id, "type": "private"}, "from": make_user(user_id),
+        "entities": [{"type": "bot_command", "offset": 0, "length": len("/start")}],
+    }}
+
+
+def callback_update(n, user_id, data):
+    return {"callback_query": {
+        "id": str(n), "from": make_user(user_id), "chat_instance": str(user_id), "data": data,
+        "message": {"message_id": n, "date": int(time.time()), "text": "…",
+                    "chat": {"id": user_id, "type": "private"}},
+    }}
+
+
+async def wait_ready(api, process, timeout):
+    deadline = time.monotonic() + timeout
+    while not api.calls["getUpdates"]:
+        if process.poll() is not None or time.monotonic() > deadline:
+            return False
+        await asyncio.sleep(0.05)
+    return True
+
+
+async def drive(api, post_ids, args):
+    rng = random.Random(args.seed)
+    sent_at = {}
+    latencies = []
+    answered_at = []
+
+    def on_message(method, chat_id):
+        start = sent_at.pop(str(chat_id), None)
+        if start is not None:
+            now = time.perf_counter()
+            latencies.append(now - start)
+            answered_at.append(now)
+
+    api.on_message = on_message
+    kinds = Counter()
+    total = int(args.rate * args.seconds)
+    start = time.perf_counter()
+    for n in range(total):
+        delay = start + n / args.rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        user_id, post_id = 100000 + n, rng.choice(post_ids)
+        if rng.random() < args.callback_share:
+            prefix = rng.choice(("continue_get_", "receive_get_"))
+            update = callback_update(n, user_id, f"{prefix}{post_id}")
+        else:
+            prefix = "start"
+            update = start_update(n, user_id, post_id)
+        kinds[prefix] += 1
+        sent_at[str(user_id)] = time.perf_counter()
+        api.push_update(update)
+    sent_for = time.perf_counter() - start
+
+    deadline = time.monotonic() + args.drain
+    while sent_at and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    elapsed = (max(answered_at) if answered_at else time.perf_counter()) - start
+    return {"sent": total, "sent_for": sent_for, "kinds": kinds, "latencies": latencies,
+            "unanswered": len(sent_at), "elapsed": elapsed}
+
+
+def report(result, api, args):
+    latencies = result["latencies"]
+    print(f"offered {result['sent']} requests at {args.rate:g}/s over {result['sent_for']:.1f} s "
+          f"({', '.join(f'{k}={v}' for k, v in sorted(result['kinds'].items()))})")
+    print(f"answered {len(latencies)}, unanswered {result['unanswered']}, "
+          f"throughput {len(latencies) / max(result['elapsed'], 1e-9):.1f} req/s")
+    print("latency  " + "  ".join(
+        f"p{pct}={percentile(latencies, pct) * 1000:.1f} ms" for pct in (50, 90, 99)
+    ) + f"  max={max(latencies, default=0.0) * 1000:.1f} ms")
+    calls = ", ".join(f"{method}={count}" for method, count in api.calls.most_common())
+    print(f"Bot API calls: {calls}")
+    print(f"injected faults: 500={api.injected['error']}, 429={api.injected['rate_limited']}; "
+          f"peak sends/s={api.peak_per_second}, peak in flight={api.peak_in_flight}")
+
+
+async def main(args):
+    post_ids = seed_posts()
+    api = FakeBotAPI(latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000,
+                     error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate,
+                     retry_after=args.retry_after, seed=args.seed)
+    base_url = await api.start()
+    log_path = os.path.join(_env.WORKDIR, "bot.log")
+    process = start_bot(base_url, log_path)
+    try:
+        if not await wait_ready(api, process, args.startup_timeout):
+            print(f"❌ bot did not start polling; log: {log_path}")
+            sys.exit(1)
+        result = await drive(api, post_ids, args)
+        report(result, api, args)
+    finally:
+        process.send_signal(signal.SIGTERM)
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, process.wait, 30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        await api.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rate", type=float, default=50.0, help="requests per second")
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--callback-share", type=float, default=0.5)
+    parser.add_argument("--latency-ms", type=float, default=50.0)
+    parser.add_argument("--jitter-ms", type=float, default=10.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--drain", type=float, default=30.0, help="seconds to wait for stragglers")
+    parser.add_argument("--startup-timeout", type=float, default=30.0)
+    parser.add_argument("--seed", type=int, default=1)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,108 @@
+"""Post synthetic updates to the bot's webhook endpoint on a local aiohttp server.
+
+Starts the same aiohttp app the bot serves in webhook mode (health check + secret
+webhook path) on localhost, posts N updates with the right secret token and a few with
+a wrong one, and reports accepted/rejected counts, ingestion rate and the latency from
+POST to handler completion. Bot API calls are answered by an in-process stub.
+
+    python benchmarks/webhook_ingest.py [--updates 2000] [--concurrency 50]
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import _env  # noqa: F401  (must come before importing bot)
+import aiohttp
+import bot
+from _stub import StubRequest, make_callback_update, make_update
+from aiohttp import web
+from telegram import Update
+from telegram.ext import ApplicationBuilder, TypeHandler
+
+
+async def run(args):
+    application = (
+        ApplicationBuilder()
+        .token("123456:bench")
+        .request(StubRequest())
+        .application_class(bot.PerUserSerialApplication)
+        .concurrent_updates(bot.CONCURRENT_UPDATES)
+        .updater(None)
+        .build()
+    )
+    posted_at = {}
+    latencies = []
+    done = asyncio.Event()
+
+    async def handler(update, context):
+        latencies.append(time.perf_counter() - posted_at[update.update_id])
+        if len(latencies) == args.updates:
+            done.set()
+
+    application.add_handler(TypeHandler(Update, handler))
+    await application.initialize()
+    await application.start()
+
+    runner = web.AppRunner(bot.build_web_app(application))
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    base = f"http://127.0.0.1:{port}"
+
+    bodies = []
+    for update_id in range(args.updates):
+        update = make_update(update_id, update_id % 300, "/start get_1") if update_id % 3 else \
+            make_callback_update(update_id, update_id % 300, "continue_get_1")
+        bodies.append((update_id, json.dumps(update.to_dict())))
+
+    statuses = {}
+    queue = asyncio.Queue()
+    for item in bodies:
+        queue.put_nowait(item)
+
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"{base}/health") as resp:
+            health = resp.status
+        for _ in range(args.bad_secret):
+            async with session.post(f"{base}{bot.WEBHOOK_PATH}", data="{}",
+                                    headers={bot.SECRET_HEADER: "wrong"}) as resp:
+                statuses[resp.status] = statuses.get(resp.status, 0) + 1
+
+        headers = {bot.SECRET_HEADER: bot.WEBHOOK_SECRET, "Content-Type": "application/json"}
+
+        async def worker():
+            while not queue.empty():
+                update_id, body = queue.get_nowait()
+                posted_at[update_id] = time.perf_counter()
+                async with session.post(f"{base}{bot.WEBHOOK_PATH}", data=body, headers=headers) as resp:
+                    statuses[resp.status] = statuses.get(resp.status, 0) + 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        await asyncio.wait_for(done.wait(), timeout=60)
+        elapsed = time.perf_counter() - started
+
+    await runner.cleanup()
+    await application.stop()
+    await application.shutdown()
+
+    latencies.sort()
+    p = lambda q: latencies[min(len(latencies) - 1, int(q * (len(latencies) - 1)))] * 1000  # noqa: E731
+    print(f"health check: HTTP {health}")
+    print(f"responses:    {dict(sorted(statuses.items()))}  (403 = rejected secret)")
+    print(f"processed:    {len(latencies)} updates in {elapsed:.2f} s  ({len(latencies) / elapsed:.0f} updates/s)")
+    print(f"latency:      p50={p(0.50):.1f} ms  p99={p(0.99):.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--bad-secret", type=int, default=5)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,38 +1,133 @@
+from __future__ import annotations
+
 import os
+import io
+import csv
 import json
 import asyncio
 import logging
 import sqlite3
 from pathlib import Path
-from urllib.parse import quote_plus
-import threading
 from dotenv import load_dotenv
-from aiohttp import web
-from telegram.ext import (
-    ApplicationBuilder,
-    CommandHandler,
-    CallbackQueryHandler,
-    MessageHandler,
-    ConversationHandler,
-    ContextTypes,
-    filters,
-    Updater,
-    CallbackContext,
-    Application,  # Import Application here
-)
+import re
 import time
-from http.server import BaseHTTPRequestHandler, HTTPServer  # اضافه کردن این خط
-
-from telegram import (
-    Update,
-    InlineKeyboardMarkup,
-    InlineKeyboardButton,
-    InputMediaDocument,
-    ReplyKeyboardMarkup,
+import hmac
+import signal
+import hashlib
+import html
+import argparse
+import calendar
+import functools
+import contextlib
+import collections
+import queue
+import threading
+import atexit
+import tempfile
+import heapq
+import pickle
+import random
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from logging.handlers import QueueHandler, QueueListener
+import contextvars
+import importlib
+from bisect import bisect_left
+
+# ============================================================
+# 📦 python-telegram-bot (imported on first use)
+# ============================================================
+# telegram and telegram.ext (with httpx under them) are most of the import time of bot.py,
+# so, like aiohttp further down, they are not imported with the module: load_telegram()
+# binds the names below as module globals when the Application is built. The database
+# helpers, scripts and benchmarks that never build one do not pay for them. Our
+# subclasses of PTB classes are written as mixins (_InstrumentedRequest, ...) and
+# combined with their PTB base there.
+_TELEGRAM_IMPORTS = {
+    "telegram": (
+        "Update",
+        "InlineKeyboardMarkup",
+        "InlineKeyboardButton",
+        "InputMediaDocument",
+        "InputMediaPhoto",
+        "ReplyKeyboardMarkup",
+        "InlineQueryResultArticle",
+        "InlineQueryResultCachedDocument",
+        "InlineQueryResultCachedPhoto",
+        "InputTextMessageContent",
+    ),
+    "telegram.ext": (
+        "ApplicationBuilder",
+        "CommandHandler",
+        "CallbackQueryHandler",
+        "MessageHandler",
+        "ConversationHandler",
+        "InlineQueryHandler",
+        "ContextTypes",
+        "filters",
+        "TypeHandler",
+        "BaseRateLimiter",
+        "BasePersistence",
+        "PersistenceInput",
+        "Application",
+    ),
+    "telegram.ext._application": ("_STOP_SIGNAL",),
+    "telegram.error": ("BadRequest", "Forbidden", "RetryAfter", "TimedOut"),
+    "telegram.request": ("BaseRequest", "HTTPXRequest"),
+}
+_TELEGRAM_SUBCLASSES = (
+    "InstrumentedRequest",
+    "LaneRequest",
+    "OutboundScheduler",
+    "PerUserSerialApplication",
+    "SQLitePersistence",
 )
+_telegram_loaded = False
+
+
+def load_telegram():
+    """Import python-telegram-bot and define the classes built on it; safe to call again."""
+    global _telegram_loaded
+    if _telegram_loaded:
+        return
+    names = globals()
+    for module_name, attrs in _TELEGRAM_IMPORTS.items():
+        module = importlib.import_module(module_name)
+        for attr in attrs:
+            names[attr] = getattr(module, attr)
+
+    # PerUserSerialApplication overrides Application._update_fetcher and uses the private
+    # _concurrent_updates_sem and _STOP_SIGNAL (imported above). They are PTB internals,
+    # checked against python-telegram-bot 20.3 (pinned in requirements.txt); if an upgrade
+    # renames them, fail at start-up instead of silently falling back to PTB's fetcher or
+    # never stopping.
+    if not (
+        callable(getattr(Application, "_update_fetcher", None))
+        and "_concurrent_updates_sem" in Application.__slots__
+    ):
+        raise ImportError(
+            "python-telegram-bot internals changed (Application._update_fetcher / "
+            "_concurrent_updates_sem); PerUserSerialApplication needs python-telegram-bot==20.3"
+        )
+
+    for base, name in (
+        (HTTPXRequest, "InstrumentedRequest"),
+        (BaseRequest, "LaneRequest"),
+        (BaseRateLimiter, "OutboundScheduler"),
+        (Application, "PerUserSerialApplication"),
+        (BasePersistence, "SQLitePersistence"),
+    ):
+        mixin = names["_" + name]
+        names[name] = type(name, (mixin, base), {"__doc__": mixin.__doc__, "__module__": __name__})
+    _telegram_loaded = True
 
-from telegram.error import Forbidden, RetryAfter, TimedOut
-from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes
+
+def __getattr__(name):
+    """``bot.Update``, ``bot.PerUserSerialApplication``, ... from outside load telegram first."""
+    if name in _TELEGRAM_SUBCLASSES or any(name in attrs for attrs in _TELEGRAM_IMPORTS.values()):
+        load_telegram()
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 # ============================================================
 # 🔐 Configuration & Security
@@ -42,26 +137,23 @@ TOKEN = os.getenv("TOKEN")  # اینجا TOKEN را می‌گیریم
 # ✅ Read the bot token securely from environment variables
 
 # بارگذاری توکن ربات از متغیر محیطی
-print(Update, ContextTypes)
-BOT_TOKEN = os.getenv("BOT_TOKEN")
+BOT_TOKEN = os.getenv("BOT_TOKEN") or TOKEN
 PORT = int(os.getenv("PORT", 5000))  # گرفتن پورت از محیط، اگر نیست از 5000 استفاده کن
 
-if not BOT_TOKEN:
-    raise ValueError("❌ BOT_TOKEN environment variable not set. Please define it before running the bot.")
-
 # ✅ Admin usernames (only these can access admin commands)
 ADMINS = ["ktb_2", "GlobalAds_admin"]
 
 # ✅ Path to SQLite database
 DB_PATH = Path("bot.db")
 
-application = ApplicationBuilder().token(BOT_TOKEN).build()
 # ============================================================
 # ⚙️ Global Variables
 # ============================================================
 
-# Stores the configured signal post id
+# Stores the configured signal post id (the first of SIGNAL_POSTS)
 SIGNAL_POST_ID = None
+# Active free signals as [(post_id, weight), ...] in display order
+SIGNAL_POSTS = []
 
 # Conversation states for new post creation
 NP_MAIN, NP_INTRO, NP_TITLE, NP_DESC, NP_CHANNELS = range(5)
@@ -70,21 +162,524 @@ NP_MAIN, NP_INTRO, NP_TITLE, NP_DESC, NP_CHANNELS = range(5)
 # 🧠 Logging Configuration
 # ============================================================
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-)
+# Records are handed to a queue on the event loop thread (QueueHandler) and formatted
+# and written by a background thread (QueueListener), so a slow stderr never blocks
+# the loop. Messages are formatted there too: pass arguments ("%s", value) instead
+# of f-strings. Repeated warnings and errors are rate limited per logger and message
+# template, so one broken channel cannot flood the logs.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # "json" or "text"
+LOG_RATE_LIMIT = int(os.getenv("LOG_RATE_LIMIT", 10))  # same message at most N times ...
+LOG_RATE_PERIOD = float(os.getenv("LOG_RATE_PERIOD", 60))  # ... per this many seconds
+
 logger = logging.getLogger(__name__)
+_log_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line."""
+
+    converter = time.gmtime
+
+    def format(self, record):
+        entry = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key in ("suppressed", "trace_id"):
+            value = getattr(record, key, None)
+            if value:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class RateLimitFilter(logging.Filter):
+    """Pass each (logger, level, message template) of WARNING and above at most `limit` times per `period`.
+
+    The first record let through after a quiet spell carries the number of records
+    dropped in between as ``suppressed``.
+    """
+
+    def __init__(self, limit=LOG_RATE_LIMIT, period=LOG_RATE_PERIOD):
+        super().__init__()
+        self.limit = limit
+        self.period = period
+        self._windows = {}  # key -> [window start, records passed, records dropped]
+
+    def filter(self, record):
+        if self.limit <= 0 or record.levelno < logging.WARNING:
+            return True
+        key = (record.name, record.levelno, record.msg if isinstance(record.msg, str) else str(record.msg))
+        now = time.monotonic()
+        window = self._windows.get(key)
+        if window is None or now - window[0] >= self.period:
+            dropped = window[2] if window else 0
+            self._windows[key] = [now, 1, 0]
+            if dropped:
+                record.suppressed = dropped
+            if len(self._windows) > 1000:
+                self._windows = {k: w for k, w in self._windows.items() if now - w[0] < self.period}
+            return True
+        if window[1] < self.limit:
+            window[1] += 1
+            return True
+        window[2] += 1
+        return False
+
+
+class DeferredQueueHandler(QueueHandler):
+    """QueueHandler that leaves message formatting to the listener thread."""
+
+    def prepare(self, record):
+        # the stock prepare() formats the message here, on the event loop thread
+        return record
+
+
+def configure_logging():
+    """Send all logging through a queue to a background writer thread (idempotent)."""
+    global _log_listener
+    if _log_listener is not None:
+        return
+    stream = logging.StreamHandler()
+    if LOG_FORMAT == "json":
+        stream.setFormatter(JsonFormatter())
+    else:
+        stream.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s", "%Y-%m-%d %H:%M:%S"))
+    log_queue = queue.SimpleQueue()
+    handler = DeferredQueueHandler(log_queue)
+    handler.addFilter(RateLimitFilter())
+    handler.addFilter(TraceIdFilter())
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(LOG_LEVEL)
+    # httpx logs every request at INFO
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    _log_listener = QueueListener(log_queue, stream, respect_handler_level=True)
+    _log_listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Flush queued records and stop the writer thread."""
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener = None
+
+# ============================================================
+# 📈 Metrics (Prometheus text format, served at /metrics)
+# ============================================================
+# Handler latency, Bot API calls (by method) and DB calls are recorded in-process by
+# small Counter/Histogram classes and rendered on demand by the web server.
+# Budget: instrumentation may add at most METRICS_BUDGET_US microseconds per update
+# (one update timing, a couple of handler timings, the DB and Bot API calls of a
+# typical update); benchmarks/bench_metrics.py measures it and fails above the budget.
+METRICS_BUDGET_US = 50
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+DB_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1.0)
+
+METRICS = []  # every metric in registration order, rendered by render_metrics()
+
+
+def _format_labels(names, values, extra=""):
+    pairs = [f'{n}="{str(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """Monotonic counter with optional labels."""
+
+    def __init__(self, name, help_text, labels=()):
+        self.name, self.help, self.labels = name, help_text, tuple(labels)
+        self.values = {}
+        METRICS.append(self)
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for label_values, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Gauge:
+    """Current value (queue depth, ...) with optional labels."""
+
+    def __init__(self, name, help_text, labels=()):
+        self.name, self.help, self.labels = name, help_text, tuple(labels)
+        self.values = {}
+        METRICS.append(self)
+
+    def set(self, value, *label_values):
+        self.values[label_values] = value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        for label_values, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Histogram:
+    """Histogram with fixed buckets; observe() only bumps one bucket, render() accumulates."""
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labels = name, help_text, tuple(labels)
+        self.buckets = tuple(buckets)
+        self.series = {}  # label values -> [per-bucket counts (+Inf last), sum, count]
+        METRICS.append(self)
+
+    def observe(self, value, *label_values):
+        series = self.series.get(label_values)
+        if series is None:
+            series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label_values, (counts, total, count) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                le = _format_labels(self.labels, label_values, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            labels = _format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+def render_metrics():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def metrics_summary():
+    """One-line totals of the main counters (logged at shutdown)."""
+    updates = sum(series[2] for series in UPDATE_LATENCY.series.values())
+    api_calls = sum(API_REQUESTS.values.values())
+    handler_errors = sum(HANDLER_ERRORS.values.values())
+    db_calls = sum(series[2] for series in DB_LATENCY.series.values())
+    return f"updates={updates} api_calls={api_calls} handler_errors={handler_errors} db_calls={db_calls}"
+
+
+UPDATE_LATENCY = Histogram("bot_update_duration_seconds", "Time from dequeuing an update to finishing all its handlers")
+HANDLER_LATENCY = Histogram("bot_handler_duration_seconds", "Handler run time", ["handler"])
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Handlers that raised", ["handler"])
+ROUTE_LATENCY = Histogram("bot_menu_route_duration_seconds", "menu_callback run time per resolved route", ["route"])
+API_LATENCY = Histogram("bot_api_request_duration_seconds", "Bot API request time", ["lane", "method"])
+API_REQUESTS = Counter("bot_api_requests_total", "Bot API requests by HTTP status ('error' for network failures)", ["lane", "method", "status"])
+DB_LATENCY = Histogram("bot_db_call_duration_seconds", "SQLite call time", ["op"], buckets=DB_BUCKETS)
+SEND_QUEUE_DEPTH = Gauge("bot_send_queue_depth", "Sends waiting in the outbound scheduler", ["lane"])
+SEND_WAIT = Histogram("bot_send_wait_seconds", "Time a send waited in the outbound scheduler", ["lane"], buckets=DB_BUCKETS + LATENCY_BUCKETS[4:])
+SEND_RETRIES = Counter("bot_send_retries_total", "Sends retried after a 429 RetryAfter", ["lane"])
+BACKLOG_UPDATES = Counter("bot_backlog_updates_total", "Updates fetched by the start-up catch-up, by outcome", ["outcome"])
+PUBLISHED_MESSAGES = Counter("bot_published_messages_total", "Post previews published to target channels", ["outcome"])
+POST_EDIT_MESSAGES = Counter("bot_post_edit_messages_total", "Sent post messages updated after an edit, by outcome", ["outcome"])
+PERSISTENCE_WRITES = Counter("bot_persistence_writes_total", "Rows written by SQLitePersistence", ["table"])
+MAINTENANCE_STEP = Histogram("bot_maintenance_step_duration_seconds", "Database maintenance step run time", ["step"])
+SCHEDULED_JOBS = Counter("bot_scheduled_jobs_total", "Scheduled jobs finished, by kind and outcome", ["kind", "outcome"])
+SCHEDULED_PENDING = Gauge("bot_scheduled_jobs_pending", "Scheduled jobs waiting in the timer heap")
+BACKLOG_DRAIN = Gauge("bot_backlog_drain_seconds", "Time the last start-up backlog took to be fetched and processed")
+
+
+def timed(func):
+    """Record run time and failures of an async handler under its function name."""
+    label = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        start_time = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            HANDLER_ERRORS.inc(label)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start_time
+            HANDLER_LATENCY.observe(elapsed, label)
+            trace = current_trace.get()
+            if trace is not None:
+                trace.add(f"handler.{label}", start_time, elapsed)
+
+    return wrapper
+
+
+class _InstrumentedRequest:
+    """HTTPXRequest that records latency and status of every Bot API call by lane and method.
+
+    Also takes the keep-alive expiry (HTTPXRequest only sets the pool size) and reuses
+    one SSL context for all clients instead of loading the CA bundle per client.
+    """
+
+    _ssl_context = None
+
+    def __init__(self, lane="interactive", keepalive_expiry=5.0, **kwargs):
+        self.lane = lane
+        self.keepalive_expiry = keepalive_expiry
+        super().__init__(**kwargs)
+
+    def _build_client(self):
+        import httpx
+
+        limits = self._client_kwargs["limits"]
+        self._client_kwargs["limits"] = httpx.Limits(
+            max_connections=limits.max_connections,
+            max_keepalive_connections=limits.max_keepalive_connections,
+            keepalive_expiry=self.keepalive_expiry,
+        )
+        if InstrumentedRequest._ssl_context is None:
+            InstrumentedRequest._ssl_context = httpx.create_ssl_context()
+        self._client_kwargs["verify"] = InstrumentedRequest._ssl_context
+        return super()._build_client()
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        start_time = time.perf_counter()
+        status = "error"
+        try:
+            status, payload = await super().do_request(url, method, request_data, **kwargs)
+            return status, payload
+        finally:
+            elapsed = time.perf_counter() - start_time
+            API_LATENCY.observe(elapsed, self.lane, api_method)
+            API_REQUESTS.inc(self.lane, api_method, status)
+            trace = current_trace.get()
+            if trace is not None:
+                trace.add(f"api.{api_method}", start_time, elapsed, status)
+
+
+_READ_STATEMENTS = ("SELECT", "PRAGMA", "WITH")
+
+
+def _db_observe(op, span_name, start_time):
+    elapsed = time.perf_counter() - start_time
+    DB_LATENCY.observe(elapsed, op)
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add(span_name, start_time, elapsed)
+
+
+def _db_span(sql):
+    return "db.read" if sql.lstrip()[:6].upper().startswith(_READ_STATEMENTS) else "db.write"
+
+
+class MetricsCursor(sqlite3.Cursor):
+    """Cursor that times execute/fetch calls (and records them as spans of the current trace)."""
+
+    def execute(self, sql, parameters=()):
+        start_time = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _db_observe("execute", _db_span(sql), start_time)
+
+    def executemany(self, sql, seq_of_parameters):
+        start_time = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _db_observe("executemany", "db.write", start_time)
+
+    def fetchone(self):
+        start_time = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            _db_observe("fetch", "db.read", start_time)
+
+    def fetchall(self):
+        start_time = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            _db_observe("fetch", "db.read", start_time)
+
+    def fetchmany(self, size=None):
+        start_time = time.perf_counter()
+        try:
+            return super().fetchmany(self.arraysize if size is None else size)
+        finally:
+            _db_observe("fetch", "db.read", start_time)
+
+
+class MetricsConnection(sqlite3.Connection):
+    """Connection whose cursors (including conn.execute shortcuts) and commits are timed."""
+
+    def cursor(self, factory=MetricsCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        start_time = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            _db_observe("commit", "db.write", start_time)
+
+
+def db_connect():
+    """Open the bot database; every query on the connection is recorded in DB_LATENCY."""
+    return sqlite3.connect(DB_PATH, factory=MetricsConnection)
+
+
+# ============================================================
+# 🔎 Tracing (per-update spans and slow-update report)
+# ============================================================
+# Every update gets a Trace with a trace id (also added to its log records). DB calls,
+# Bot API calls, waits in the outbound scheduler, membership checks and handlers add
+# timed spans to it. Updates slower than SLOW_UPDATE_SECONDS keep their full span
+# list in a ring buffer, shown by the /slow admin command and, when DEBUG_TOKEN is
+# set, as JSON at /debug/slow?token=<DEBUG_TOKEN>.
+SLOW_UPDATE_SECONDS = float(os.getenv("SLOW_UPDATE_SECONDS", 2))
+SLOW_UPDATE_BUFFER = int(os.getenv("SLOW_UPDATE_BUFFER", 50))
+TRACE_MAX_SPANS = 300
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+slow_updates = collections.deque(maxlen=SLOW_UPDATE_BUFFER)
+
+
+class Trace:
+    __slots__ = ("trace_id", "update_id", "user_id", "label", "started_at", "start", "spans", "dropped")
+
+    def __init__(self, update_id=None, user_id=None, label=""):
+        self.trace_id = os.urandom(6).hex()
+        self.update_id = update_id
+        self.user_id = user_id
+        self.label = label
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.spans = []  # (name, offset from start, duration, detail)
+        self.dropped = 0
+
+    def add(self, name, start_time, elapsed, detail=None):
+        if len(self.spans) < TRACE_MAX_SPANS:
+            self.spans.append((name, start_time - self.start, elapsed, detail))
+        else:
+            self.dropped += 1
+
+    def as_dict(self, duration):
+        return {
+            "trace_id": self.trace_id,
+            "update_id": self.update_id,
+            "user_id": self.user_id,
+            "label": self.label,
+            "started_at": time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(self.started_at)),
+            "duration": round(duration, 4),
+            "spans": [
+                {"name": name, "offset": round(offset, 4), "duration": round(elapsed, 4), "detail": detail}
+                for name, offset, elapsed, detail in self.spans
+            ],
+            "dropped_spans": self.dropped,
+        }
+
+
+@contextlib.contextmanager
+def span(name, detail=None):
+    """Record the enclosed block as a span of the current trace (no-op outside updates)."""
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, start_time, time.perf_counter() - start_time, detail)
+
+
+def trace_label(update):
+    """Short description of what an update asked for: button data or command, never free text."""
+    if not isinstance(update, Update):
+        return type(update).__name__
+    if update.callback_query:
+        return f"callback:{(update.callback_query.data or '')[:40]}"
+    if update.message and update.message.text and update.message.text.startswith("/"):
+        return update.message.text.split()[0][:40]
+    if update.message:
+        return "message"
+    return "update"
+
+
+def start_trace(update):
+    user = update.effective_user if isinstance(update, Update) else None
+    return Trace(getattr(update, "update_id", None), user.id if user else None, trace_label(update))
+
+
+def finish_trace(trace):
+    duration = time.perf_counter() - trace.start
+    if duration >= SLOW_UPDATE_SECONDS:
+        slow_updates.append(trace.as_dict(duration))
+        slowest = max(trace.spans, key=lambda item: item[2], default=None)
+        logger.warning(
+            "🐢 Slow update %s (%s) took %.2fs; slowest span: %s",
+            trace.update_id, trace.label, duration,
+            f"{slowest[0]} {slowest[2]:.2f}s" if slowest else "-",
+        )
+
+
+class TraceIdFilter(logging.Filter):
+    """Adds the current trace id to log records (as ``trace_id``)."""
+
+    def filter(self, record):
+        trace = current_trace.get()
+        record.trace_id = trace.trace_id if trace is not None else None
+        return True
+
+
+def format_slow_updates(count=5):
+    """Text report of the latest slow updates for Telegram (newest first)."""
+    if not slow_updates:
+        return f"✅ هیچ آپدیت کندی (بیش از {SLOW_UPDATE_SECONDS:g} ثانیه) ثبت نشده است."
+    blocks = []
+    for entry in list(slow_updates)[-count:][::-1]:
+        lines = [
+            f"🐢 {entry['started_at']} — {entry['duration']:.2f}s — {entry['label']}",
+            f"update {entry['update_id']} | user {entry['user_id']} | trace {entry['trace_id']}",
+        ]
+        for item in sorted(entry["spans"], key=lambda item: item["duration"], reverse=True)[:8]:
+            detail = f" {item['detail']}" if item["detail"] else ""
+            lines.append(f"  +{item['offset']:.2f}s {item['duration']:.3f}s {item['name']}{detail}")
+        if len(entry["spans"]) > 8:
+            lines.append(f"  … {len(entry['spans']) - 8} more spans")
+        blocks.append("\n".join(lines))
+    return "\n\n".join(blocks)[:4000]
+
+
+async def show_slow_updates(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/slow [n] — span breakdown of the latest slow updates (admins only)."""
+    if not (update.effective_user and update.effective_user.username in ADMINS):
+        await update.message.reply_text("❌ ✨ Unauthorized. ✨")
+        return
+    count = int(context.args[0]) if context.args and context.args[0].isdigit() else 5
+    await update.message.reply_text(format_slow_updates(count))
+
 
-logger.info("✅ Configuration loaded successfully.")
-async def start(update, context):
-    logger.info("Received /start command")  # لاگ برای بررسی اینکه دستور /start دریافت شده است
-    await update.message.reply_text("✅ Hello! I'm your bot. How can I help you?")
 # Database setup
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
+    conn = db_connect()
     c = conn.cursor()
+    # lets maintenance return free pages in small steps; only takes effect on a new database
+    # (older ones are converted once by run_maintenance)
+    c.execute("PRAGMA auto_vacuum = INCREMENTAL")
     c.execute("""
     CREATE TABLE IF NOT EXISTS posts (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -107,20 +702,162 @@ def init_db():
         first_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP
     )
     """)
+    # posts.expires_at (unix time) was added later; expired posts are deleted by maintenance
+    cols = [r[1] for r in c.execute("PRAGMA table_info(posts)")]
+    if "expires_at" not in cols:
+        c.execute("ALTER TABLE posts ADD COLUMN expires_at REAL")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_posts_expires_at ON posts(expires_at) WHERE expires_at IS NOT NULL")
+    # users.last_seen was added later; migrate older databases in place
+    cols = [r[1] for r in c.execute("PRAGMA table_info(users)")]
+    if "last_seen" not in cols:
+        c.execute("ALTER TABLE users ADD COLUMN last_seen TIMESTAMP")
+    # indexes used by broadcast segments (see compile_segment)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_first_seen ON users(first_seen)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_last_seen ON users(last_seen)")
+    # which users requested which post (get_<id> deep links)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS post_requests (
+        post_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        requested_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (post_id, user_id)
+    ) WITHOUT ROWID
+    """)
+    # broadcasts and the users each one has reached (for "not yet reached" segments)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        segment TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+        broadcast_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        PRIMARY KEY (broadcast_id, user_id)
+    ) WITHOUT ROWID
+    """)
+    # timed jobs (post publishing, signal rotation) run by JobScheduler
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS scheduled_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        run_at REAL NOT NULL,
+        kind TEXT NOT NULL,
+        payload TEXT NOT NULL DEFAULT '{}',
+        status TEXT NOT NULL DEFAULT 'pending',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        finished_at TIMESTAMP,
+        error TEXT
+    )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_scheduled_jobs_pending ON scheduled_jobs(run_at) WHERE status = 'pending'")
+    # messages a post was sent as (channel posts, admin previews and details), to update
+    # them when the post is edited. kind: "preview" or "details" (the admin listing);
+    # media: 1 when the message is a photo/document, whose caption is edited instead of its text
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS post_messages (
+        post_id INTEGER NOT NULL,
+        chat_id INTEGER NOT NULL,
+        message_id INTEGER NOT NULL,
+        sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        kind TEXT NOT NULL DEFAULT 'preview',
+        media INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (post_id, chat_id, message_id)
+    ) WITHOUT ROWID
+    """)
+    cols = [r[1] for r in c.execute("PRAGMA table_info(post_messages)")]
+    if "kind" not in cols:
+        c.execute("ALTER TABLE post_messages ADD COLUMN kind TEXT NOT NULL DEFAULT 'preview'")
+        c.execute("ALTER TABLE post_messages ADD COLUMN media INTEGER NOT NULL DEFAULT 0")
+    create_post_search_index(c)
+    # user_data and conversation states (SQLitePersistence)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS user_data (
+        user_id INTEGER PRIMARY KEY,
+        data BLOB NOT NULL,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS conversations (
+        name TEXT NOT NULL,
+        key TEXT NOT NULL,
+        state TEXT NOT NULL,
+        PRIMARY KEY (name, key)
+    ) WITHOUT ROWID
+    """)
     conn.commit()
-    # Load persisted signal post ID
-    c.execute("SELECT value FROM settings WHERE key = 'signal_post_id'")
-    row = c.fetchone()
-    global SIGNAL_POST_ID
-    if row:
-        SIGNAL_POST_ID = row[0]
+    # Load the persisted signal set (older databases only have a single signal_post_id)
+    c.execute("SELECT key, value FROM settings WHERE key IN ('signal_posts', 'signal_post_id')")
+    stored = dict(c.fetchall())
     conn.close()
+    global SIGNAL_POST_ID, SIGNAL_POSTS
+    if stored.get("signal_posts"):
+        SIGNAL_POSTS = [(int(post_id), int(weight)) for post_id, weight in json.loads(stored["signal_posts"])]
+    elif stored.get("signal_post_id"):
+        SIGNAL_POSTS = [(int(stored["signal_post_id"]), 1)]
+    SIGNAL_POST_ID = SIGNAL_POSTS[0][0] if SIGNAL_POSTS else None
+
+# ------------------------------------------------------------
+# 🔍 Post search index (FTS5)
+# ------------------------------------------------------------
+# posts_fts holds each post's title and description under the post id as rowid. The
+# functions that write posts (save_post_db, save_posts_db, update_post_caption_db and
+# the deletes) update it in the same transaction. (Triggers would do the same, but
+# every new connection parses their SQL; db_connect runs per call.) Arabic ي/ك are
+# folded to Persian ی/ک on both sides, so a search matches whichever keyboard the
+# text was typed with.
+def fold_search_text(text):
+    return (text or "").replace("ي", "ی").replace("ك", "ک")
+
+
+def index_post(c, post_id, cap):
+    c.execute("DELETE FROM posts_fts WHERE rowid = ?", (post_id,))
+    c.execute(
+        "INSERT INTO posts_fts (rowid, title, description) VALUES (?, ?, ?)",
+        (post_id, fold_search_text(cap.get("title")), fold_search_text(cap.get("description"))),
+    )
+
+
+def create_post_search_index(c):
+    exists = c.execute("SELECT 1 FROM sqlite_master WHERE name = 'posts_fts'").fetchone()
+    c.execute("""
+    CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5(
+        title, description, tokenize = 'unicode61 remove_diacritics 2'
+    )
+    """)
+    if not exists:  # first run with the index: add the posts saved before it existed
+        for post_id, caption in c.execute("SELECT id, caption FROM posts").fetchall():
+            cap, _channels = decode_post({"caption": caption}, untitled="")
+            index_post(c, post_id, cap)
+
+
+def fts_query(text):
+    """Turn free text into an FTS5 query: every word must match, as a prefix, in any order."""
+    return " ".join(f'"{word}"*' for word in re.findall(r"\w+", fold_search_text(text)))
+
+
+def search_posts(text, page=0, page_size=10):
+    """Ranked matches for ``text``; returns ``(total, [(post_id, title, snippet), ...])`` for one page."""
+    match = fts_query(text)
+    if not match:
+        return 0, []
+    conn = db_connect()
+    total = conn.execute("SELECT count(*) FROM posts_fts WHERE posts_fts MATCH ?", (match,)).fetchone()[0]
+    # title matches weigh more than description matches
+    rows = conn.execute(
+        "SELECT rowid, title, snippet(posts_fts, 1, '', '', '…', 10) FROM posts_fts "
+        "WHERE posts_fts MATCH ? ORDER BY bm25(posts_fts, 10.0, 1.0) LIMIT ? OFFSET ?",
+        (match, page_size, page * page_size),
+    ).fetchall()
+    conn.close()
+    return total, rows
 
-init_db()
 
 # settings helpers (persistent small key/value storage)
 def get_setting(key, default=None):
-    conn = sqlite3.connect(DB_PATH)
+    conn = db_connect()
     cur = conn.cursor()
     cur.execute("SELECT value FROM settings WHERE key = ?", (key,))
     row = cur.fetchone()
@@ -128,7 +865,7 @@ def get_setting(key, default=None):
     return row[0] if row else default
 
 def set_setting(key, value):
-    conn = sqlite3.connect(DB_PATH)
+    conn = db_connect()
     cur = conn.cursor()
     cur.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, str(value)))
     conn.commit()
@@ -139,13 +876,13 @@ def add_user_to_db(user):
     if not user:
         return
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect()
         cur = conn.cursor()
         username = getattr(user, "username", "") or ""
         # insert if missing
         cur.execute("INSERT OR IGNORE INTO users (user_id, username) VALUES (?, ?)", (user.id, username))
         # keep username fresh
-        cur.execute("UPDATE users SET username = ? WHERE user_id = ?", (username, user.id))
+        cur.execute("UPDATE users SET username = ?, last_seen = CURRENT_TIMESTAMP WHERE user_id = ?", (username, user.id))
         conn.commit()
     except Exception:
         logger.exception("Failed to add/update user in DB")
@@ -155,10 +892,52 @@ def add_user_to_db(user):
         except Exception:
             pass
 
+# last_seen updates are buffered in memory and written in one batch, so recording
+# activity does not cost a DB write per update
+ACTIVITY_FLUSH_INTERVAL = 60  # seconds
+_pending_seen = {}
+_last_seen_flush = time.monotonic()
+
+def flush_user_activity():
+    """Write buffered last_seen timestamps to the users table."""
+    global _last_seen_flush
+    _last_seen_flush = time.monotonic()
+    if not _pending_seen:
+        return 0
+    rows = [(ts, uid) for uid, ts in _pending_seen.items()]
+    _pending_seen.clear()
+    try:
+        conn = db_connect()
+        conn.executemany("UPDATE users SET last_seen = ? WHERE user_id = ?", rows)
+        conn.commit()
+        conn.close()
+    except Exception:
+        logger.exception("Failed to flush user activity")
+    return len(rows)
+
+async def track_user_activity(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Runs before every other handler (group -1) and records when a user was last active."""
+    user = update.effective_user
+    if not user:
+        return
+    _pending_seen[user.id] = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+    if time.monotonic() - _last_seen_flush >= ACTIVITY_FLUSH_INTERVAL:
+        flush_user_activity()
+
+def record_post_request(user_id, post_id):
+    """Remember that a user requested a post (used by the post:<id> broadcast segment)."""
+    try:
+        conn = db_connect()
+        conn.execute("INSERT OR IGNORE INTO post_requests (post_id, user_id) VALUES (?, ?)", (int(post_id), user_id))
+        conn.commit()
+        conn.close()
+    except Exception:
+        logger.exception("Failed to record post request")
+
 def get_user_count():
     """Return number of distinct users recorded."""
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect()
         cur = conn.cursor()
         cur.execute("SELECT COUNT(*) FROM users")
         row = cur.fetchone()
@@ -171,7 +950,7 @@ def get_user_count():
 def get_post_count():
     """Return number of posts recorded."""
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_connect()
         cur = conn.cursor()
         cur.execute("SELECT COUNT(*) FROM posts")
         row = cur.fetchone()
@@ -191,130 +970,67 @@ async def stats_bot(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     users = get_user_count()
     posts = get_post_count()
-    signal = SIGNAL_POST_ID or "ندارد"
+    signal = "، ".join(f"#{post_id}" for post_id, _weight in SIGNAL_POSTS) or "ندارد"
     try:
         await update.message.reply_text(
             f"📊 آمار ربات:\n\n👥 تعداد اعضا: {users}\n📝 تعداد پست‌ها: {posts}\n⚡️ سیگنال رایگان: {signal}"
         )
     except Exception:
         pass
-# 🆕 ثبت سیگنال جدید (توسط ادمین‌ها)
-async def newpost_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.info(f"newpost_start triggered by user={update.effective_user.id}")
-    try:
-        origin_text = update.message.text if update.message and update.message.text else None
-        if origin_text:
-            context.user_data["post_origin"] = origin_text
-    except Exception:
-        pass
-
-    await update.message.reply_text(
-        "✨ لطفاً فایل اصلی را ارسال کنید (فایل، عکس یا متن)\nبرای لغو از /cancel استفاده کنید. ✨"
-    )
-    return NP_MAIN
-
-
-async def newpost_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Receive main file/text"""
-    msg = update.message
-    logger.info(f"newpost_main from {update.effective_user.id}")
-    if msg.document:
-        context.user_data["main_file"] = {"file_id": msg.document.file_id, "type": "document"}
-    elif msg.photo:
-        context.user_data["main_file"] = {"file_id": msg.photo[-1].file_id, "type": "photo"}
-    elif msg.text:
-        context.user_data["main_file"] = {"text": msg.text, "type": "text"}
-
-    await update.message.reply_text(
-        "✨ حالا فایل معرفی را ارسال کنید (فایل، عکس یا متن)\nاین فایل قبل از دریافت فایل اصلی نمایش داده می‌شود. ✨"
-    )
-    return NP_INTRO
-
-
-async def newpost_intro(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    msg = update.message
-    logger.info(f"newpost_intro from {update.effective_user.id}")
-    if msg.document:
-        context.user_data["intro_file"] = {"file_id": msg.document.file_id, "type": "document"}
-    elif msg.photo:
-        context.user_data["intro_file"] = {"file_id": msg.photo[-1].file_id, "type": "photo"}
-    elif msg.text:
-        context.user_data["intro_file"] = {"text": msg.text, "type": "text"}
-
-    await update.message.reply_text("✨ عنوان پست را وارد کنید: ✨")
-    return NP_TITLE
-
-
-async def newpost_title(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    context.user_data["title"] = update.message.text
-    await update.message.reply_text("✨ توضیحات پست را وارد کنید: ✨")
-    return NP_DESC
-
-
-async def newpost_desc(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    context.user_data["description"] = update.message.text
-    await update.message.reply_text(
-        "✨ آیدی کانال‌های اجباری را وارد کنید (هر کدام در یک خط)\nاگر کانال اجباری ندارید، None بنویسید: ✨"
-    )
-    return NP_CHANNELS
-
-
-async def newpost_channels(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = update.message.text.strip()
-    parsed = parse_channels_text(text) if text.lower() != "none" else []
-    context.user_data["channels"] = json.dumps(parsed, ensure_ascii=False)
-
-    # Save post
-    post_id = save_post_db(context.user_data)
-    await update.message.reply_text("✅ ✨ پست با موفقیت ذخیره شد. ✨")
-
-    bot_user = await context.bot.get_me()
-    bot_username = getattr(bot_user, "username", None) or ""
-    deep_link = f"https://t.me/{bot_username}?start=get_{post_id}" if bot_username else f"https://t.me/{post_id}"
-    kb = InlineKeyboardMarkup([[InlineKeyboardButton("📥 Receive", url=deep_link)]])
-    caption = f"📌 {context.user_data.get('title','Untitled')}\n<a href=\"{deep_link}\">📥 Receive</a>"
-
-    intro = context.user_data.get("intro_file", {})
-    try:
-        if intro:
-            if intro.get("type") == "photo" and intro.get("file_id"):
-                await update.message.reply_photo(photo=intro["file_id"], caption=caption, reply_markup=kb, parse_mode="HTML")
-            elif intro.get("type") == "document" and intro.get("file_id"):
-                await update.message.reply_document(document=intro["file_id"], caption=caption, reply_markup=kb, parse_mode="HTML")
-            elif intro.get("type") == "text" and intro.get("text"):
-                await update.message.reply_text(intro.get("text"), reply_markup=kb, parse_mode="HTML")
-            else:
-                await update.message.reply_text(caption, reply_markup=kb, parse_mode="HTML")
-    except Exception:
-        await update.message.reply_text(caption, reply_markup=kb, parse_mode="HTML")
-
-    origin = context.user_data.get("post_origin")
-    if origin == "📣 سیگنال رایگان":
-        try:
-            await update.message.reply_text(f"✨ پیش‌نمایش پست {post_id} برای سیگنال رایگان نمایش داده شد. ✨")
-        except Exception:
-            pass
-
-    context.user_data.clear()
-    return ConversationHandler.END
-
 
 
-
-def save_post_db(data):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    caption = json.dumps({
+def encode_post_caption(data):
+    return json.dumps({
         "title": data["title"],
         "description": data["description"],
         "main_file": data["main_file"],
         "intro_file": data["intro_file"]
     })
-    c.execute("INSERT INTO posts (caption, channels) VALUES (?, ?)", (caption, data["channels"]))
+
+def save_post_db(data):
+    conn = db_connect()
+    c = conn.cursor()
+    c.execute("INSERT INTO posts (caption, channels) VALUES (?, ?)", (encode_post_caption(data), data["channels"]))
     post_id = c.lastrowid
+    index_post(c, post_id, data)
     conn.commit()
     conn.close()
+    invalidate_title_index()
     return post_id
+
+def save_posts_db(posts):
+    """Insert many posts in one transaction (all or none); returns their ids in order."""
+    conn = db_connect()
+    try:
+        c = conn.cursor()
+        post_ids = []
+        for data in posts:
+            c.execute("INSERT INTO posts (caption, channels) VALUES (?, ?)", (encode_post_caption(data), data["channels"]))
+            post_ids.append(c.lastrowid)
+            index_post(c, c.lastrowid, data)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    invalidate_title_index()
+    return post_ids
+
+
+def update_post_caption_db(post_id, cap):
+    """Store an edited caption dict and re-index the post."""
+    conn = db_connect()
+    c = conn.cursor()
+    c.execute("UPDATE posts SET caption = ? WHERE id = ?", (json.dumps(cap, ensure_ascii=False), post_id))
+    index_post(c, post_id, cap)
+    conn.commit()
+    conn.close()
+    invalidate_title_index()
+    if is_signal_post(post_id):
+        invalidate_signal_cache()
+
+
 async def send_intro(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     try:
@@ -323,7 +1039,7 @@ async def send_intro(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         await update.message.reply_text(f"✨ Error sending intro file: {str(e)} ✨")
 def get_post_db(post_id):
-    conn = sqlite3.connect(DB_PATH)
+    conn = db_connect()
     c = conn.cursor()
     c.execute("SELECT caption, channels FROM posts WHERE id = ?", (post_id,))
     row = c.fetchone()
@@ -333,49 +1049,192 @@ def get_post_db(post_id):
         return {"caption": caption, "channels": channels}
     return None
 
-def delete_post_db(post_id):
-    global SIGNAL_POST_ID
-    # جلوگیری از حذف سیگنال فعال 
-    if SIGNAL_POST_ID and str(post_id) == str(SIGNAL_POST_ID):
-        # فقط اجازه حذف اگر سیگنال جدید ثبت شده باشد (یعنی SIGNAL_POST_ID تغییر کند)
-        return False
-        
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("DELETE FROM posts WHERE id = ?", (post_id,))
-    conn.commit()
-    conn.close()
-    return True
+def decode_post(post, untitled="Untitled"):
+    """Decode a posts row into ``(caption dict, channel list)``.
 
-def force_delete_post_db(post_id):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("DELETE FROM posts WHERE id = ?", (post_id,))
-    conn.commit()
-    conn.close()
-    return True
+    Channels stored as plain lines (older rows) become ``{"name", "username"}`` dicts.
+    """
+    try:
+        cap = json.loads(post["caption"])
+    except Exception:
+        cap = {"title": untitled, "description": "", "main_file": {}, "intro_file": {}}
+    channels_text = post.get("channels") or ""
+    try:
+        channels = json.loads(channels_text) if channels_text else []
+    except Exception:
+        channels = []
+        for line in channels_text.splitlines():
+            line = line.strip()
+            if line:
+                channels.append({"name": line, "username": line.lstrip('@')})
+    return cap, channels
+
+
+def join_keyboard(channels, post_id):
+    """Buttons for the channels still to join, plus the membership re-check button."""
+    channel_buttons = [
+        [InlineKeyboardButton(item.get('name') or item.get('username'), url=f"https://t.me/{item.get('username')}")]
+        for item in channels
+    ]
+    membership_button = [InlineKeyboardButton("✅ Check membership", callback_data=f"continue_get_{post_id}")]
+    return InlineKeyboardMarkup(channel_buttons + [membership_button])
 
-async def check_join_status(user_id, channels, context: ContextTypes.DEFAULT_TYPE):
-    not_joined = []
-    for channel in channels:
-        channel = channel.strip()
-        if not channel:
-            continue
-        try:
-            # protect each API call with a short timeout to avoid hanging
-            # ensure channel is in username form with @ prefix for get_chat_member
-            channel_param = channel if channel.startswith("@") else f"@{channel}"
+
+def post_info_caption(title, description):
+    return f"📌 عنوان: {title}\n\n📝 توضیحات:\n{description}"
+
+
+def post_details_caption(post_id, cap, channels):
+    """The admin listing's text for a post: id, title, description and join channels."""
+    channels_display = "\n".join(f"• {ch['name']} — @{ch['username']}" for ch in channels) if channels else "بدون کانال"
+    title = cap.get("title", "بدون عنوان")
+    desc = cap.get("description", "") or "بدون توضیحات"
+    return f"📌 #{post_id} — {title}\n\n📝 توضیحات:\n{desc}\n\n🔗 کانال‌های جوین:\n{channels_display}"
+
+
+def post_details_keyboard(post_id):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("✏️ ویرایش", callback_data=f"edit_post_{post_id}"),
+         InlineKeyboardButton("❌ حذف", callback_data=f"delete_post_{post_id}")]
+    ])
+
+
+# Album posts store main_file as {"type": "album", "items": [{"type": "photo"|"document", "file_id"}, ...]}
+# and are delivered with send_media_group, up to Telegram's limit of 10 items per call.
+MEDIA_GROUP_LIMIT = 10
+
+
+def album_chunks(items):
+    """Split album items into send_media_group batches.
+
+    Telegram only groups documents with documents, so a change between photos and
+    documents starts a new batch, as does reaching MEDIA_GROUP_LIMIT.
+    """
+    chunks = []
+    for item in items:
+        if chunks and len(chunks[-1]) < MEDIA_GROUP_LIMIT and (chunks[-1][-1]["type"] == "document") == (item["type"] == "document"):
+            chunks[-1].append(item)
+        else:
+            chunks.append([item])
+    return chunks
+
+
+async def send_album(bot, chat_id, items, caption=None):
+    """Send album items with one send_media_group call per chunk; ``caption`` goes on the first item."""
+    for chunk in album_chunks(items):
+        if len(chunk) == 1:  # a media group needs at least two items
+            item = chunk[0]
+            if item["type"] == "photo":
+                await bot.send_photo(chat_id=chat_id, photo=item["file_id"], caption=caption)
+            else:
+                await bot.send_document(chat_id=chat_id, document=item["file_id"], caption=caption)
+        else:
+            media_class = {"photo": InputMediaPhoto, "document": InputMediaDocument}
+            media = [
+                media_class[item["type"]](media=item["file_id"], caption=caption if index == 0 else None)
+                for index, item in enumerate(chunk)
+            ]
+            await bot.send_media_group(chat_id=chat_id, media=media)
+        caption = None
+
+
+def post_deep_link(bot_username, post_id):
+    return f"https://t.me/{bot_username}?start=get_{post_id}" if bot_username else f"https://t.me/{post_id}"
+
+
+def preview_content(post_id, cap, bot_username):
+    """``(caption, text, keyboard)`` of a post preview: the caption put on intro/main media,
+    the text of a text-only preview, and the "📥 Receive" button."""
+    # titles and intro texts are plain text typed by admins; "<" or "&" would break the HTML
+    title = html.escape(cap.get("title") or "بدون عنوان", quote=False)
+    intro = cap.get("intro_file", {}) or {}
+    # ساخت لینک دریافت فایل + دکمه شیشه‌ای
+    deep_link = post_deep_link(bot_username, post_id)
+    kb = InlineKeyboardMarkup([[InlineKeyboardButton("📥 Receive", url=deep_link)]])
+    caption_html = f"📌 {title}\n\n<a href=\"{deep_link}\">📥 Receive</a>"
+    # اگر intro از نوع متن بود -> یک پیام شامل عنوان + متن معرفی + لینک پنهان
+    if intro.get("type") == "text" and intro.get("text"):
+        intro_text = html.escape(intro["text"], quote=False)
+        return caption_html, f"📌 {title}\n\n{intro_text}\n\n<a href=\"{deep_link}\">📥 Receive</a>", kb
+    return caption_html, caption_html, kb
+
+
+async def send_post_preview(bot, chat_id, post_id, cap, bot_username):
+    """Send a post's intro (or main file) with its title and the "📥 Receive" deep link; returns the Message."""
+    intro = cap.get("intro_file", {}) or {}
+    main = cap.get("main_file", {}) or {}
+    if main.get("type") == "album" and main.get("items"):
+        main = main["items"][0]  # an album is previewed by its first item
+    caption_html, text_html, kb = preview_content(post_id, cap, bot_username)
+
+    # اگر intro وجود دارد و عکس/فایل است -> ارسال با کپشن شامل عنوان+لینک
+    if intro.get("file_id"):
+        if intro.get("type") == "photo":
+            return await bot.send_photo(chat_id=chat_id, photo=intro["file_id"], caption=caption_html, reply_markup=kb, parse_mode="HTML")
+        return await bot.send_document(chat_id=chat_id, document=intro["file_id"], caption=caption_html, reply_markup=kb, parse_mode="HTML")
+    if intro.get("type") == "text" and intro.get("text"):
+        return await bot.send_message(chat_id=chat_id, text=text_html, reply_markup=kb, parse_mode="HTML")
+    # اگر intro وجود ندارد ولی فایل اصلی هست -> از فایل اصلی استفاده کن (با کپشن)
+    if main.get("file_id"):
+        if main.get("type") == "photo":
+            return await bot.send_photo(chat_id=chat_id, photo=main["file_id"], caption=caption_html, reply_markup=kb, parse_mode="HTML")
+        return await bot.send_document(chat_id=chat_id, document=main["file_id"], caption=caption_html, reply_markup=kb, parse_mode="HTML")
+    # در غیر این صورت فقط عنوان + لینک را به‌صورت متن ارسال کن
+    return await bot.send_message(chat_id=chat_id, text=text_html, reply_markup=kb, parse_mode="HTML")
+
+
+def delete_post_db(post_id):
+    # جلوگیری از حذف سیگنال فعال 
+    if is_signal_post(post_id):
+        # فقط اجازه حذف اگر سیگنال جدید ثبت شده باشد (یعنی پست از سیگنال‌های فعال خارج شود)
+        return False
+        
+    conn = db_connect()
+    c = conn.cursor()
+    c.execute("DELETE FROM posts WHERE id = ?", (post_id,))
+    c.execute("DELETE FROM posts_fts WHERE rowid = ?", (post_id,))
+    c.execute("DELETE FROM post_messages WHERE post_id = ?", (post_id,))
+    conn.commit()
+    conn.close()
+    invalidate_title_index()
+    return True
+
+def force_delete_post_db(post_id):
+    conn = db_connect()
+    c = conn.cursor()
+    c.execute("DELETE FROM posts WHERE id = ?", (post_id,))
+    c.execute("DELETE FROM posts_fts WHERE rowid = ?", (post_id,))
+    c.execute("DELETE FROM post_messages WHERE post_id = ?", (post_id,))
+    conn.commit()
+    conn.close()
+    invalidate_title_index()
+    if is_signal_post(post_id):
+        invalidate_signal_cache()
+    return True
+
+async def check_join_status(user_id, channels, context: ContextTypes.DEFAULT_TYPE):
+    not_joined = []
+    for channel in channels:
+        channel = channel.strip()
+        if not channel:
+            continue
+        try:
+            # protect each API call with a short timeout to avoid hanging
+            # ensure channel is in username form with @ prefix for get_chat_member
+            channel_param = channel if channel.startswith("@") else f"@{channel}"
             try:
-                member = await asyncio.wait_for(context.bot.get_chat_member(channel_param, user_id), timeout=5)
+                with span("membership", channel_param):
+                    member = await asyncio.wait_for(context.bot.get_chat_member(channel_param, user_id), timeout=5)
             except asyncio.TimeoutError:
-                logger.warning(f"Timeout while checking membership for {channel} and user {user_id}")
+                logger.warning("Timeout while checking membership for %s and user %s", channel, user_id)
                 not_joined.append(channel)
                 continue
 
             if member.status not in ["creator", "administrator", "member"]:
                 not_joined.append(channel)
-        except Exception:
-            logger.exception(f"Error checking membership for channel {channel}")
+        except Exception as exc:
+            # no traceback: a broken channel fails the same way for every user
+            logger.warning("Error checking membership for channel %s: %r", channel, exc)
             not_joined.append(channel)
     return not_joined
 
@@ -437,35 +1296,7 @@ def parse_channels_text(channels_text: str):
 
     return out
 
-async def start(update, context):
-    await update.message.reply_text('Hello!')
-
-
-
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """ثبت کاربر و نمایش منوی اصلی"""
-    user = update.effective_user
-    chat_id = update.effective_chat.id if update.effective_chat else None
-
-    # ثبت کاربر در دیتابیس
-    try:
-        if user:
-            add_user_to_db(user)
-    except Exception:
-        pass
-
-    # پیام خوش‌آمد برای کاربر
-    welcome_text = (
-        "👋 Hi!\n"
-        "Welcome to the Free Signals bot.\n"
-        "Please choose an option from the menu below 👇"
-    )
-# ✨ ارسال پیام خوش‌آمد
-    await context.bot.send_message(chat_id=update.effective_chat.id, text=welcome_text)
-
-
-
-
+@timed
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """نمایش پیام خوش‌آمد در استارت اصلی و حذف آن هنگام دریافت فایل"""
     user = update.effective_user
@@ -488,21 +1319,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not post:
             await update.message.reply_text("❌ File not found.")
             return
+        if user:
+            record_post_request(user.id, post_id)
 
-        try:
-            cap = json.loads(post["caption"])
-        except Exception:
-            cap = {"title": "بدون عنوان", "description": "", "main_file": {}, "intro_file": {}}
-
-        channels_text = post.get("channels", "")
-        try:
-            channels_parsed = json.loads(channels_text) if channels_text else []
-        except Exception:
-            channels_parsed = []
-            for c in (channels_text or "").splitlines():
-                c = c.strip()
-                if c:
-                    channels_parsed.append({"name": c, "username": c.lstrip('@')})
+        cap, channels_parsed = decode_post(post, untitled="بدون عنوان")
 
         usernames_for_check = [item.get("username", "").lstrip('@') for item in channels_parsed if item.get("username")]
         not_joined = await check_join_status(update.effective_user.id, usernames_for_check, context) if usernames_for_check else []
@@ -510,9 +1330,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         if remaining_channels:
             caption_intro = f"📌 {cap.get('title','بدون عنوان')}\n✨ Please join the channels below first ✨"
-            channel_buttons = [[InlineKeyboardButton(item['name'], url=f"https://t.me/{item['username']}")] for item in remaining_channels]
-            membership_button = [InlineKeyboardButton("✅ Check membership", callback_data=f"continue_get_{post_id}")]
-            kb = InlineKeyboardMarkup(channel_buttons + [membership_button])
+            kb = join_keyboard(remaining_channels, post_id)
             intro = cap.get("intro_file", {})
             if intro.get("file_id") and intro.get("type") == "photo":
                 try:
@@ -528,13 +1346,15 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         main_file = cap.get("main_file", {})
         title = cap.get("title", "بدون عنوان")
         description = cap.get("description", "") or "بدون توضیحات"
-        caption_info = f"📌 عنوان: {title}\n\n📝 توضیحات:\n{description}"
+        caption_info = post_info_caption(title, description)
         chat_id = update.effective_chat.id
 
         if main_file.get("type") == "photo" and main_file.get("file_id"):
             await context.bot.send_photo(chat_id=chat_id, photo=main_file["file_id"], caption=caption_info)
         elif main_file.get("type") == "document" and main_file.get("file_id"):
             await context.bot.send_document(chat_id=chat_id, document=main_file["file_id"], caption=caption_info)
+        elif main_file.get("type") == "album" and main_file.get("items"):
+            await send_album(context.bot, chat_id, main_file["items"], caption_info)
         elif main_file.get("type") == "text" and main_file.get("text"):
             combined = f"📌 {title}\n\n📄 فایل اصلی:\n{main_file['text']}\n\n📝 توضیحات:\n{description}"
             await context.bot.send_message(chat_id=chat_id, text=combined)
@@ -574,6 +1394,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 
+@timed
 async def continue_get_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -586,22 +1407,7 @@ async def continue_get_callback(update: Update, context: ContextTypes.DEFAULT_TY
             pass
         return
 
-    try:
-        cap = json.loads(post["caption"])
-    except Exception:
-        cap = {"title": "Untitled", "description": "", "main_file": {}, "intro_file": {}}
-
-    channels_text = post.get("channels", "") or ""
-    # parse stored channels (supports JSON or simple lines)
-    channels_parsed = []
-    try:
-        channels_parsed = json.loads(channels_text) if channels_text else []
-    except Exception:
-        for ln in channels_text.splitlines():
-            ln = ln.strip()
-            if not ln:
-                continue
-            channels_parsed.append({"name": ln, "username": ln.lstrip('@')})
+    cap, channels_parsed = decode_post(post)
 
     usernames_for_check = [item.get("username", "").lstrip('@') for item in channels_parsed if item.get("username")]
     not_joined = await check_join_status(query.from_user.id, usernames_for_check, context) if usernames_for_check else []
@@ -610,15 +1416,12 @@ async def continue_get_callback(update: Update, context: ContextTypes.DEFAULT_TY
         # User is missing membership in some channels -> inform and show buttons
         remaining_channels = [item for item in channels_parsed if item.get("username", "").lstrip('@') in not_joined]
         caption_new = f"📌 {cap.get('title','Untitled')}\n\n❌ You are not a member of all required channels yet."
-        channel_buttons = [[InlineKeyboardButton(item.get('name') or item.get('username'), url=f"https://t.me/{item.get('username')}")] for item in remaining_channels]
-        membership_button = [InlineKeyboardButton("✅ Check membership", callback_data=f"continue_get_{post_id}")]
-        kb = InlineKeyboardMarkup(channel_buttons + [membership_button])
+        kb = join_keyboard(remaining_channels, post_id)
 
         intro = cap.get("intro_file", {})
         try:
             # prefer editing existing message if possible
             if query.message and intro.get("file_id") and intro.get("type") == "photo":
-                from telegram import InputMediaPhoto
                 await query.message.edit_media(media=InputMediaPhoto(media=intro["file_id"], caption=caption_new))
                 await query.message.edit_reply_markup(reply_markup=kb)
             else:
@@ -652,17 +1455,18 @@ async def continue_get_callback(update: Update, context: ContextTypes.DEFAULT_TY
         else:
             # First send the main file regardless of type (photo/document)
             if main_file.get("type") == "photo" and main_file.get("file_id"):
-                await context.bot.send_photo(chat_id=chat_id, photo=main_file["file_id"], caption=f"📌 عنوان: {title}\n\n📝 توضیحات:\n{description}")
+                await context.bot.send_photo(chat_id=chat_id, photo=main_file["file_id"], caption=post_info_caption(title, description))
             elif main_file.get("type") == "document" and main_file.get("file_id"):
-                await context.bot.send_document(chat_id=chat_id, document=main_file["file_id"], caption=f"📌 عنوان: {title}\n\n📝 توضیحات:\n{description}")
+                await context.bot.send_document(chat_id=chat_id, document=main_file["file_id"], caption=post_info_caption(title, description))
+            elif main_file.get("type") == "album" and main_file.get("items"):
+                await send_album(context.bot, chat_id, main_file["items"], post_info_caption(title, description))
             elif main_file.get("type") == "text" and main_file.get("text"):
                 # fallback (shouldn't reach because handled above)
                 await context.bot.send_message(chat_id=chat_id, text=f"📄 فایل اصلی:\n{main_file['text']}")
-                await asyncio.sleep(0.5)
-                await context.bot.send_message(chat_id=chat_id, text=f"📌 عنوان: {title}\n\n📝 توضیحات:\n{description}")
+                await context.bot.send_message(chat_id=chat_id, text=post_info_caption(title, description))
             else:
                 # اگر هیچ فایلی نبود، فقط عنوان و توضیحات را می‌فرستیم
-                await context.bot.send_message(chat_id=chat_id, text=f"📌 عنوان: {title}\n\n📝 توضیحات:\n{description}")
+                await context.bot.send_message(chat_id=chat_id, text=post_info_caption(title, description))
 
         try:
             await query.edit_message_text("✅ ✨ شما در تمامی کانال‌ها عضو هستید. فایل ارسال شد. ✨")
@@ -678,6 +1482,7 @@ async def continue_get_callback(update: Update, context: ContextTypes.DEFAULT_TY
     return
 
 
+@timed
 async def receive_get_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -689,6 +1494,7 @@ async def receive_get_callback(update: Update, context: ContextTypes.DEFAULT_TYP
         except Exception:
             pass
         return
+    record_post_request(query.from_user.id, post_id)
 
     # Try to delete the message that had the photo + title + button
     try:
@@ -696,19 +1502,7 @@ async def receive_get_callback(update: Update, context: ContextTypes.DEFAULT_TYP
     except Exception:
         logger.exception("Could not delete preview message")
 
-    try:
-        cap = json.loads(post["caption"])
-    except Exception:
-        cap = {"title": "Untitled", "description": "", "main_file": {}, "intro_file": {}}
-    channels_text = post.get("channels", "")
-    try:
-        channels_parsed = json.loads(channels_text) if channels_text else []
-    except Exception:
-        channels_parsed = []
-        for c in (channels_text or "").splitlines():
-            c = c.strip()
-            if c:
-                channels_parsed.append({"name": c, "username": c.lstrip('@')})
+    cap, channels_parsed = decode_post(post)
 
     # build deep link to this post (will survive forwarding)
     bot_user = await context.bot.get_me()
@@ -718,9 +1512,7 @@ async def receive_get_callback(update: Update, context: ContextTypes.DEFAULT_TYP
     # Present intro with channel buttons (user will press Check membership to remove joined channels)
     title = cap.get("title", "Untitled")
     caption_intro = f"📌 {title}\n{deep_link}\nPlease join the channels below first"
-    channel_buttons = [[InlineKeyboardButton(item['name'], url=f"https://t.me/{item['username']}")] for item in channels_parsed]
-    membership_button = [InlineKeyboardButton("✅ Check membership", callback_data=f"continue_get_{post_id}")]
-    kb = InlineKeyboardMarkup(channel_buttons + [membership_button])
+    kb = join_keyboard(channels_parsed, post_id)
 
     intro = cap.get("intro_file", {}) or {}
     main = cap.get("main_file", {}) or {}
@@ -772,7 +1564,7 @@ async def receive_get_callback(update: Update, context: ContextTypes.DEFAULT_TYP
 
 # New post conversation handlers
 async def newpost_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-	logger.info(f"newpost_start triggered by user={update.effective_user.id}")
+	logger.debug("newpost_start triggered by user=%s", update.effective_user.id)
 	# record origin (if started from a keyboard button like "📣 سیگنال رایگان")
 	try:
 		origin_text = update.message.text if update.message and update.message.text else None
@@ -782,30 +1574,57 @@ async def newpost_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 		pass
 
 	await update.message.reply_text(
-		"✨ لطفاً فایل اصلی را ارسال کنید (فایل، عکس یا متن)\nبرای لغو از /cancel استفاده کنید. ✨"
+		"✨ لطفاً فایل اصلی را ارسال کنید (فایل، عکس یا متن)\n"
+		"برای چند فایل، آن‌ها را به‌صورت آلبوم بفرستید و در پایان /done را بزنید.\n"
+		"برای لغو از /cancel استفاده کنید. ✨"
 	)
 	return NP_MAIN
 
 async def newpost_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Receive main file/text"""
+    """Receive main file/text; photos/documents sent as an album are collected until /done"""
     msg = update.message
-    logger.info(f"newpost_main received message from {update.effective_user.id}: has_document={bool(msg.document)} has_photo={bool(msg.photo)} has_text={bool(msg.text)}")
+    logger.debug("newpost_main received message from %s: has_document=%s has_photo=%s has_text=%s", update.effective_user.id, bool(msg.document), bool(msg.photo), bool(msg.text))
+    media = None
     if msg.document:
-        context.user_data["main_file"] = {
-            "file_id": msg.document.file_id,
-            "type": "document"
-        }
+        media = {"file_id": msg.document.file_id, "type": "document"}
     elif msg.photo:
-        context.user_data["main_file"] = {
-            "file_id": msg.photo[-1].file_id,
-            "type": "photo"
-        }
+        media = {"file_id": msg.photo[-1].file_id, "type": "photo"}
+
+    items = context.user_data.get("album_items")
+    if media and (msg.media_group_id or items is not None):
+        if items is None:
+            items = context.user_data["album_items"] = []
+        items.append(media)
+        # Telegram delivers an album as one message per file: answer once per album
+        if msg.media_group_id is None or msg.media_group_id != context.user_data.get("album_group"):
+            context.user_data["album_group"] = msg.media_group_id
+            await update.message.reply_text("📎 فایل‌ها دریافت می‌شوند. فایل‌های بیشتر را بفرستید یا برای ادامه /done را بزنید.")
+        return NP_MAIN
+    if items is not None:
+        await update.message.reply_text("✨ فقط عکس یا فایل به آلبوم اضافه می‌شود. برای ادامه /done را بزنید. ✨")
+        return NP_MAIN
+
+    if media:
+        context.user_data["main_file"] = media
     elif msg.text:
         context.user_data["main_file"] = {
             "text": msg.text,
             "type": "text"
         }
-    
+    return await _ask_newpost_intro(update)
+
+async def newpost_main_done(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/done — finish collecting the files of an album post"""
+    items = context.user_data.pop("album_items", None)
+    context.user_data.pop("album_group", None)
+    if not items:
+        await update.message.reply_text("✨ هنوز فایلی دریافت نشده است. فایل اصلی را ارسال کنید. ✨")
+        return NP_MAIN
+    context.user_data["main_file"] = items[0] if len(items) == 1 else {"type": "album", "items": items}
+    await update.message.reply_text(f"✅ {len(items)} فایل برای فایل اصلی ثبت شد.")
+    return await _ask_newpost_intro(update)
+
+async def _ask_newpost_intro(update):
     await update.message.reply_text(
         "✨ حالا فایل معرفی را ارسال کنید (فایل، عکس یا متن)\nاین فایل قبل از دریافت فایل اصلی نمایش داده می‌شود. ✨"
     )
@@ -814,7 +1633,7 @@ async def newpost_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def newpost_intro(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Receive intro file/text"""
     msg = update.message
-    logger.info(f"newpost_intro received message from {update.effective_user.id}: has_document={bool(msg.document)} has_photo={bool(msg.photo)} has_text={bool(msg.text)}")
+    logger.debug("newpost_intro received message from %s: has_document=%s has_photo=%s has_text=%s", update.effective_user.id, bool(msg.document), bool(msg.photo), bool(msg.text))
     if msg.document:
         context.user_data["intro_file"] = {
             "file_id": msg.document.file_id,
@@ -836,21 +1655,21 @@ async def newpost_intro(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def newpost_title(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Receive post title"""
-    logger.info(f"newpost_title from {update.effective_user.id}: text={update.message.text}")
+    logger.debug("newpost_title from %s: text_len=%s", update.effective_user.id, len(update.message.text or ""))
     context.user_data["title"] = update.message.text
     await update.message.reply_text("✨ توضیحات پست را وارد کنید: ✨")
     return NP_DESC
 
 async def newpost_desc(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Receive post description"""
-    logger.info(f"newpost_desc from {update.effective_user.id}: text_len={len(update.message.text) if update.message.text else 0}")
+    logger.debug("newpost_desc from %s: text_len=%s", update.effective_user.id, len(update.message.text) if update.message.text else 0)
     context.user_data["description"] = update.message.text
     await update.message.reply_text("✨ آیدی کانال‌های اجباری را وارد کنید (هر کدام در یک خط)\nاگر کانال اجباری ندارید، None بنویسید: ✨")
     return NP_CHANNELS
 
 async def newpost_channels(update: Update, context: ContextTypes.DEFAULT_TYPE):
 	"""Receive required channels and save post"""
-	logger.info(f"newpost_channels triggered by {update.effective_user.id}")
+	logger.debug("newpost_channels triggered by %s", update.effective_user.id)
 	text = update.message.text.strip()
 	# Parse channels entered by admin: each line can contain display name and address
 	parsed = parse_channels_text(text) if text.lower() != "none" else []
@@ -864,42 +1683,27 @@ async def newpost_channels(update: Update, context: ContextTypes.DEFAULT_TYPE):
 	# build deep link to bot: https://t.me/<bot_username>?start=get_<post_id>
 	bot_user = await context.bot.get_me()
 	bot_username = getattr(bot_user, "username", None) or ""
-	deep_link = f"https://t.me/{bot_username}?start=get_{post_id}" if bot_username else f"https://t.me/{post_id}"
-	# شکلی از دکمه شیشه‌ای (inline) برای دریافت فایل
-	kb = InlineKeyboardMarkup([[InlineKeyboardButton("📥 Receive", url=deep_link)]])
-	# caption لینک پنهان (HTML)
+	deep_link = post_deep_link(bot_username, post_id)
 	title = context.user_data.get('title','Untitled')
-	# default caption for media/text messages (title + hidden link)
-	caption = f"📌 {title}\n<a href=\"{deep_link}\">📥 Receive</a>"
 
 	# NEW: همیشه فایل معرفی را نمایش بده؛ اگر فایل معرفی متنی بود، متن را بعد از عنوان در همان پیام قرار بده
-	intro = context.user_data.get("intro_file", {})
-
 	try:
-		if intro:
-			# Photo intro
-			if intro.get("type") == "photo" and intro.get("file_id"):
-				await update.message.reply_photo(photo=intro["file_id"], caption=caption, reply_markup=kb, parse_mode="HTML")
-			# Document intro
-			elif intro.get("type") == "document" and intro.get("file_id"):
-				await update.message.reply_document(document=intro["file_id"], caption=caption, reply_markup=kb, parse_mode="HTML")
-			# Text intro -> include title, intro text, then hidden link (all in one message)
-			elif intro.get("type") == "text" and intro.get("text"):
-				full_text = f"📌 {title}\n\n{intro.get('text')}\n\n<a href=\"{deep_link}\">📥 Receive</a>"
-				await update.message.reply_text(full_text, reply_markup=kb, parse_mode="HTML")
-			else:
-				# fallback: send caption text with glass button
-				await update.message.reply_text(caption, reply_markup=kb, parse_mode="HTML")
-		else:
-			# no intro provided -> still show title + hidden link + button
-			await update.message.reply_text(caption, reply_markup=kb, parse_mode="HTML")
+		message = await send_post_preview(context.bot, update.effective_chat.id, post_id, context.user_data, bot_username)
+		record_post_messages([(post_id, message)])
 	except Exception:
 		# final fallback: safe text reply
 		try:
+			kb = InlineKeyboardMarkup([[InlineKeyboardButton("📥 Receive", url=deep_link)]])
 			await update.message.reply_text(f"📌 {title}\n📥 {deep_link}", reply_markup=kb)
 		except Exception:
 			pass
 
+	# publish to the configured channels; one summary instead of a message per channel
+	targets = get_publish_targets()
+	if targets:
+		results = await publish_post_to_targets(context.bot, post_id, targets)
+		await update.message.reply_text(publish_summary(post_id, results))
+
 	# If conversation was started via "📣 سیگنال رایگان", keep origin info and explicitly show preview (already above),
 	# you may extend behavior here (e.g., post to a channel) if needed in future.
 	origin = context.user_data.get("post_origin")
@@ -924,7 +1728,7 @@ async def list_posts(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.username not in ADMINS:
         await update.message.reply_text("❌ ✨ Unauthorized. ✨")
         return
-    conn = sqlite3.connect(DB_PATH)
+    conn = db_connect()
     cur = conn.cursor()
     cur.execute("SELECT id, caption FROM posts ORDER BY id DESC LIMIT 50")
     rows = cur.fetchall()
@@ -944,56 +1748,6 @@ async def list_posts(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Remove the three button keyboard and simply send the message
     await update.message.reply_text(msg)
 
-# ⚙️ انتخاب پست از لیست برای تنظیم سیگنال رایگان
-async def set_signal_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-
-    try:
-        post_id = int(query.data.replace("set_signal_", ""))
-    except Exception:
-        await query.edit_message_text("❌ شناسه پست نامعتبر است.")
-        return
-
-    post = get_post_db(post_id)
-    if not post:
-        await query.edit_message_text("❌ پست مورد نظر یافت نشد.")
-        return
-
-    # ذخیره در تنظیمات
-    set_setting("signal_post_id", post_id)
-    global SIGNAL_POST_ID
-    SIGNAL_POST_ID = post_id
-
-    await query.edit_message_text(f"✅ پست شماره {post_id} به عنوان سیگنال فعال تنظیم شد.")
-
-
-# ⚙️ انتخاب پست به عنوان سیگنال رایگان
-async def set_signal(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Sets a selected post as the active free signal."""
-    if update.effective_user.username not in ADMINS:
-        await update.message.reply_text("❌ فقط ادمین می‌تواند سیگنال تنظیم کند.")
-        return
-
-    text = update.message.text.strip()
-    if not text.isdigit():
-        await update.message.reply_text("❌ لطفاً فقط عدد ID پست را ارسال کنید.")
-        return
-
-    post_id = int(text)
-    post = get_post_db(post_id)
-    if not post:
-        await update.message.reply_text("❌ پست یافت نشد.")
-        return
-
-    # ذخیره در جدول settings
-    set_setting("signal_post_id", post_id)
-    global SIGNAL_POST_ID
-    SIGNAL_POST_ID = post_id
-
-    await update.message.reply_text(f"✅ سیگنال رایگان با شناسه {post_id} تنظیم شد.")
-
-
 async def delete_post(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.username not in ADMINS:
         await update.message.reply_text("❌ ✨ Unauthorized. ✨")
@@ -1009,7 +1763,7 @@ async def delete_post(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     # جلوگیری از حذف سیگنال فعال
-    if SIGNAL_POST_ID and str(post_id) == str(SIGNAL_POST_ID):
+    if is_signal_post(post_id):
         await update.message.reply_text("❌ این پست به عنوان سیگنال رایگان قفل شده و قابل حذف نیست. ابتدا سیگنال جدید ثبت کنید.")
         return
         
@@ -1093,463 +1847,554 @@ async def buy_bot(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if chat_id:
         await context.bot.send_message(chat_id=chat_id, text="To buy a bot, choose an option below 👇", reply_markup=reply_markup)
 
-# ...existing code...
 
-async def menu_callback(update, context):
-    query = update.callback_query
-    if query:
-        await query.answer()
-    data = query.data if query else (update.message.text if update.message else "")
+# ===============================
+# 📈 Free signals (active set and payload cache)
+# ===============================
+# Several posts can be active free signals at once, each with a weight. "📈 Free Signal"
+# answers with one of them, picked at random in proportion to the weights. The message
+# for every active signal (method, caption and keyboard) is rendered once into
+# _signal_cache, so a tap is a memory lookup plus one send. The cache is rebuilt when
+# the set changes (signal_post_ / set_signal_ / /signals / scheduled rotation) or an
+# active signal post is edited.
+_signal_cache = None  # (bot username, cumulative weights, [(post_id, method, kwargs), ...]) or None
 
-    # Ensure chat_id exists immediately (keep this early)
-    chat_id = None
-    try:
-        if update and getattr(update, "effective_chat", None):
-            chat_id = update.effective_chat.id
-    except Exception:
-        chat_id = None
-    if chat_id is None and query and query.message:
-        chat_id = query.message.chat_id
 
-    # NEW: handle inline selection of a signal post (callback_data "signal_post_<id>")
-    if isinstance(data, str) and data.startswith("signal_post_"):
-        try:
-            post_id = int(data.split("signal_post_")[1])
-        except Exception:
-            try:
-                if query and query.message:
-                    await query.edit_message_text("❌ شناسه پست نامعتبر است.")
-            except Exception:
-                pass
-            return
+def is_signal_post(post_id):
+    return any(str(post_id) == str(active) for active, _weight in SIGNAL_POSTS)
 
-        # persist selection
-        try:
-            set_setting("signal_post_id", post_id)
-            global SIGNAL_POST_ID
-            SIGNAL_POST_ID = post_id
-        except Exception:
-            logger.exception("Failed to persist chosen signal post")
 
-        # reply success (prefer editing the inline message)
-        try:
-            if query and query.message:
-                await query.edit_message_text(f"✅ پست شماره {post_id} به عنوان سیگنال فعال تنظیم شد.")
-            elif chat_id:
-                await context.bot.send_message(chat_id=chat_id, text=f"✅ پست شماره {post_id} به عنوان سیگنال فعال تنظیم شد.")
-        except Exception:
-            pass
-        return
+def set_signal_posts(signals):
+    """Replace the active signal set (``[(post_id, weight), ...]``) and persist it."""
+    global SIGNAL_POSTS, SIGNAL_POST_ID
+    SIGNAL_POSTS = [(int(post_id), max(1, int(weight))) for post_id, weight in signals]
+    SIGNAL_POST_ID = SIGNAL_POSTS[0][0] if SIGNAL_POSTS else None
+    set_setting("signal_posts", json.dumps(SIGNAL_POSTS))
+    invalidate_signal_cache()
 
-    if not query and isinstance(data, str):
-        txt = data.strip()
-
-        # تنظیم سیگنال رایگان (map main menu button to admin submenu)
-        if txt in ("⚙️ تنظیم سیگنال رایگان", "تنظیم سیگنال رایگان", "Set Free Signal", "Free Signal"):
-            data = "admin_signal_menu"
-
-        # پذیرش چند واریانت برای دکمه "دیدن سیگنال"
-        elif txt in (
-            "دیدن سیگنال",
-            "👁 دیدن سیگنال",
-            "👁️ دیدن سیگنال",
-            "👁️️ دیدن سیگنال",
-            "View Signal",
-            "See Signal"
-        ):
-            data = "دیدن سیگنال"
-
-        # برگشت به منوی قبلی
-        elif txt in ("🔙 برگشت", "برگشت"):
-            prev = context.user_data.get("prev_menu")
-            if prev == "posts_menu":
-                data = "show_posts_menu"
-            elif prev == "signal_menu":
-                data = "admin_signal_menu"
-            else:
-                data = "back_to_main"
 
-        # آمار ربات (support both with and without emoji)
-        elif txt in ("آمار ربات", "📊 آمار ربات"):
-            await stats_bot(update, context)
-            return
+def activate_signal(post_id):
+    """Make ``post_id`` the only active free signal."""
+    set_signal_posts([(post_id, 1)])
 
-        # ارسال به همه (support both with and without emoji)
-        elif txt in ("ارسال به همه", "📤 ارسال به همه"):
-            kb = InlineKeyboardMarkup([
-                [InlineKeyboardButton("❌ لغو ارسال به همه", callback_data="cancel_broadcast")]
-            ])
-            await update.message.reply_text(
-                "📨 لطفاً پیامی که می‌خواهید برای همه اعضا ارسال شود را بفرستید.",
-                reply_markup=kb
-            )
-            context.user_data["awaiting_broadcast_text"] = True
-            return
 
-        # posts submenu mappings
-        elif txt in ("📚 پست ها", "پست ها"):
-            data = "show_posts_menu"
-            context.user_data["prev_menu"] = "main_menu"
-
-        # ads submenu mappings
-        elif txt in ("📢 تبلیغات", "تبلیغات"):
-            data = "admin_ads_menu"
-            context.user_data["prev_menu"] = "main_menu"
-
-        elif txt in ("ℹ️ اطلاعات و ویرایش", "اطلاعات و ویرایش"):
-            data = "admin_listposts"
-            context.user_data["prev_menu"] = "posts_menu"
-        elif txt in ("📤 پست های ارسالی", "پست های ارسالی"):
-            data = "admin_post_sent"
-            context.user_data["prev_menu"] = "posts_menu"
-        # new: ads submenu mappings
-        elif txt in ("تبلیغات",):
-            data = "admin_ads_menu"
-            context.user_data["prev_menu"] = "main_menu"
-        elif txt in ("آیدی ادمین", "آیدی ادمین تنظیم تبلیغات"):
-            data = "ads_admin_id"
-            context.user_data["prev_menu"] = context.user_data.get("prev_menu", "main_menu")
-        elif txt in ("تنظیم تبلیغات", "تنظیم تبلیغات دکمه"):
-            data = "ads_set"
-            context.user_data["prev_menu"] = "ads_menu"
-        elif txt in ("سفارش ممبر واقعی", "👥 سفارش ممبر واقعی", "👥 Order Real Members", "Order Real Members"):
-            await order_member(update, context)
-            return
-        elif txt in ("تبلیغات رایگان", "🆓 تبلیغات رایگان", "🆓 Free Ads", "Free Ads"):
-            await free_ads(update, context)
-            return
-        elif txt in ("صحبت با پشتیبان", "💬 صحبت با پشتیبان", "Contact Support", "💬 Contact Support"):
-            await contact_support(update, context)
-            return
-    # 🛒 دکمه خرید ربات — پشتیبانی از چند نوع نوشته
-        elif txt in (
-            "خرید این ربات یا ربات دیگر",
-            "🤖 خرید این ربات یا ربات دیگر",
-            "خرید ربات",
-            "🤖 خرید ربات",
-            "Buy this bot",
-            "Buy Bot",
-            "🤖 Buy Bot"
-        ):
-            await buy_bot(update, context)
-            return
+def toggle_signal(post_id):
+    """Add ``post_id`` to the active set (weight 1) or remove it; returns True if it is now active."""
+    if is_signal_post(post_id):
+        set_signal_posts([(active, weight) for active, weight in SIGNAL_POSTS if str(active) != str(post_id)])
+        return False
+    set_signal_posts(SIGNAL_POSTS + [(int(post_id), 1)])
+    return True
 
-        # keep "ثبت سیگنال" and "دیدن سیگنال" as-is (they are checked directly later)
 
-    # Ensure chat_id exists immediately
-    chat_id = None
-    try:
-        if update and getattr(update, "effective_chat", None):
-            chat_id = update.effective_chat.id
-    except Exception:
-        chat_id = None
-    if chat_id is None and query and query.message:
-        chat_id = query.message.chat_id
+def invalidate_signal_cache():
+    global _signal_cache
+    _signal_cache = None
 
 
-    # NEW: explicit handler for "پست های ارسالی" (admin) - active for both callback and plain message
-    if data == "admin_post_sent" or (update.message and update.message.text == "📤 پست های ارسالی"):
-        # only admins
-        user = update.effective_user if update else None
-        if not user or getattr(user, "username", None) not in ADMINS:
-            try:
-                if chat_id:
-                    await context.bot.send_message(chat_id=chat_id, text="❌ فقط ادمین می‌تواند از این منو استفاده کند.")
-            except Exception:
-                pass
-            return
+def signal_payload(post_id, cap, bot_username):
+    """``(method name, kwargs without chat_id)`` of the message "📈 Free Signal" sends for a post."""
+    intro = cap.get("intro_file", {}) or {}
+    caption_html, text_html, kb = preview_content(post_id, cap, bot_username)
+    # intro media -> media with caption (title + hidden link); intro text -> one text message
+    if intro.get("file_id"):
+        if intro.get("type") == "photo":
+            return "send_photo", {"photo": intro["file_id"], "caption": caption_html, "reply_markup": kb, "parse_mode": "HTML"}
+        return "send_document", {"document": intro["file_id"], "caption": caption_html, "reply_markup": kb, "parse_mode": "HTML"}
+    return "send_message", {"text": text_html, "reply_markup": kb, "parse_mode": "HTML"}
+
+
+def signal_cache(bot_username):
+    """The rendered active signals, built on first use after a change."""
+    global _signal_cache
+    if _signal_cache is None or _signal_cache[0] != bot_username:
+        payloads, cumulative, total = [], [], 0
+        for post_id, weight in SIGNAL_POSTS:
+            post = get_post_db(post_id)
+            if not post:
+                continue
+            cap, _channels = decode_post(post, untitled="بدون عنوان")
+            payloads.append((post_id, *signal_payload(post_id, cap, bot_username)))
+            total += weight
+            cumulative.append(total)
+        _signal_cache = (bot_username, cumulative, payloads)
+    return _signal_cache
+
+
+def pick_signal(bot_username):
+    """One active signal's ``(post_id, method, kwargs)`` by weight, or None."""
+    _username, cumulative, payloads = signal_cache(bot_username)
+    if not payloads:
+        return None
+    return payloads[bisect_left(cumulative, random.random() * cumulative[-1])]
+
+
+def signal_selection_markup():
+    """Recent posts as signal_post_<id> toggle buttons; active signals are marked ✅."""
+    conn = db_connect()
+    rows = conn.execute("SELECT id, caption FROM posts ORDER BY id DESC LIMIT 50").fetchall()
+    conn.close()
+    if not rows:
+        return None
+    kb_rows = []
+    for pid, caption in rows:
+        cap, _channels = decode_post({"caption": caption}, untitled="")
+        title = (cap.get("title") or "").strip() or "بدون عنوان"
+        mark = "✅ " if is_signal_post(pid) else ""
+        kb_rows.append([InlineKeyboardButton(f"{mark}{title} — #{pid}", callback_data=f"signal_post_{pid}")])
+    kb_rows.append([InlineKeyboardButton("❌ انصراف", callback_data="cancel_signal_0")])
+    return InlineKeyboardMarkup(kb_rows)
+
+
+SIGNALS_USAGE = (
+    "📈 سیگنال‌های رایگان فعال:\n{listing}\n\n"
+    "/signals 12 15:3 20 — تنظیم مجموعه (شناسه پست، با «:وزن» اختیاری؛ پیش‌فرض ۱)\n"
+    "/signals off — غیرفعال کردن همه"
+)
 
-        try:
-            # get bot username for deep links
-            bot_user = await context.bot.get_me()
-            bot_username = getattr(bot_user, "username", "") or ""
-
-            conn = sqlite3.connect(DB_PATH)
-            cur = conn.cursor()
-            cur.execute("SELECT id, caption FROM posts ORDER BY id DESC")
-            rows = cur.fetchall()
-            conn.close()
 
-            if not rows:
-                try:
-                    await context.bot.send_message(chat_id=chat_id, text="✨ هیچ پستی یافت نشد.")
-                except Exception:
-                    pass
+async def signals_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/signals [<id>[:<weight>] ... | off] — show or set the active free signals (admins only)."""
+    if not (update.effective_user and update.effective_user.username in ADMINS):
+        await update.message.reply_text("❌ ✨ Unauthorized. ✨")
+        return
+    args = context.args or []
+    if args == ["off"]:
+        set_signal_posts([])
+    elif args:
+        signals = []
+        for arg in args:
+            match = re.fullmatch(r"(\d+)(?::(\d+))?", arg)
+            if not match:
+                await update.message.reply_text(f"❌ مقدار نامعتبر: {arg}")
                 return
+            post_id, weight = int(match.group(1)), int(match.group(2) or 1)
+            if not get_post_db(post_id):
+                await update.message.reply_text(f"❌ پست {post_id} یافت نشد.")
+                return
+            signals.append((post_id, weight))
+        set_signal_posts(signals)
+    total = sum(weight for _post_id, weight in SIGNAL_POSTS)
+    listing = "\n".join(f"• #{post_id} — وزن {weight} ({weight / total:.0%})" for post_id, weight in SIGNAL_POSTS) or "— ندارد"
+    await update.message.reply_text(SIGNALS_USAGE.format(listing=listing))
 
-            for row in rows:
-                post_id = row[0]
-                try:
-                    cap = json.loads(row[1]) if row[1] else {}
-                except Exception:
-                    cap = {"title": "بدون عنوان", "intro_file": {}, "main_file": {}}
-
-                title = cap.get("title", "بدون عنوان")
-                intro = cap.get("intro_file", {}) or {}
-                main = cap.get("main_file", {}) or {}
-
-                # ساخت لینک دریافت فایل + دکمه شیشه‌ای
-                deep_link = f"https://t.me/{bot_username}?start=get_{post_id}" if bot_username else f"https://t.me/{post_id}"
-                kb = InlineKeyboardMarkup([[InlineKeyboardButton("📥 Receive", url=deep_link)]])
-                caption_html = f"📌 {title}\n\n<a href=\"{deep_link}\">📥 Receive</a>"
-
-                try:
-                    # اگر intro وجود دارد و عکس/فایل است -> ارسال با کپشن شامل عنوان+لینک
-                    if intro.get("file_id"):
-                        if intro.get("type") == "photo":
-                            await context.bot.send_photo(chat_id=chat_id, photo=intro["file_id"], caption=caption_html, reply_markup=kb, parse_mode="HTML")
-                        else:
-                            await context.bot.send_document(chat_id=chat_id, document=intro["file_id"], caption=caption_html, reply_markup=kb, parse_mode="HTML")
-                    # اگر intro از نوع متن بود -> یک پیام شامل عنوان + متن معرفی + لینک پنهان
-                    elif intro.get("type") == "text" and intro.get("text"):
-                        full_text = f"📌 {title}\n\n{intro.get('text')}\n\n<a href=\"{deep_link}\">📥 Receive</a>"
-                        await context.bot.send_message(chat_id=chat_id, text=full_text, reply_markup=kb, parse_mode="HTML")
-                    # اگر intro وجود ندارد ولی فایل اصلی هست -> از فایل اصلی استفاده کن (با کپشن)
-                    elif main.get("file_id"):
-                        if main.get("type") == "photo":
-                            await context.bot.send_photo(chat_id=chat_id, photo=main["file_id"], caption=caption_html, reply_markup=kb, parse_mode="HTML")
-                        else:
-                            await context.bot.send_document(chat_id=chat_id, document=main["file_id"], caption=caption_html, reply_markup=kb, parse_mode="HTML")
-                    # در غیر این صورت فقط عنوان + لینک را به‌صورت متن ارسال کن
-                    else:
-                        await context.bot.send_message(chat_id=chat_id, text=caption_html, reply_markup=kb, parse_mode="HTML")
-                except Exception:
-                    logger.exception(f"Error sending post {post_id}")
-                    continue
 
-        except Exception as e:
-            logger.exception("Error in admin_post_sent handler")
-            try:
-                await context.bot.send_message(chat_id=chat_id, text=f"❌ خطا در نمایش پست‌ها: {str(e)}")
-            except Exception:
-                pass
-        return
+# ===============================
+# 🧭 Menu routing
+# ===============================
+class MenuRouter:
+    """Routes menu button texts and callback data to their handlers.
+
+    Exact keys (menu texts, their aliases and callback ids) are looked up in a dict.
+    Callback data carrying an argument (``edit_post_<id>``, ``confirm_delete_<id>:<msg>``, ...)
+    is matched by prefix: registered prefixes are bucketed by their first ``_key_len``
+    characters (the length of the shortest prefix), so a lookup is one slice and one dict
+    lookup, then a comparison with the few prefixes in the bucket, longest first.
+    Handlers for pending input (``awaiting_support_id``, ...) run for plain messages that
+    match no route, in registration order.
+
+    Handlers are called as ``handler(update, context, chat_id, arg)`` where ``arg`` is the
+    matched text for exact routes and the remainder after the prefix for prefix routes.
+    """
 
-       # NEW: Ads admin submenu and actions
-    if data == "admin_ads_menu" or (
-        update.message and update.message.text in ("📢 تبلیغات", "تبلیغات")
-    ):
-        user = update.effective_user if update else None
-        if not user or getattr(user, "username", None) not in ADMINS:
-            try:
-                if chat_id:
-                    await context.bot.send_message(chat_id=chat_id, text="❌ فقط ادمین می‌تواند از این منو استفاده کند.")
-            except Exception:
-                pass
-            return
-        kb = ReplyKeyboardMarkup(
-            [
-                ["👤 آیدی پشتیبان", "⚙️ تنظیم تبلیغات"],
-                ["🔙 برگشت"]
-            ],
-            resize_keyboard=True
-        )
-        context.user_data["prev_menu"] = "ads_menu"
+    def __init__(self):
+        self._exact = {}
+        self._prefix_routes = {}  # prefix -> handler
+        self._buckets = {}  # prefix[:_key_len] -> [(prefix, len(prefix), handler), ...], longest first
+        self._key_len = 0
+        self._pending = []
+
+    def exact(self, *keys):
+        def register(handler):
+            for key in keys:
+                self._exact[key] = handler
+            return handler
+        return register
+
+    def prefix(self, *prefixes):
+        def register(handler):
+            for pfx in prefixes:
+                self._prefix_routes[pfx] = handler
+            self._key_len = min(map(len, self._prefix_routes))
+            self._buckets = {}
+            for pfx in sorted(self._prefix_routes, key=len, reverse=True):
+                self._buckets.setdefault(pfx[:self._key_len], []).append((pfx, len(pfx), self._prefix_routes[pfx]))
+            return handler
+        return register
+
+    def pending(self, flag):
+        """Register a handler for the next plain message while ``context.user_data[flag]`` is set."""
+        def register(handler):
+            self._pending.append((flag, handler))
+            return handler
+        return register
+
+    def resolve(self, data, allow_prefix=True):
+        """Return ``(handler, arg)`` for ``data`` or ``(None, None)``."""
+        handler = self._exact.get(data)
+        if handler is not None:
+            return handler, data
+        if not allow_prefix:
+            return None, None
+        bucket = self._buckets.get(data[:self._key_len])
+        if bucket is not None:
+            for pfx, size, handler in bucket:
+                if data[:size] == pfx:
+                    return handler, data[size:]
+        return None, None
+
+    def resolve_pending(self, user_data):
+        for flag, handler in self._pending:
+            if user_data.get(flag):
+                return handler
+        return None
+
+
+menu_routes = MenuRouter()
+
+
+def _plain(handler):
+    """Adapt an ``(update, context)`` handler to the router's calling convention."""
+    async def routed(update, context, chat_id, arg):
+        await handler(update, context)
+    return routed
+
+
+@menu_routes.prefix("signal_post_")
+async def choose_signal_post(update, context, chat_id, arg):
+    """Inline selection of a signal post (callback_data "signal_post_<id>")."""
+    query = update.callback_query
+    try:
+        post_id = int(arg)
+    except Exception:
         try:
-            await context.bot.send_message(chat_id=chat_id, text="📢 منوی تبلیغات: یکی از گزینه‌ها را انتخاب کنید.", reply_markup=kb)
+            if query and query.message:
+                await query.edit_message_text("❌ شناسه پست نامعتبر است.")
         except Exception:
             pass
         return
 
-    if data in ("آیدی پشتیبان", "👤 آیدی پشتیبان"):
-        kb = ReplyKeyboardMarkup(
-            [
-                ["✏️ تنظیم آیدی پشتیبان", "👁️ دیدن آیدی پشتیبان"],
-                ["🔙 برگشت"]
-            ],
-            resize_keyboard=True
-        )
-        context.user_data["prev_menu"] = "support_menu"
-        await context.bot.send_message(chat_id=chat_id, text="👤 مدیریت آیدی پشتیبان:", reply_markup=kb)
+    # persist selection: each tap adds the post to the active signals or removes it
+    try:
+        active = toggle_signal(post_id)
+    except Exception:
+        logger.exception("Failed to persist chosen signal post")
         return
+    status = (f"✅ پست شماره {post_id} به سیگنال‌های فعال اضافه شد." if active
+              else f"➖ پست شماره {post_id} از سیگنال‌های فعال حذف شد.")
 
-    # Handle setting new support admin ID
-    elif data in ("تنظیم آیدی پشتیبان", "✏️ تنظیم آیدی پشتیبان"):
-        try:
-            user = update.effective_user if update else None
-            if not user or getattr(user, "username", None) not in ADMINS:
-                if chat_id:
-                    await context.bot.send_message(chat_id=chat_id, text="❌ فقط ادمین می‌تواند آیدی پشتیبان را تنظیم کند.")
-                return
-            context.user_data["awaiting_support_id"] = True
+    # reply success (prefer editing the inline message, keeping the list for more choices)
+    try:
+        if query and query.message:
+            await query.edit_message_text(f"{status}\n\n📌 برای افزودن/حذف سیگنال، پست‌ها را انتخاب کنید:",
+                                          reply_markup=signal_selection_markup())
+        elif chat_id:
+            await context.bot.send_message(chat_id=chat_id, text=status)
+    except Exception:
+        pass
+    return
 
-            # add an inline "cancel" button so admin can cancel without sending text
-            kb_inline = InlineKeyboardMarkup([
-                [InlineKeyboardButton("❌ لغو تنظیم آیدی پشتیبان", callback_data="cancel_support_id")]
-            ])
 
-            await context.bot.send_message(chat_id=chat_id, text="✍️ لطفاً آیدی پشتیبان (مثلاً @username) را ارسال کنید یا برای لغو، دکمه ❌ را بزنید.", reply_markup=kb_inline)
-        except Exception:
-            pass
-        return
+@menu_routes.exact("admin_signal_menu", "⚙️ تنظیم سیگنال رایگان", "تنظیم سیگنال رایگان", "Set Free Signal", "Free Signal")
+async def show_signal_menu(update, context, chat_id, arg):
+    """Admin: signal settings submenu (ثبت سیگنال / دیدن سیگنال / برگشت)."""
+    kb = ReplyKeyboardMarkup(
+        [
+            ["📝 ثبت سیگنال", "👁️ دیدن سیگنال"],  # use emojis here
+            ["🔙 برگشت"]
+        ],
+        resize_keyboard=True
+    )
+    context.user_data["prev_menu"] = "main_menu"
+    try:
+        await context.bot.send_message(chat_id=chat_id, text="⚙️ تنظیم سیگنال رایگان: یکی از گزینه‌ها را انتخاب کنید.", reply_markup=kb)
+    except Exception:
+        pass
+    return
 
-    # Handle canceling support ID setting
-    elif data in ("❌ لغو تنظیم آیدی پشتیبان", "لغو تنظیم آیدی پشتیبان"):
-        await cancel_support_id(update, context)
-        return
 
-    # Handle showing current support admin ID
-    elif data in ("دیدن آیدی پشتیبان", "👁️ دیدن آیدی پشتیبان"):
-        try:
-            support = get_setting("support_id", None)
-            if not support:
-                await context.bot.send_message(chat_id=chat_id, text="⚠️ هنوز آیدی پشتیبان تنظیم نشده است.")
-            else:
-                display = f"@{support}" if not support.startswith("@") and not support.isdigit() else support
-                await context.bot.send_message(chat_id=chat_id, text=f"🔹 آیدی پشتیبان فعلی: {display}")
-        except Exception:
-            pass
-        return
+@menu_routes.exact("show_posts_menu", "📚 پست ها", "پست ها")
+async def show_posts_menu(update, context, chat_id, arg):
+    """Admin: posts submenu (پست های ارسالی / اطلاعات و ویرایش / برگشت)."""
+    kb = ReplyKeyboardMarkup(
+        [
+            ["📤 پست های ارسالی", "ℹ️ اطلاعات و ویرایش"],
+            ["🔙 برگشت"]
+        ],
+        resize_keyboard=True
+    )
+    context.user_data["prev_menu"] = "main_menu"
+    try:
+        await context.bot.send_message(chat_id=chat_id, text="📚 منوی پست‌ها: یکی از گزینه‌ها را انتخاب کنید.", reply_markup=kb)
+    except Exception:
+        pass
+    return
+
+
+@menu_routes.exact("back_to_main")
+async def back_to_main(update, context, chat_id, arg):
+    """Return the full admin main keyboard (same as in /start for admins)."""
+    kb = ReplyKeyboardMarkup(
+        [
+            ["🆕 پست جدید", "📚 پست ها"],
+            ["📢 تبلیغات", "⚙️ تنظیم سیگنال رایگان"],
+            ["📊 آمار ربات", "📤 ارسال به همه"]
+        ],
+        resize_keyboard=True
+    )
+    context.user_data.pop("prev_menu", None) # پاک کردن منوی قبلی
+    await context.bot.send_message(chat_id=chat_id, text="✨ 📋 منوی اصلی: ✨", reply_markup=kb)
+    return
+
+
+@menu_routes.exact("🔙 برگشت", "برگشت")
+async def menu_back(update, context, chat_id, arg):
+    """برگشت به منوی قبلی"""
+    prev = context.user_data.get("prev_menu")
+    if prev == "posts_menu":
+        await show_posts_menu(update, context, chat_id, arg)
+    elif prev == "signal_menu":
+        await show_signal_menu(update, context, chat_id, arg)
+    else:
+        await back_to_main(update, context, chat_id, arg)
+
+
+menu_routes.exact("آمار ربات", "📊 آمار ربات")(_plain(stats_bot))
+menu_routes.exact("سفارش ممبر واقعی", "👥 سفارش ممبر واقعی", "👥 Order Real Members", "Order Real Members")(_plain(order_member))
+menu_routes.exact("تبلیغات رایگان", "🆓 تبلیغات رایگان", "🆓 Free Ads", "Free Ads")(_plain(free_ads))
+menu_routes.exact("صحبت با پشتیبان", "💬 صحبت با پشتیبان", "Contact Support", "💬 Contact Support")(_plain(contact_support))
+# 🛒 دکمه خرید ربات — پشتیبانی از چند نوع نوشته
+menu_routes.exact(
+    "خرید این ربات یا ربات دیگر",
+    "🤖 خرید این ربات یا ربات دیگر",
+    "خرید ربات",
+    "🤖 خرید ربات",
+    "Buy this bot",
+    "Buy Bot",
+    "🤖 Buy Bot",
+)(_plain(buy_bot))
+
+
+@menu_routes.exact("ارسال به همه", "📤 ارسال به همه")
+async def broadcast_prompt(update, context, chat_id, arg):
+    """ارسال به همه: ask the admin for the broadcast message."""
+    kb = InlineKeyboardMarkup([
+        [InlineKeyboardButton("❌ لغو ارسال به همه", callback_data="cancel_broadcast")]
+    ])
+    await update.message.reply_text(
+        f"📨 لطفاً پیامی که می‌خواهید برای همه اعضا ارسال شود را بفرستید.\n{TEMPLATE_HELP}",
+        reply_markup=kb
+    )
+    context.user_data["awaiting_broadcast_text"] = True
+
 
+@menu_routes.exact("cancel_broadcast")
+async def cancel_broadcast(update, context, chat_id, arg):
+    """لغو ارسال به همه"""
+    context.user_data.pop("awaiting_broadcast_text", None)
+    await context.bot.send_message(chat_id=chat_id, text="❌ ارسال به همه لغو شد.")
+    return
 
-    # If admin just sent support id (we use awaiting_support_id flag), save it
 
-    if update.message and context.user_data.get("awaiting_support_id") and update.message.text:
+@menu_routes.exact("admin_post_sent", "📤 پست های ارسالی", "پست های ارسالی")
+async def admin_post_sent(update, context, chat_id, arg):
+    """Admin: "پست های ارسالی" — preview every post with its Receive deep link."""
+    context.user_data["prev_menu"] = "posts_menu"
+    # only admins
+    user = update.effective_user if update else None
+    if not user or getattr(user, "username", None) not in ADMINS:
         try:
-            user = update.effective_user if update else None
-            if not user or getattr(user, "username", None) not in ADMINS:
-                return
-            val = update.message.text.strip()
-            stored = val.lstrip('@')
-            set_setting("support_id", stored)
-            context.user_data.pop("awaiting_support_id", None)
-            await context.bot.send_message(chat_id=chat_id, text=f"✅ آیدی پشتیبان ذخیره شد: @{stored}")
+            if chat_id:
+                await context.bot.send_message(chat_id=chat_id, text="❌ فقط ادمین می‌تواند از این منو استفاده کند.")
         except Exception:
-            logger.exception("Failed to save support id")
+            pass
         return
 
-    # ✅ اگر ادمین متنی فرستاد و در حالت ارسال به همه است
-    if update.message and context.user_data.get("awaiting_broadcast_text"):
-        text = update.message.text
-        context.user_data.pop("awaiting_broadcast_text", None)
-        context.user_data["broadcast_message"] = update.message
+    try:
+        # get bot username for deep links
+        bot_user = await context.bot.get_me()
+        bot_username = getattr(bot_user, "username", "") or ""
 
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("✅ بله، ارسال کن", callback_data="broadcast_confirm"),
-             InlineKeyboardButton("❌ خیر، لغو شود", callback_data="broadcast_cancel")]
-        ])
-        await update.message.reply_text(
-            f"آیا مطمئن هستید که این پیام برای همه ارسال شود؟\n\n{text}",
-            reply_markup=kb
-        )
-        return
+        conn = db_connect()
+        cur = conn.cursor()
+        cur.execute("SELECT id, caption FROM posts ORDER BY id DESC")
+        rows = cur.fetchall()
+        conn.close()
 
+        if not rows:
+            try:
+                await context.bot.send_message(chat_id=chat_id, text="✨ هیچ پستی یافت نشد.")
+            except Exception:
+                pass
+            return
 
-    # Admin: show signal settings submenu (ثبت سیگنال / دیدن سیگنال / برگشت)
-    # Admin: show posts submenu (پست های ارسالی / اطلاعات و ویرایش / برگشت)
-    if data == "show_posts_menu":
-        kb = ReplyKeyboardMarkup(
-            [
-                ["📤 پست های ارسالی", "ℹ️ اطلاعات و ویرایش"],
-                ["🔙 برگشت"]
-            ],
-            resize_keyboard=True
-        )
-        context.user_data["prev_menu"] = "main_menu"
+        sent = []
+        for row in rows:
+            post_id = row[0]
+            try:
+                cap = json.loads(row[1]) if row[1] else {}
+            except Exception:
+                cap = {"title": "بدون عنوان", "intro_file": {}, "main_file": {}}
+
+            try:
+                sent.append((post_id, await send_post_preview(context.bot, chat_id, post_id, cap, bot_username)))
+            except Exception:
+                logger.exception("Error sending post %s", post_id)
+                continue
+        record_post_messages(sent)
+
+    except Exception as e:
+        logger.exception("Error in admin_post_sent handler")
         try:
-            await context.bot.send_message(chat_id=chat_id, text="📚 منوی پست‌ها: یکی از گزینه‌ها را انتخاب کنید.", reply_markup=kb)
+            await context.bot.send_message(chat_id=chat_id, text=f"❌ خطا در نمایش پست‌ها: {str(e)}")
         except Exception:
             pass
-        return
+    return
 
-    if data == "admin_signal_menu":
-        kb = ReplyKeyboardMarkup(
-            [
-                ["📝 ثبت سیگنال", "👁️ دیدن سیگنال"],  # use emojis here
-                ["🔙 برگشت"]
-            ],
-            resize_keyboard=True
-        )
-        context.user_data["prev_menu"] = "main_menu"
+
+@menu_routes.exact("admin_ads_menu", "📢 تبلیغات", "تبلیغات")
+async def admin_ads_menu(update, context, chat_id, arg):
+    """Admin: ads submenu."""
+    context.user_data["prev_menu"] = "main_menu"
+    user = update.effective_user if update else None
+    if not user or getattr(user, "username", None) not in ADMINS:
         try:
-            await context.bot.send_message(chat_id=chat_id, text="⚙️ تنظیم سیگنال رایگان: یکی از گزینه‌ها را انتخاب کنید.", reply_markup=kb)
+            if chat_id:
+                await context.bot.send_message(chat_id=chat_id, text="❌ فقط ادمین می‌تواند از این منو استفاده کند.")
         except Exception:
             pass
         return
+    kb = ReplyKeyboardMarkup(
+        [
+            ["👤 آیدی پشتیبان", "⚙️ تنظیم تبلیغات"],
+            ["🔙 برگشت"]
+        ],
+        resize_keyboard=True
+    )
+    context.user_data["prev_menu"] = "ads_menu"
+    try:
+        await context.bot.send_message(chat_id=chat_id, text="📢 منوی تبلیغات: یکی از گزینه‌ها را انتخاب کنید.", reply_markup=kb)
+    except Exception:
+        pass
+    return
 
-    if data == "back_to_main":
-        # return the full admin main keyboard (same as in /start for admins)
-        kb = ReplyKeyboardMarkup(
-            [
-                ["🆕 پست جدید", "📚 پست ها"],
-                ["📢 تبلیغات", "⚙️ تنظیم سیگنال رایگان"],
-                ["📊 آمار ربات", "📤 ارسال به همه"]
-            ],
-            resize_keyboard=True
-        )
-        context.user_data.pop("prev_menu", None) # پاک کردن منوی قبلی
-        await context.bot.send_message(chat_id=chat_id, text="✨ 📋 منوی اصلی: ✨", reply_markup=kb)
-        return
 
-    # Admin: start registering a signal (expects admin to forward a message containing get_<id>)
-    if data in ("ثبت سیگنال", "📝 ثبت سیگنال"):
-        try:
-            user = update.effective_user
-            if not user or getattr(user, "username", None) not in ADMINS:
-                await context.bot.send_message(chat_id=chat_id, text="❌ فقط ادمین می‌تواند سیگنال را ثبت کند.")
-                return
+@menu_routes.exact("آیدی پشتیبان", "👤 آیدی پشتیبان")
+async def support_menu(update, context, chat_id, arg):
+    """مدیریت آیدی پشتیبان"""
+    kb = ReplyKeyboardMarkup(
+        [
+            ["✏️ تنظیم آیدی پشتیبان", "👁️ دیدن آیدی پشتیبان"],
+            ["🔙 برگشت"]
+        ],
+        resize_keyboard=True
+    )
+    context.user_data["prev_menu"] = "support_menu"
+    await context.bot.send_message(chat_id=chat_id, text="👤 مدیریت آیدی پشتیبان:", reply_markup=kb)
+    return
 
-            # fetch recent posts from DB
-            try:
-                conn = sqlite3.connect(DB_PATH)
-                cur = conn.cursor()
-                cur.execute("SELECT id, caption FROM posts ORDER BY id DESC LIMIT 50")
-                rows = cur.fetchall()
-                conn.close()
-            except Exception:
-                rows = []
 
-            if not rows:
-                await context.bot.send_message(chat_id=chat_id, text="⚠️ هیچ پستی یافت نشد تا به عنوان سیگنال انتخاب شود.")
-                return
+@menu_routes.exact("تنظیم آیدی پشتیبان", "✏️ تنظیم آیدی پشتیبان")
+async def ask_support_id(update, context, chat_id, arg):
+    """Start setting a new support admin ID."""
+    try:
+        user = update.effective_user if update else None
+        if not user or getattr(user, "username", None) not in ADMINS:
+            if chat_id:
+                await context.bot.send_message(chat_id=chat_id, text="❌ فقط ادمین می‌تواند آیدی پشتیبان را تنظیم کند.")
+            return
+        context.user_data["awaiting_support_id"] = True
 
-            # build inline keyboard: one button per post with title — #id
-            kb_rows = []
-            for r in rows:
-                pid = r[0]
-                try:
-                    meta = json.loads(r[1]) if r[1] else {}
-                    title = (meta.get("title") or "").strip() or "بدون عنوان"
-                except Exception:
-                    title = "بدون عنوان"
-                label = f"{title} — #{pid}"
-                kb_rows.append([InlineKeyboardButton(label, callback_data=f"signal_post_{pid}")])
-
-            # add a cancel button row
-            kb_rows.append([InlineKeyboardButton("❌ انصراف", callback_data=f"cancel_signal_0")])
-            kb = InlineKeyboardMarkup(kb_rows)
-            await context.bot.send_message(chat_id=chat_id, text="📌 برای ثبت سیگنال، یکی از پست‌ها را انتخاب کنید:", reply_markup=kb)
-        except Exception:
-            logger.exception("Error showing posts for signal registration")
-        return
+        # add an inline "cancel" button so admin can cancel without sending text
+        kb_inline = InlineKeyboardMarkup([
+            [InlineKeyboardButton("❌ لغو تنظیم آیدی پشتیبان", callback_data="cancel_support_id")]
+        ])
 
-    # Admin: show current signal
-    if data == "دیدن سیگنال":
-        try:
-            if not SIGNAL_POST_ID:
-                await context.bot.send_message(chat_id=chat_id, text="⚠️ هنوز سیگنال رایگانی تنظیم نشده است.")
-                return
+        await context.bot.send_message(chat_id=chat_id, text="✍️ لطفاً آیدی پشتیبان (مثلاً @username) را ارسال کنید یا برای لغو، دکمه ❌ را بزنید.", reply_markup=kb_inline)
+    except Exception:
+        pass
+    return
+
+
+
+@menu_routes.exact("دیدن آیدی پشتیبان", "👁️ دیدن آیدی پشتیبان")
+async def show_support_id(update, context, chat_id, arg):
+    """Show the current support admin ID."""
+    try:
+        support = get_setting("support_id", None)
+        if not support:
+            await context.bot.send_message(chat_id=chat_id, text="⚠️ هنوز آیدی پشتیبان تنظیم نشده است.")
+        else:
+            display = f"@{support}" if not support.startswith("@") and not support.isdigit() else support
+            await context.bot.send_message(chat_id=chat_id, text=f"🔹 آیدی پشتیبان فعلی: {display}")
+    except Exception:
+        pass
+    return
+
+
+@menu_routes.exact("ثبت سیگنال", "📝 ثبت سیگنال")
+async def register_signal_menu(update, context, chat_id, arg):
+    """Admin: list recent posts to choose the free signal from."""
+    try:
+        user = update.effective_user
+        if not user or getattr(user, "username", None) not in ADMINS:
+            await context.bot.send_message(chat_id=chat_id, text="❌ فقط ادمین می‌تواند سیگنال را ثبت کند.")
+            return
+
+        # inline keyboard: one toggle button per recent post (title — #id), active ones marked
+        kb = signal_selection_markup()
+        if kb is None:
+            await context.bot.send_message(chat_id=chat_id, text="⚠️ هیچ پستی یافت نشد تا به عنوان سیگنال انتخاب شود.")
+            return
+        await context.bot.send_message(chat_id=chat_id, text="📌 برای افزودن/حذف سیگنال، پست‌ها را انتخاب کنید:", reply_markup=kb)
+    except Exception:
+        logger.exception("Error showing posts for signal registration")
+    return
+
+
+@menu_routes.prefix("cancel_signal_")
+async def cancel_signal_selection(update, context, chat_id, arg):
+    """انصراف from the signal selection list: remove the list message."""
+    try:
+        await update.callback_query.message.delete()
+    except Exception:
+        pass
+
+
+@menu_routes.exact("dummy")
+async def ignore_callback(update, context, chat_id, arg):
+    """Label-only buttons (e.g. the delete confirmation header) do nothing."""
+    return
+
+
+@menu_routes.exact("دیدن سیگنال", "👁 دیدن سیگنال", "👁️ دیدن سیگنال", "👁️️ دیدن سیگنال", "View Signal", "See Signal")
+async def view_signal(update, context, chat_id, arg):
+    """Admin: show the active signals."""
+    try:
+        if not SIGNAL_POSTS:
+            await context.bot.send_message(chat_id=chat_id, text="⚠️ هنوز سیگنال رایگانی تنظیم نشده است.")
+            return
 
+        total = sum(weight for _post_id, weight in SIGNAL_POSTS)
+        for post_id, weight in SIGNAL_POSTS:
             # load signal post from DB
-            post = get_post_db(SIGNAL_POST_ID)
+            post = get_post_db(post_id)
             if not post:
-                await context.bot.send_message(chat_id=chat_id, text="⚠️ پست سیگنال پیدا نشد.")
-                return
-
-            try:
-                cap = json.loads(post.get("caption") or "{}")
-            except Exception:
-                cap = {}
+                await context.bot.send_message(chat_id=chat_id, text=f"⚠️ پست سیگنال #{post_id} پیدا نشد.")
+                continue
 
+            cap, _channels = decode_post(post, untitled="بدون عنوان")
             title = cap.get("title", "بدون عنوان")
             desc = cap.get("description", "") or ""
-            intro = cap.get("intro_file", {})
+            intro = cap.get("intro_file", {}) or {}
+            main = cap.get("main_file", {}) or {}
+            if main.get("type") == "album" and main.get("items"):
+                main = main["items"][0]
 
-            # build caption text to show: include post id, title and description
+            # build caption text to show: include post id, weight, title and description
+            send_caption = f"📌 سیگنال رایگان — #{post_id} (وزن {weight}، {weight / total:.0%})\n\n<b>{title}</b>"
             if desc:
-                send_caption = f"📌 سیگنال رایگان — #{SIGNAL_POST_ID}\n\n<b>{title}</b>\n\n{desc}"
-            else:
-                send_caption = f"📌 سیگنال رایگان — #{SIGNAL_POST_ID}\n\n<b>{title}</b>"
+                send_caption += f"\n\n{desc}"
 
             # prefer sending intro file (photo/document/text), fallback to main file, else plain text
             try:
@@ -1560,15 +2405,14 @@ async def menu_callback(update, context):
                         await context.bot.send_document(chat_id=chat_id, document=intro["file_id"], caption=send_caption, parse_mode="HTML")
                 elif intro.get("text"):
                     await context.bot.send_message(chat_id=chat_id, text=f"{send_caption}\n\n{intro.get('text')}", parse_mode="HTML")
-                else:
+                elif main.get("file_id"):
                     # no intro -> try main file
-                    if main.get("file_id"):
-                        if main.get("type") == "photo":
-                            await context.bot.send_photo(chat_id=chat_id, photo=main["file_id"], caption=send_caption, parse_mode="HTML")
-                        else:
-                            await context.bot.send_document(chat_id=chat_id, document=main["file_id"], caption=send_caption, parse_mode="HTML")
+                    if main.get("type") == "photo":
+                        await context.bot.send_photo(chat_id=chat_id, photo=main["file_id"], caption=send_caption, parse_mode="HTML")
                     else:
-                        await context.bot.send_message(chat_id=chat_id, text=send_caption, parse_mode="HTML")
+                        await context.bot.send_document(chat_id=chat_id, document=main["file_id"], caption=send_caption, parse_mode="HTML")
+                else:
+                    await context.bot.send_message(chat_id=chat_id, text=send_caption, parse_mode="HTML")
             except Exception:
                 # final fallback: send plain text
                 try:
@@ -1576,562 +2420,473 @@ async def menu_callback(update, context):
                 except Exception:
                     pass
 
-        except Exception:
-            logger.exception("Error while handling 'دیدن سیگنال'")
-        return
+    except Exception:
+        logger.exception("Error while handling 'دیدن سیگنال'")
+    return
 
-    # Handle "سیگنال رایگان" button
-    if (data and data == "📈 سیگنال رایگان") or (update.message and update.message.text in ("📈 سیگنال رایگان", "📈 Free Signal", "Free Signal")):
-        # show only: intro (media or text), title, hidden deep-link in caption/text and a glass inline button
-        if not SIGNAL_POST_ID:
-            try:
-                if chat_id:
-                    await context.bot.send_message(chat_id=chat_id, text="❌ No free signal has been selected yet.")
-            except Exception:
-                pass
-            return
 
-        post = get_post_db(SIGNAL_POST_ID)
-        if not post:
-            try:
-                if chat_id:
-                    await context.bot.send_message(chat_id=chat_id, text="❌ سیگنال فعلی موجود نیست.")
-            except Exception:
-                pass
-            return
+@menu_routes.exact("📈 سیگنال رایگان", "📈 Free Signal")
+async def free_signal(update, context, chat_id, arg):
+    """User: "📈 Free Signal" — intro, title and the Receive deep link of an active signal."""
+    # show only: intro (media or text), title, hidden deep-link in caption/text and a glass inline button
+    signal = pick_signal(context.bot.username)
+    if signal is None:
+        try:
+            if chat_id:
+                await context.bot.send_message(chat_id=chat_id, text="❌ No free signal has been selected yet.")
+        except Exception:
+            pass
+        return
 
+    _post_id, method, kwargs = signal
+    try:
+        await getattr(context.bot, method)(chat_id=chat_id, **kwargs)
+    except Exception:
         try:
-            cap = json.loads(post.get("caption") or "{}")
+            caption = kwargs.get("caption") or kwargs.get("text")
+            await context.bot.send_message(chat_id=chat_id, text=caption, reply_markup=kwargs["reply_markup"])
         except Exception:
-            cap = {}
+            pass
+    return
 
+
+@menu_routes.exact("📱 پست های پرطرفدار", "پست های پرطرفدار", "📱 Popular Posts", "Popular Posts")
+async def popular_posts(update, context, chat_id, arg):
+    """Public: "پست های پرطرفدار" — same preview layout as the admin sent-posts list."""
+    # treat as admin "پست های ارسالی" preview so public sees the same posts/layout
+    try:
         bot_user = await context.bot.get_me()
         bot_username = getattr(bot_user, "username", "") or ""
-        deep_link = f"https://t.me/{bot_username}?start=get_{SIGNAL_POST_ID}" if bot_username else f"https://t.me/{SIGNAL_POST_ID}"
+        conn = db_connect()
+        cur = conn.cursor()
+        cur.execute("SELECT id, caption FROM posts ORDER BY id DESC")
+        rows = cur.fetchall()
+        conn.close()
+    except Exception:
+        rows = []
 
-        title = cap.get("title", "بدون عنوان")
-        intro = cap.get("intro_file", {}) or {}
-        caption_html = f"📌 {title}\n\n<a href=\"{deep_link}\">📥 Receive</a>"
-        kb = InlineKeyboardMarkup([[InlineKeyboardButton("📥 Receive", url=deep_link)]])
+    if not rows:
+        if chat_id:
+            await context.bot.send_message(chat_id=chat_id, text="✨ هیچ پستی یافت نشد.")
+        return
 
+    for row in rows:
+        post_id = row[0]
         try:
-            # If intro is media -> send intro media with caption (title + hidden link) and glass button beneath
-            if intro.get("file_id"):
-                if intro.get("type") == "photo":
-                    await context.bot.send_photo(chat_id=chat_id, photo=intro["file_id"], caption=caption_html, reply_markup=kb, parse_mode="HTML")
-                else:
-                    await context.bot.send_document(chat_id=chat_id, document=intro["file_id"], caption=caption_html, reply_markup=kb, parse_mode="HTML")
-            # If intro is text -> send one message with title + intro text + hidden link (glass button beneath)
-            elif intro.get("type") == "text" and intro.get("text"):
-                txt = f"📌 {title}\n\n{intro.get('text')}\n\n<a href=\"{deep_link}\">📥 Receive</a>"
-                await context.bot.send_message(chat_id=chat_id, text=txt, reply_markup=kb, parse_mode="HTML")
-            else:
-                # no intro -> only title + hidden link + glass button
-                await context.bot.send_message(chat_id=chat_id, text=caption_html, reply_markup=kb, parse_mode="HTML")
+            cap = json.loads(row[1]) if row[1] else {}
         except Exception:
+            cap = {"title": "بدون عنوان", "intro_file": {}, "main_file": {}}
 
+        try:
+            await send_post_preview(context.bot, chat_id, post_id, cap, bot_username)
+        except Exception:
+            logger.exception("Error sending post %s", post_id)
             try:
-                await context.bot.send_message(chat_id=chat_id, text=caption_html, reply_markup=kb)
+                await context.bot.send_message(chat_id=chat_id, text=f"📌 {cap.get('title', 'بدون عنوان')}\n\n{post_deep_link(bot_username, post_id)}")
             except Exception:
                 pass
-        return
+    return
 
 
-    # 📢 ارسال همگانی (با گزارش نهایی)
-    if data == "broadcast_confirm":
-        try:
-            user = update.effective_user
-            if not user or getattr(user, "username", None) not in ADMINS:
-                await context.bot.send_message(chat_id=chat_id, text="❌ فقط ادمین می‌تواند پیام ارسال کند.")
-                return
+@menu_routes.exact("admin_listposts", "ℹ️ اطلاعات و ویرایش", "اطلاعات و ویرایش")
+async def admin_listposts(update, context, chat_id, arg):
+    """Admin: "اطلاعات و ویرایش" — post details with edit/delete buttons."""
+    context.user_data["prev_menu"] = "posts_menu"
+    conn = db_connect()
+    cur = conn.cursor()
+    cur.execute("SELECT id, caption, channels FROM posts ORDER BY id DESC LIMIT 50")
+    rows = cur.fetchall()
+    conn.close()
 
-            text = context.user_data.get("broadcast_text")
-            if not text:
-                await context.bot.send_message(chat_id=chat_id, text="⚠️ هیچ پیامی برای ارسال وجود ندارد.")
-                return
+    if not rows:
+        kb = ReplyKeyboardMarkup([["برگشت"]], resize_keyboard=True)
+        await context.bot.send_message(chat_id=chat_id, text="✨ هیچ پستی یافت نشد. ✨", reply_markup=kb)
+        return
 
-            # حذف حالت انتظار تا دوباره اشتباه وارد نشود
-            context.user_data.pop("broadcast_text", None)
+    # Send each post as a separate message with full details
+    sent = []
+    for row in rows:
+        post_id = row[0]
+        try:
+            cap, channels = decode_post({"caption": row[1], "channels": row[2]}, untitled="بدون عنوان")
+            caption = post_details_caption(post_id, cap, channels)
+            kb = post_details_keyboard(post_id)
+            intro = cap.get("intro_file", {}) or {}
 
-            # دریافت لیست کاربران ثبت‌شده در دیتابیس
-            conn = sqlite3.connect(DB_PATH)
-            cur = conn.cursor()
-            cur.execute("SELECT user_id FROM users")
-            user_ids = [row[0] for row in cur.fetchall()]
-            conn.close()
+            # Send with intro file if exists, otherwise just text
+            if intro.get("file_id"):
+                if intro.get("type") == "photo":
+                    message = await context.bot.send_photo(
+                        chat_id=chat_id,
+                        photo=intro["file_id"],
+                        caption=caption,
+                        reply_markup=kb
+                    )
+                else:
+                    message = await context.bot.send_document(
+                        chat_id=chat_id,
+                        document=intro["file_id"],
+                        caption=caption,
+                        reply_markup=kb
+                    )
+            else:
+                message = await context.bot.send_message(
+                    chat_id=chat_id,
+                    text=caption,
+                    reply_markup=kb
+                )
+            sent.append((post_id, message))
+        except Exception as e:
+            logger.exception("Error displaying post %s", post_id)
+            continue
 
-            total = len(user_ids)
-            sent = 0
-            failed = 0
+    record_post_messages(sent, kind="details")
+    return
 
-            status_msg = await context.bot.send_message(chat_id=chat_id, text=f"⏳ در حال ارسال پیام به {total} کاربر...")
 
-            for i, uid in enumerate(user_ids, start=1):
-                try:
-                    await context.bot.send_message(chat_id=uid, text=text)
-                    sent += 1
-                except (Forbidden, RetryAfter, TimedOut):
-                    failed += 1
-                except Exception:
-                    failed += 1
-                    continue
+@menu_routes.prefix("edit_post_")
+async def edit_post_menu(update, context, chat_id, arg):
+    """Open the per-field edit menu under a post preview."""
+    query = update.callback_query
+    try:
+        post_id = int(arg)
+    except Exception:
+        if chat_id:
+            await context.bot.send_message(chat_id=chat_id, text="❌ شناسه نامعتبر.")
+        return
+    post = get_post_db(post_id)
+    if not post:
+        if chat_id:
+            await context.bot.send_message(chat_id=chat_id, text="❌ پست یافت نشد.")
+        return
 
-                if i % 50 == 0:
-                    try:
-                        await status_msg.edit_text(f"📨 در حال ارسال... {i}/{total}\n✅ موفق: {sent} | 🚫 خطا: {failed}")
-                    except Exception:
-                        pass
+    # ساخت منوی ویرایش جدید (دکمه‌های ویرایش فیلدها و حذف، بدون دکمه ویرایش/حذف اصلی)
+    edit_kb = InlineKeyboardMarkup([
+        [InlineKeyboardButton("📁 فایل اصلی", callback_data=f"edit_field_{post_id}_main_file")],
+        [InlineKeyboardButton("📎 فایل معرفی", callback_data=f"edit_field_{post_id}_intro_file")],
+        [InlineKeyboardButton("📝 عنوان", callback_data=f"edit_field_{post_id}_title")],
+        [InlineKeyboardButton("🖋️ کپشن", callback_data=f"edit_field_{post_id}_description")],
+        [InlineKeyboardButton("🔗 کانال‌های جوین", callback_data=f"edit_field_{post_id}_channels")],
+        [InlineKeyboardButton("❌ حذف", callback_data=f"delete_post_{post_id}")]
+    ])
 
-                await asyncio.sleep(0.08)  # تاخیر کوچک برای جلوگیری از flood
+    # فقط reply_markup را ویرایش کن تا منوی ویرایش زیر همان پست باز شود و دکمه‌های قبلی حذف شوند
+    try:
+        if query.message:
+            await query.message.edit_reply_markup(reply_markup=edit_kb)
+            return
+    except Exception:
+        logger.exception("Could not edit preview message for post %s; sending edit menu separately.", post_id)
 
-            # گزارش نهایی
-            report = (
-                f"✅ گزارش نهایی:\n\n"
-                f"📨 ارسال موفق: {sent}\n"
-                f"🚫 ناموفق: {failed}\n"
-                f"👥 کل کاربران: {total}"
-            )
-            await context.bot.send_message(chat_id=query.from_user.id, text=report)
-        except Exception as e:
-            await context.bot.send_message(chat_id=query.from_user.id, text=f"❌ خطا در ارسال همگانی:\n{str(e)}")
-    # 🔹 لغو ارسال به همه (درست و هم‌سطح با try:)
-    if data == "cancel_broadcast":
-        context.user_data.pop("awaiting_broadcast_text", None)
-        await context.bot.send_message(chat_id=chat_id, text="❌ ارسال به همه لغو شد.")
-        return
-
-    # Do NOT delete preview when handling edit/delete flows
-    # keep preview when handling any edit/delete/confirm/cancel flows so "خیر" (cancel_delete_) won't remove the post
-    if data and not (
-        data.startswith("delete_post_")
-        or data.startswith("edit_post_")
-        or data.startswith("edit_field_")
-        or data.startswith("confirm_delete_")
-        or data.startswith("cancel_delete_")
-    ):
-         try:
-             if query and getattr(query, "message", None):
-                 await query.message.delete()
-         except Exception:
-             pass
-
-    # handle edit-field callbacks (admin clicked one of the 5 edit buttons)
-    if data and data.startswith("edit_field_"):
-        try:
-            payload = data.split("edit_field_")[1]
-            post_part, field = payload.split("_", 1)
-            post_id = int(post_part)
-        except Exception:
-            if chat_id:
-                await context.bot.send_message(chat_id=chat_id, text="❌ شناسه یا فیلد نامعتبر.")
-            return
+    # اگر نشد، منوی ویرایش را جداگانه ارسال کن
+    try:
+        if chat_id:
+            await context.bot.send_message(chat_id=chat_id, text=f"✏️ انتخاب بخش برای ویرایش پست {post_id}:", reply_markup=edit_kb)
+    except Exception:
+        pass
+    return
 
-        labels = {
-            "main_file": "فایل اصلی",
-            "intro_file": "فایل معرفی",
-            "title": "عنوان",
-            "description": "کپشن",
-            "channels": "کانال‌های جوین"
-        }
-        label = labels.get(field, field)
 
-        if field in ("main_file", "intro_file"):
-            try:
-                if chat_id:
-                    await context.bot.send_message(chat_id=chat_id, text=f"⚠️ بخش «{label}» فعلاً غیرفعال است.")
-            except Exception:
-                pass
-            return
+@menu_routes.prefix("edit_field_")
+async def edit_field_prompt(update, context, chat_id, arg):
+    """Admin clicked one of the 5 edit buttons: wait for the new value."""
+    query = update.callback_query
+    try:
+        payload = arg
+        post_part, field = payload.split("_", 1)
+        post_id = int(post_part)
+    except Exception:
+        if chat_id:
+            await context.bot.send_message(chat_id=chat_id, text="❌ شناسه یا فیلد نامعتبر.")
+        return
 
-        # set editing state for next message
-        context.user_data["editing_post_id"] = post_id
-        context.user_data["editing_field"] = field
-        try:
-            if query.message:
-                context.user_data["editing_preview_msg_id"] = query.message.message_id
-                context.user_data["editing_preview_chat_id"] = query.message.chat_id
-                context.user_data["editing_preview_reply_markup"] = query.message.reply_markup
-        except Exception:
-            pass
+    labels = {
+        "main_file": "فایل اصلی",
+        "intro_file": "فایل معرفی",
+        "title": "عنوان",
+        "description": "کپشن",
+        "channels": "کانال‌های جوین"
+    }
+    label = labels.get(field, field)
+
+    if field in ("main_file", "intro_file"):
         try:
             if chat_id:
-                await context.bot.send_message(chat_id=chat_id, text=f"✏️ لطفاً مقدار جدید برای «{label}» پست {post_id} را ارسال کنید.\nبرای انصراف /cancel استفاده کنید.")
+                await context.bot.send_message(chat_id=chat_id, text=f"⚠️ بخش «{label}» فعلاً غیرفعال است.")
         except Exception:
             pass
         return
 
-    # handle receiving new value for editing fields (title/description/channels)
-    if update.message and context.user_data.get("editing_post_id") and context.user_data.get("editing_field"):
-        post_id = context.user_data["editing_post_id"]
-        field = context.user_data["editing_field"]
-        new_value = update.message.text.strip()
-        # update DB
-        post = get_post_db(post_id)
-        if not post:
-            await update.message.reply_text("❌ پست یافت نشد.")
-            context.user_data.pop("editing_post_id", None)
-            context.user_data.pop("editing_field", None)
-            return
-        try:
-            cap = json.loads(post["caption"])
-        except Exception:
-            cap = {}
-
-        # update the field
-        if field == "title":
-            cap["title"] = new_value
-        elif field == "description":
-            cap["description"] = new_value
-        elif field == "channels":
-            # parse and store as JSON string
-            parsed = parse_channels_text(new_value)
-            channels_json = json.dumps(parsed, ensure_ascii=False)
-            conn = sqlite3.connect(DB_PATH)
-            cur = conn.cursor()
-            cur.execute("UPDATE posts SET channels = ? WHERE id = ?", (channels_json, post_id))
-            conn.commit()
-            conn.close()
-            # update caption in DB as well (for consistency)
-            cur = sqlite3.connect(DB_PATH).cursor()
-            cur.execute("UPDATE posts SET caption = ? WHERE id = ?", (json.dumps(cap, ensure_ascii=False), post_id))
-            cur.connection.commit()
-            cur.connection.close()
-        else:
-            # update caption only
-            conn = sqlite3.connect(DB_PATH)
-            cur = conn.cursor()
-            cur.execute("UPDATE posts SET caption = ? WHERE id = ?", (json.dumps(cap, ensure_ascii=False), post_id))
-            conn.commit()
-            conn.close()
-
-        if field != "channels":
-            # update caption only
-            conn = sqlite3.connect(DB_PATH)
-            cur = conn.cursor()
-            cur.execute("UPDATE posts SET caption = ? WHERE id = ?", (json.dumps(cap, ensure_ascii=False), post_id))
-            conn.commit()
-            conn.close()
+    # set editing state for next message
+    context.user_data["editing_post_id"] = post_id
+    context.user_data["editing_field"] = field
+    try:
+        if query.message:
+            context.user_data["editing_preview_msg_id"] = query.message.message_id
+            context.user_data["editing_preview_chat_id"] = query.message.chat_id
+            context.user_data["editing_preview_reply_markup"] = query.message.reply_markup
+    except Exception:
+        pass
+    try:
+        if chat_id:
+            await context.bot.send_message(chat_id=chat_id, text=f"✏️ لطفاً مقدار جدید برای «{label}» پست {post_id} را ارسال کنید.\nبرای انصراف /cancel استفاده کنید.")
+    except Exception:
+        pass
+    return
 
-        await update.message.reply_text("✅ مقدار جدید ذخیره شد.")
 
-        # clear editing state
-        context.user_data.pop("editing_post_id", None)
-        context.user_data.pop("editing_field", None)
-        context.user_data.pop("editing_preview_msg_id", None)
-        context.user_data.pop("editing_preview_chat_id", None)
-        context.user_data.pop("editing_preview_reply_markup", None)
+@menu_routes.prefix("delete_post_")
+async def delete_post_prompt(update, context, chat_id, arg):
+    """Delete button: ask for confirmation under the same post."""
+    query = update.callback_query
+    try:
+        post_id = int(arg)
+    except Exception:
+        if chat_id:
+            await context.bot.send_message(chat_id=chat_id, text="❌ شناسه نامعتبر.")
         return
 
-    # handle delete button callback -> show confirmation
-    if data and data.startswith("delete_post_"):
-        try:
-            post_id = int(data.split("delete_post_")[1])
-        except Exception:
-            if chat_id:
-                await context.bot.send_message(chat_id=chat_id, text="❌ شناسه نامعتبر.")
-            return
-
-        # ساخت منوی تأیید حذف با دکمه‌های بله/خیر
-        delete_kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("⚠️ آیا از حذف این پست مطمئن هستید؟", callback_data="dummy")],
-            [
-                InlineKeyboardButton("بله، حذف شود ✅", callback_data=f"confirm_delete_{post_id}:0"),
-                InlineKeyboardButton("خیر ❌", callback_data=f"cancel_delete_{post_id}:0")
-            ]
-        ])
-        
-        try:
-            if query and query.message:
-                # فقط دکمه‌ها را عوض می‌کنیم، متن پیام را دست نمی‌زنیم
-                await query.message.edit_reply_markup(reply_markup=delete_kb)
-        except Exception:
-            logger.exception("Could not edit delete confirmation buttons")
-        return
+    # ساخت منوی تأیید حذف با دکمه‌های بله/خیر
+    delete_kb = InlineKeyboardMarkup([
+        [InlineKeyboardButton("⚠️ آیا از حذف این پست مطمئن هستید؟", callback_data="dummy")],
+        [
+            InlineKeyboardButton("بله، حذف شود ✅", callback_data=f"confirm_delete_{post_id}:0"),
+            InlineKeyboardButton("خیر ❌", callback_data=f"cancel_delete_{post_id}:0")
+        ]
+    ])
+    
+    try:
+        if query and query.message:
+            # فقط دکمه‌ها را عوض می‌کنیم، متن پیام را دست نمی‌زنیم
+            await query.message.edit_reply_markup(reply_markup=delete_kb)
+    except Exception:
+        logger.exception("Could not edit delete confirmation buttons")
+    return
 
-    # handle confirmation -> actually delete
-    if data and data.startswith("confirm_delete_"):
-        try:
-            payload = data.split("confirm_delete_")[1]
-            post_part, preview_part = payload.split(":", 1)
-            post_id = int(post_part)
-            preview_msg_id = int(preview_part)
-        except Exception:
-            if chat_id:
-                await context.bot.send_message(chat_id=chat_id, text="❌ شناسه نامعتبر.")
-            return
 
-        # Instead of editing reply_markup, completely delete the message with the post and its buttons
-        try:
-            if query.message:
-                await query.message.delete()
-        except Exception:
-            pass
+@menu_routes.prefix("confirm_delete_")
+async def confirm_delete_post(update, context, chat_id, arg):
+    """Confirmation: actually delete the post."""
+    query = update.callback_query
+    try:
+        payload = arg
+        post_part, preview_part = payload.split(":", 1)
+        post_id = int(post_part)
+        preview_msg_id = int(preview_part)
+    except Exception:
+        if chat_id:
+            await context.bot.send_message(chat_id=chat_id, text="❌ شناسه نامعتبر.")
+        return
 
-        # try to remove any local files referenced in the stored caption (safe best-effort)
-        try:
-            conn = sqlite3.connect(DB_PATH)
-            cur = conn.cursor()
-            cur.execute("SELECT caption, channels FROM posts WHERE id = ?", (post_id,))
-            row = cur.fetchone()
-            conn.close()
-        except Exception:
-            row = None
+    # Instead of editing reply_markup, completely delete the message with the post and its buttons
+    try:
+        if query.message:
+            await query.message.delete()
+    except Exception:
+        pass
 
-        if row:
-            try:
-                cap_json = json.loads(row[0])
-            except Exception:
-                cap_json = {}
-            for key in ("main_file", "intro_file"):
-                fobj = cap_json.get(key, {}) if isinstance(cap_json, dict) else {}
-                local_path = fobj.get("path")
-                if local_path:
-                    try:
-                        p = Path(local_path)
-                        if p.exists():
-                            p.unlink()
-                    except Exception:
-                        logger.exception(f"Failed to remove local file for post {post_id}: {local_path}")
-
-        # delete DB entry
-        try:
-            delete_post_db(post_id)
-        except Exception:
-            logger.exception(f"Failed to delete post {post_id} from DB")
-            if chat_id:
-                await context.bot.send_message(chat_id=chat_id, text=f"❌ خطا در حذف پست {post_id} از منبع.")
-            return
+    # try to remove any local files referenced in the stored caption (safe best-effort)
+    try:
+        conn = db_connect()
+        cur = conn.cursor()
+        cur.execute("SELECT caption, channels FROM posts WHERE id = ?", (post_id,))
+        row = cur.fetchone()
+        conn.close()
+    except Exception:
+        row = None
 
-        # Remove any confirmation messages if present (optional)
+    if row:
         try:
-            if preview_msg_id and chat_id:
-                await context.bot.delete_message(chat_id=chat_id, message_id=preview_msg_id)
+            cap_json = json.loads(row[0])
         except Exception:
-            logger.exception(f"Failed to delete preview message for post {post_id}")
-
-        # ارسال پیام تایید حذف جداگانه
-        try:
-            if chat_id:
-                confirm = await context.bot.send_message(chat_id=chat_id, text=f"✅ پست {post_id} با موفقیت حذف شد.")
-                await asyncio.sleep(3)
+            cap_json = {}
+        for key in ("main_file", "intro_file"):
+            fobj = cap_json.get(key, {}) if isinstance(cap_json, dict) else {}
+            local_path = fobj.get("path")
+            if local_path:
                 try:
-                    await context.bot.delete_message(chat_id=chat_id, message_id=confirm.message_id)
+                    p = Path(local_path)
+                    if p.exists():
+                        p.unlink()
                 except Exception:
-                    pass
-        except Exception:
-            pass
-        return
+                    logger.exception("Failed to remove local file for post %s: %s", post_id, local_path)
 
-    # handle cancel deletion -> restore original edit/delete buttons (do NOT delete the message)
-    if data and data.startswith("cancel_delete_"):
-        try:
-            payload = data.split("cancel_delete_")[1]
-            post_part, _ = payload.split(":", 1)
-            post_id = int(post_part)
-            # بازگرداندن دکمه‌های اصلی (ویرایش و حذف)
-            original_kb = InlineKeyboardMarkup([
-                [InlineKeyboardButton("✏️ ویرایش", callback_data=f"edit_post_{post_id}"),
-                 InlineKeyboardButton("❌ حذف", callback_data=f"delete_post_{post_id}")]
-            ])
-            if query and query.message:
-                await query.message.edit_reply_markup(reply_markup=original_kb)
-       
-        except Exception:
-            logger.exception("Could not restore original buttons")
+    # delete DB entry
+    try:
+        delete_post_db(post_id)
+    except Exception:
+        logger.exception("Failed to delete post %s from DB", post_id)
+        if chat_id:
+            await context.bot.send_message(chat_id=chat_id, text=f"❌ خطا در حذف پست {post_id} از منبع.")
         return
 
-    # handle edit_post_ etc.
-    if data and data.startswith("edit_post_"):
-        try:
-            post_id = int(data.split("edit_post_")[1])
-        except Exception:
-            if chat_id:
-                await context.bot.send_message(chat_id=chat_id, text="❌ شناسه نامعتبر.")
-            return
-        post = get_post_db(post_id)
-        if not post:
-            if chat_id:
-                await context.bot.send_message(chat_id=chat_id, text="❌ پست یافت نشد.")
-            return
+    # Remove any confirmation messages if present (optional)
+    try:
+        if preview_msg_id and chat_id:
+            await context.bot.delete_message(chat_id=chat_id, message_id=preview_msg_id)
+    except Exception:
+        logger.exception("Failed to delete preview message for post %s", post_id)
 
-        # ساخت منوی ویرایش جدید (دکمه‌های ویرایش فیلدها و حذف، بدون دکمه ویرایش/حذف اصلی)
-        edit_kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("📁 فایل اصلی", callback_data=f"edit_field_{post_id}_main_file")],
-            [InlineKeyboardButton("📎 فایل معرفی", callback_data=f"edit_field_{post_id}_intro_file")],
-            [InlineKeyboardButton("📝 عنوان", callback_data=f"edit_field_{post_id}_title")],
-            [InlineKeyboardButton("🖋️ کپشن", callback_data=f"edit_field_{post_id}_description")],
-            [InlineKeyboardButton("🔗 کانال‌های جوین", callback_data=f"edit_field_{post_id}_channels")],
-            [InlineKeyboardButton("❌ حذف", callback_data=f"delete_post_{post_id}")]
-        ])
+    # ارسال پیام تایید حذف جداگانه
+    try:
+        if chat_id:
+            confirm = await context.bot.send_message(chat_id=chat_id, text=f"✅ پست {post_id} با موفقیت حذف شد.")
+            await asyncio.sleep(3)
+            try:
+                await context.bot.delete_message(chat_id=chat_id, message_id=confirm.message_id)
+            except Exception:
+                pass
+    except Exception:
+        pass
+    return
 
-        # فقط reply_markup را ویرایش کن تا منوی ویرایش زیر همان پست باز شود و دکمه‌های قبلی حذف شوند
-        try:
-            if query.message:
-                await query.message.edit_reply_markup(reply_markup=edit_kb)
-                return
-        except Exception:
-            logger.exception(f"Could not edit preview message for post {post_id}; sending edit menu separately.")
 
-        # اگر نشد، منوی ویرایش را جداگانه ارسال کن
-        try:
-            if chat_id:
-                await context.bot.send_message(chat_id=chat_id, text=f"✏️ انتخاب بخش برای ویرایش پست {post_id}:", reply_markup=edit_kb)
-        except Exception:
-            pass
-        return
+@menu_routes.prefix("cancel_delete_")
+async def cancel_delete_post(update, context, chat_id, arg):
+    """Cancel deletion: restore the original edit/delete buttons (keep the message)."""
+    query = update.callback_query
+    try:
+        payload = arg
+        post_part, _ = payload.split(":", 1)
+        post_id = int(post_part)
+        # بازگرداندن دکمه‌های اصلی (ویرایش و حذف)
+        original_kb = InlineKeyboardMarkup([
+            [InlineKeyboardButton("✏️ ویرایش", callback_data=f"edit_post_{post_id}"),
+             InlineKeyboardButton("❌ حذف", callback_data=f"delete_post_{post_id}")]
+        ])
+        if query and query.message:
+            await query.message.edit_reply_markup(reply_markup=original_kb)
+   
+    except Exception:
+        logger.exception("Could not restore original buttons")
+    return
 
-    # handle info/edit menu callback (show post details + edit buttons)
-    if data == "admin_listposts":
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-        cur.execute("SELECT id, caption, channels FROM posts ORDER BY id DESC LIMIT 50")
-        rows = cur.fetchall()
-        conn.close()
 
-        if not rows:
-            kb = ReplyKeyboardMarkup([["برگشت"]], resize_keyboard=True)
-            await context.bot.send_message(chat_id=chat_id, text="✨ هیچ پستی یافت نشد. ✨", reply_markup=kb)
+@menu_routes.pending("awaiting_support_id")
+async def save_support_id(update, context, chat_id, arg):
+    """Admin sent the new support id."""
+    try:
+        user = update.effective_user if update else None
+        if not user or getattr(user, "username", None) not in ADMINS:
             return
+        val = update.message.text.strip()
+        stored = val.lstrip('@')
+        set_setting("support_id", stored)
+        context.user_data.pop("awaiting_support_id", None)
+        await context.bot.send_message(chat_id=chat_id, text=f"✅ آیدی پشتیبان ذخیره شد: @{stored}")
+    except Exception:
+        logger.exception("Failed to save support id")
+    return
 
-        # Send each post as a separate message with full details
-        for row in rows:
-            post_id = row[0]
-            try:
-                cap = json.loads(row[1]) if row[1] else {}
-                channels_text = row[2] if row[2] else ""
-                
-                # Parse channels for display
-                channels = []
-                try:
-                    channels = json.loads(channels_text) if channels_text else []
-                except:
-                    channels = [{"name": c.strip(), "username": c.strip().lstrip('@')} 
-                              for c in channels_text.splitlines() if c.strip()]
-
-                # Build channels display text
-                channels_display = "\n".join(f"• {ch['name']} — @{ch['username']}" 
-                                          for ch in channels) if channels else "بدون کانال"
-
-                title = cap.get("title", "بدون عنوان")
-                desc = cap.get("description", "") or "بدون توضیحات"
-                intro = cap.get("intro_file", {})
-
-                # Build full post info text
-                caption = f"📌 #{post_id} — {title}\n\n"
-                caption += f"📝 توضیحات:\n{desc}\n\n"
-                caption += f"🔗 کانال‌های جوین:\n{channels_display}"
-
-                # Create edit/delete buttons
-                kb = InlineKeyboardMarkup([
-                    [InlineKeyboardButton("✏️ ویرایش", callback_data=f"edit_post_{post_id}"),
-                     InlineKeyboardButton("❌ حذف", callback_data=f"delete_post_{post_id}")]
-                ])
-
-                # Send with intro file if exists, otherwise just text
-                if intro.get("file_id"):
-                    if intro.get("type") == "photo":
-                        await context.bot.send_photo(
-                            chat_id=chat_id,
-                            photo=intro["file_id"],
-                            caption=caption,
-                            reply_markup=kb
-                        )
-                    else:
-                        await context.bot.send_document(
-                            chat_id=chat_id,
-                            document=intro["file_id"],
-                            caption=caption,
-                            reply_markup=kb
-                        )
-                else:
-                    await context.bot.send_message(
-                        chat_id=chat_id,
-                        text=caption,
-                        reply_markup=kb
-                    )
-                
-                # Add small delay between posts
-                await asyncio.sleep(0.3)
 
-            except Exception as e:
-                logger.exception(f"Error displaying post {post_id}")
-                continue
+@menu_routes.pending("awaiting_broadcast_text")
+async def receive_broadcast_message(update, context, chat_id, arg):
+    """Admin sent the message to broadcast: ask for confirmation."""
+    context.user_data.pop("awaiting_broadcast_text", None)
+    context.user_data["broadcast_message"] = update.message
+    context.user_data.setdefault("broadcast_segment", "all")
 
+    await update.message.reply_text(
+        broadcast_confirm_text(context),
+        reply_markup=broadcast_confirm_markup(context.user_data["broadcast_segment"])
+    )
+    return
+
+
+@menu_routes.pending("editing_post_id")
+async def save_edited_field(update, context, chat_id, arg):
+    """Admin sent a new value for title/description/channels."""
+    post_id = context.user_data["editing_post_id"]
+    field = context.user_data["editing_field"]
+    new_value = update.message.text.strip()
+    # update DB
+    post = get_post_db(post_id)
+    if not post:
+        await update.message.reply_text("❌ پست یافت نشد.")
+        context.user_data.pop("editing_post_id", None)
+        context.user_data.pop("editing_field", None)
         return
+    try:
+        cap = json.loads(post["caption"])
+    except Exception:
+        cap = {}
+
+    # update the field
+    if field == "title":
+        cap["title"] = new_value
+    elif field == "description":
+        cap["description"] = new_value
+    elif field == "channels":
+        # parse and store as JSON string
+        parsed = parse_channels_text(new_value)
+        channels_json = json.dumps(parsed, ensure_ascii=False)
+        conn = db_connect()
+        cur = conn.cursor()
+        cur.execute("UPDATE posts SET channels = ? WHERE id = ?", (channels_json, post_id))
+        conn.commit()
+        conn.close()
+    if field != "channels":
+        update_post_caption_db(post_id, cap)
 
-    # Public: show "پست های جذاب" — support both callback.data == text or plain message text forwarded here
-    if (data and data in ("📱 پست های پرطرفدار", "پست های پرطرفدار", "📱 Popular Posts", "Popular Posts")) or (update.message and update.message.text and update.message.text in ("📱 پست های پرطرفدار", "پست های پرطرفدار", "📱 Popular Posts", "Popular Posts")):
-        # treat as admin "پست های ارسالی" preview so public sees the same posts/layout
-        try:
-            bot_user = await context.bot.get_me()
-            bot_username = getattr(bot_user, "username", "") or ""
-            conn = sqlite3.connect(DB_PATH)
-            cur = conn.cursor()
-            cur.execute("SELECT id, caption FROM posts ORDER BY id DESC")
-            rows = cur.fetchall()
-            conn.close()
-        except Exception:
-            rows = []
+    await update.message.reply_text("✅ مقدار جدید ذخیره شد.")
 
-        if not rows:
-            if chat_id:
-                await context.bot.send_message(chat_id=chat_id, text="✨ هیچ پستی یافت نشد.")
-            return
+    # refresh the previews and listings already sent for this post, in the background
+    context.application.create_task(
+        propagate_post_edit(context.bot, post_id, field, update.effective_chat.id),
+        update=update,
+    )
 
-        for row in rows:
-            post_id = row[0]
-            try:
-                cap = json.loads(row[1]) if row[1] else {}
-            except Exception:
-                cap = {"title": "بدون عنوان", "intro_file": {}, "main_file": {}}
+    # clear editing state
+    context.user_data.pop("editing_post_id", None)
+    context.user_data.pop("editing_field", None)
+    context.user_data.pop("editing_preview_msg_id", None)
+    context.user_data.pop("editing_preview_chat_id", None)
+    context.user_data.pop("editing_preview_reply_markup", None)
+    return
 
-            title = cap.get("title", "بدون عنوان")
-            intro = cap.get("intro_file", {}) or {}
-            main = cap.get("main_file", {}) or {}
 
-            deep_link = f"https://t.me/{bot_username}?start=get_{post_id}" if bot_username else f"https://t.me/{post_id}"
-            kb = InlineKeyboardMarkup([[InlineKeyboardButton("📥 Receive", url=deep_link)]])
-            caption_html = f"📌 {title}\n\n<a href=\"{deep_link}\">📥 Receive</a>"
+@timed
+async def menu_callback(update, context):
+    """Entry point for menu texts and callback queries: resolve the route and run it."""
+    query = update.callback_query
+    if query:
+        await query.answer()
+    data = query.data if query else (update.message.text if update.message else "")
+
+    chat_id = None
+    try:
+        if update and getattr(update, "effective_chat", None):
+            chat_id = update.effective_chat.id
+    except Exception:
+        chat_id = None
+    if chat_id is None and query and query.message:
+        chat_id = query.message.chat_id
 
+    if isinstance(data, str) and data:
+        # only callback data carries <prefix><arg> payloads; typed text must match exactly
+        handler, arg = menu_routes.resolve(data if query else data.strip(), allow_prefix=bool(query))
+        if handler is not None:
+            start_time = time.perf_counter()
             try:
-                if intro.get("file_id"):
-                    if intro.get("type") == "photo":
-                        await context.bot.send_photo(chat_id=chat_id, photo=intro["file_id"], caption=caption_html, reply_markup=kb, parse_mode="HTML")
-                    else:
-                        await context.bot.send_document(chat_id=chat_id, document=intro["file_id"], caption=caption_html, reply_markup=kb, parse_mode="HTML")
-                elif intro.get("type") == "text" and intro.get("text"):
-                    full_text = f"📌 {title}\n\n{intro.get('text')}\n\n<a href=\"{deep_link}\">📥 Receive</a>"
-                    await context.bot.send_message(chat_id=chat_id, text=full_text, reply_markup=kb, parse_mode="HTML")
-                elif main.get("file_id"):
-                    if main.get("type") == "photo":
-                        await context.bot.send_photo(chat_id=chat_id, photo=main["file_id"], caption=caption_html, reply_markup=kb, parse_mode="HTML")
-                    else:
-                        await context.bot.send_document(chat_id=chat_id, document=main["file_id"], caption=caption_html, reply_markup=kb, parse_mode="HTML")
-                else:
-                    await context.bot.send_message(chat_id=chat_id, text=caption_html, reply_markup=kb, parse_mode="HTML")
-            except Exception:
-                logger.exception(f"Error sending post {post_id}")
-                try:
-                    await context.bot.send_message(chat_id=chat_id, text=caption_html)
-                except Exception:
-                    pass
-            await asyncio.sleep(0.25)
-        return
+                await handler(update, context, chat_id, arg)
+            finally:
+                ROUTE_LATENCY.observe(time.perf_counter() - start_time, handler.__name__)
+            return
 
-    # Admin: show signal settings submenu (ثبت سیگنال / دیدن سیگنال / برگشت)
-    if data == "admin_signal_menu":
-        kb = ReplyKeyboardMarkup(
-            [
-                ["ثبت سیگنال", "دیدن سیگنال"],
-                ["🔙 برگشت"]
-            ],
-                       resize_keyboard=True
-        )
+    if query:
+        # unknown callback: drop the message that carried it
         try:
-            await context.bot.send_message(chat_id=chat_id, text="⚙️ تنظیم سیگنال رایگان: یکی از گزینه‌ها را انتخاب کنید.", reply_markup=kb)
+            if getattr(query, "message", None):
+                await query.message.delete()
         except Exception:
             pass
         return
+
+    if update.message:
+        handler = menu_routes.resolve_pending(context.user_data)
+        if handler is not None:
+            await handler(update, context, chat_id, data)
+
 async def cancel_support_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """لغو تنظیم آیدی پشتیبان — supports both message-based and callback-based cancel."""
     try:
@@ -2169,12 +2924,8 @@ async def cancel_support_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception:
         logger.exception("Error in cancel_support_id")
 
-# ===============================
-# ✅ Menu handler
-# ===============================
-async def handle_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await menu_callback(update, context)
 
+menu_routes.exact("❌ لغو تنظیم آیدی پشتیبان", "لغو تنظیم آیدی پشتیبان")(_plain(cancel_support_id))
 
 # ===============================
 # ✅ فعال‌سازی منو برای دکمه‌های متنی (ReplyKeyboard)
@@ -2184,24 +2935,1207 @@ async def handle_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await menu_callback(update, context)
 
 
-def main():
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
-    ...
+# ===============================
+# 🔍 Post search
+# ===============================
+# /search <query> answers with one message per page of ranked results (title and a
+# description snippet) with edit/delete buttons per post, instead of one message per
+# post. The query is kept in user_data so page buttons only carry the page number.
+SEARCH_PAGE_SIZE = 8
+
+
+def search_results_page(text, page):
+    """``(message text, InlineKeyboardMarkup)`` for one page of results."""
+    total, rows = search_posts(text, page, SEARCH_PAGE_SIZE)
+    if not total:
+        return f"🔍 نتیجه‌ای برای «{text}» یافت نشد.", None
+    pages = (total + SEARCH_PAGE_SIZE - 1) // SEARCH_PAGE_SIZE
+    lines = [f"🔍 «{text}» — {total} نتیجه (صفحه {page + 1} از {pages})\n"]
+    buttons = []
+    for post_id, title, snippet in rows:
+        lines.append(f"📌 #{post_id} — {title or 'بدون عنوان'}" + (f"\n   {snippet}" if snippet else ""))
+        buttons.append([InlineKeyboardButton(f"✏️ ویرایش #{post_id}", callback_data=f"edit_post_{post_id}"),
+                        InlineKeyboardButton(f"❌ حذف #{post_id}", callback_data=f"delete_post_{post_id}")])
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("⬅️ قبلی", callback_data=f"search_page_{page - 1}"))
+    if page + 1 < pages:
+        nav.append(InlineKeyboardButton("بعدی ➡️", callback_data=f"search_page_{page + 1}"))
+    if nav:
+        buttons.append(nav)
+    return "\n".join(lines), InlineKeyboardMarkup(buttons)
+
+
+@timed
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/search <query> — find posts by title and description (admins only)."""
+    if not (update.effective_user and update.effective_user.username in ADMINS):
+        await update.message.reply_text("❌ ✨ Unauthorized. ✨")
+        return
+    text = " ".join(context.args or []).strip()
+    if not fts_query(text):
+        await update.message.reply_text("🔍 استفاده: /search <عبارت جستجو>")
+        return
+    context.user_data["search_query"] = text
+    body, kb = search_results_page(text, 0)
+    await update.message.reply_text(body, reply_markup=kb)
 
-    # basic commands
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("intro", send_intro))
-    app.add_handler(CommandHandler("stats", stats_bot))
 
-    # Conversation for creating new posts (moved into main)
-    newpost_conv = ConversationHandler(
-        entry_points=[
-            CommandHandler("newpost", newpost_start),
-            MessageHandler(filters.Regex(r"^🆕 پست جدید$"), newpost_start),
+@menu_routes.prefix("search_page_")
+async def search_page(update, context, chat_id, arg):
+    """Page buttons under /search results (callback_data "search_page_<page>")."""
+    query = update.callback_query
+    text = context.user_data.get("search_query")
+    if not (text and arg.isdigit()):
+        await query.edit_message_text("⚠️ جستجو منقضی شده؛ دوباره /search را بفرستید.")
+        return
+    body, kb = search_results_page(text, int(arg))
+    await query.edit_message_text(body, reply_markup=kb)
+
+
+# ===============================
+# 🔎 Inline mode (@bot <query>)
+# ===============================
+# Typing "@<bot> <words>" in any chat lists matching posts; picking one shares its
+# intro with the "📥 Receive" deep link. (Inline mode has to be enabled once with
+# @BotFather /setinline.) Answers come from TitleIndex, an in-memory index of the posts
+# table: every word of every title (folded like the FTS index) in one sorted list, so
+# the posts with a word starting with a prefix are one bisect range. After a post is
+# saved, edited or deleted, the first query rebuilds it in a worker thread, so the event
+# loop keeps serving other updates meanwhile. Results do not depend on who asks, so
+# answers are marked non-personal and Telegram caches them for INLINE_CACHE_TIME
+# seconds; repeated queries never reach the bot.
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", 300))
+INLINE_PAGE_SIZE = 50  # Telegram's maximum per answer
+
+_title_index = None  # the latest TitleIndex built
+_title_index_version = 0  # bumped by every post write; an index of an older version is stale
+_title_index_build = None  # (version, bot_username, task) of the rebuild in progress
+# "+= 1" is a read and a write, and the maintenance thread and the event loop both bump
+# the version; without the lock two bumps can become one and a stale index be kept
+_title_index_lock = threading.Lock()
+
+
+def invalidate_title_index():
+    """Called after post writes, possibly from a worker thread (maintenance)."""
+    global _title_index_version
+    with _title_index_lock:
+        _title_index_version += 1
+
+
+def inline_result(post_id, cap, bot_username):
+    """The shareable InlineQueryResult of a post: its intro with title and deep link."""
+    title = cap.get("title") or "بدون عنوان"
+    intro = cap.get("intro_file", {}) or {}
+    caption_html, text_html, kb = preview_content(post_id, cap, bot_username)
+    description = (cap.get("description") or "")[:100]
+    if intro.get("file_id") and intro.get("type") == "photo":
+        return InlineQueryResultCachedPhoto(
+            id=str(post_id), photo_file_id=intro["file_id"], title=title, description=description,
+            caption=caption_html, parse_mode="HTML", reply_markup=kb,
+        )
+    if intro.get("file_id"):
+        return InlineQueryResultCachedDocument(
+            id=str(post_id), document_file_id=intro["file_id"], title=title, description=description,
+            caption=caption_html, parse_mode="HTML", reply_markup=kb,
+        )
+    return InlineQueryResultArticle(
+        id=str(post_id), title=title, description=description, reply_markup=kb,
+        input_message_content=InputTextMessageContent(text_html, parse_mode="HTML"),
+    )
+
+
+def title_words(text):
+    return set(re.findall(r"\w+", fold_search_text(text).lower()))
+
+
+class TitleIndex:
+    """Prefix index over the words of post titles; inline results are built on first use."""
+
+    def __init__(self, bot_username, version=0):
+        self.bot_username = bot_username
+        self.version = version
+        self.captions = {}  # post_id -> caption JSON
+        self.words_of = {}  # post_id -> title words
+        pairs = []
+        for post_id, caption, _channels in iter_posts():
+            cap, _ = decode_post({"caption": caption}, untitled="")
+            words = title_words(cap.get("title"))
+            self.captions[post_id] = caption
+            self.words_of[post_id] = words
+            pairs.extend((word, post_id) for word in words)
+        pairs.sort()
+        self.words = [word for word, _ in pairs]
+        self.post_ids = [post_id for _, post_id in pairs]
+        self.newest = sorted(self.captions, reverse=True)
+        self._results = {}
+
+    def match(self, text, limit):
+        """Up to ``limit`` post ids, newest first, whose title has a word starting with every word of ``text``."""
+        prefixes = title_words(text)
+        if not prefixes:  # empty query: the latest posts
+            return self.newest[:limit]
+        ranges = []
+        for prefix in prefixes:
+            lo = bisect_left(self.words, prefix)
+            ranges.append((bisect_left(self.words, prefix + "\U0010ffff", lo) - lo, lo, prefix))
+        ranges.sort()
+        # candidates from the narrowest prefix, then checked against the others' words
+        _size, lo, first = ranges[0]
+        others = [prefix for _size, _lo, prefix in ranges[1:]]
+        candidates = set(self.post_ids[lo:lo + _size])
+        if others:
+            candidates = {post_id for post_id in candidates
+                          if all(any(word.startswith(prefix) for word in self.words_of[post_id]) for prefix in others)}
+        # a set of ints iterates mostly in ascending order, the worst case for heapq.nlargest;
+        # timsort handles such runs in linear time
+        return sorted(candidates, reverse=True)[:limit]
+
+    def result(self, post_id):
+        result = self._results.get(post_id)
+        if result is None:
+            cap, _channels = decode_post({"caption": self.captions[post_id]}, untitled="")
+            result = self._results[post_id] = inline_result(post_id, cap, self.bot_username)
+        return result
+
+
+async def title_index(bot_username):
+    """The TitleIndex of the current posts; after a post write it is rebuilt in a worker
+    thread, once, however many inline queries are waiting for it."""
+    global _title_index, _title_index_build
+    version = _title_index_version
+    index = _title_index
+    if index is not None and index.version == version and index.bot_username == bot_username:
+        return index
+    build = _title_index_build
+    if build is None or build[:2] != (version, bot_username):
+        task = asyncio.create_task(asyncio.to_thread(TitleIndex, bot_username, version))
+        build = _title_index_build = (version, bot_username, task)
+    try:
+        index = await asyncio.shield(build[2])
+    except Exception:
+        if _title_index_build is build:
+            _title_index_build = None  # let the next query try again
+        raise
+    if _title_index is None or _title_index.version <= index.version:
+        _title_index = index
+    return index
+
+
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Answer "@bot <query>" with matching posts (paged with next_offset)."""
+    query = update.inline_query
+    index = await title_index(context.bot.username)
+    offset = int(query.offset) if query.offset.isdigit() else 0
+    # one extra match tells whether there is a next page
+    matches = index.match(query.query, offset + INLINE_PAGE_SIZE + 1)
+    page = matches[offset:offset + INLINE_PAGE_SIZE]
+    more = len(matches) > offset + INLINE_PAGE_SIZE
+    await query.answer(
+        [index.result(post_id) for post_id in page],
+        cache_time=INLINE_CACHE_TIME,
+        is_personal=False,
+        next_offset=str(offset + INLINE_PAGE_SIZE) if more else "",
+    )
+
+
+# ===============================
+# 📦 Bulk import / export of posts
+# ===============================
+# /importposts takes a JSON or CSV file (sent with /importposts as its caption, or
+# answered with /importposts), validates every row and creates all posts in one
+# transaction; if any row is invalid nothing is imported. /exportposts [json|csv]
+# writes every post in the same format, so an export can be imported again.
+#
+# JSON is a list of objects (or {"posts": [...]}); CSV has a header row. Fields:
+#   title        required
+#   description
+#   main_file    required: {"type": "photo"|"document", "file_id": ...},
+#                {"type": "text", "text": ...} or {"type": "album", "items": [...]};
+#                also "photo:<file_id>", "document:<file_id>" or plain text (handy in CSV)
+#   intro_file   optional, same forms as main_file
+#   channels     a list of {"name", "username"}, or lines as typed in the newpost
+#                flow ("Name | @channel", one per line); empty or None for no channels
+# "id" and "deep_link" (written by the export) are ignored.
+IMPORT_MAX_BYTES = 5 * 1024 * 1024
+IMPORT_MAX_ERRORS = 20  # invalid rows listed in the reply
+POST_FIELDS = ("title", "description", "main_file", "intro_file", "channels")
+EXPORT_PAGE_SIZE = 200
+CAPTION_LIMIT = 1024  # Telegram's limit for media captions
+TEXT_LIMIT = 4096  # ... and for message texts
+
+_FILE_REF_RE = re.compile(r"^(photo|document):(\S+)$")
+_CHANNEL_USERNAME_RE = re.compile(r"^[A-Za-z0-9_]{4,32}$")
+
+
+def _import_file_field(value, field):
+    if value is None or value == "":
+        return {}
+    if isinstance(value, str):
+        value = value.strip()
+        if not value.startswith("{"):
+            ref = _FILE_REF_RE.match(value)
+            if ref:
+                return {"type": ref.group(1), "file_id": ref.group(2)}
+            return {"type": "text", "text": value} if value else {}
+        try:
+            value = json.loads(value)
+        except ValueError:
+            raise ValueError(f"{field}: JSON نامعتبر")
+    if not isinstance(value, dict):
+        raise ValueError(f"{field}: باید آبجکت یا متن باشد")
+    if not value:
+        return {}
+    kind = value.get("type")
+    if kind == "album" and field == "main_file":
+        items = value.get("items")
+        if not isinstance(items, list) or len(items) < 2:
+            raise ValueError(f"{field}: آلبوم باید حداقل دو فایل داشته باشد")
+        album = []
+        for item in items:
+            item = _import_file_field(item, f"{field}.items")
+            if item.get("type") not in ("photo", "document"):
+                raise ValueError(f"{field}.items: فقط عکس یا فایل مجاز است")
+            album.append(item)
+        return {"type": "album", "items": album}
+    if kind in ("photo", "document"):
+        if not value.get("file_id"):
+            raise ValueError(f"{field}: برای {kind} مقدار file_id لازم است")
+        return {"type": kind, "file_id": str(value["file_id"])}
+    if kind == "text":
+        if not value.get("text"):
+            raise ValueError(f"{field}: متن خالی است")
+        return {"type": "text", "text": str(value["text"])}
+    raise ValueError(f"{field}: نوع ناشناخته {kind!r}")
+
+
+def _import_channels_field(value):
+    if value is None or value == "":
+        return []
+    if isinstance(value, str):
+        channels = parse_channels_text(value)
+    elif isinstance(value, list):
+        channels = []
+        for item in value:
+            if isinstance(item, dict):
+                username = str(item.get("username") or "").lstrip("@")
+                channels.append({"name": str(item.get("name") or username), "username": username})
+            else:
+                channels.extend(parse_channels_text(str(item)))
+    else:
+        raise ValueError("channels: باید لیست یا متن باشد")
+    for channel in channels:
+        if not _CHANNEL_USERNAME_RE.match(channel["username"]):
+            raise ValueError(f"channels: یوزرنیم نامعتبر {channel['username']!r}")
+    return channels
+
+
+def validate_post_row(row):
+    """Turn one imported row into the dict save_post_db() takes; raises ValueError."""
+    if not isinstance(row, dict):
+        raise ValueError("باید آبجکت باشد")
+    if None in row:  # csv.DictReader: more cells than header columns
+        raise ValueError("تعداد ستون‌ها بیشتر از سرستون‌هاست")
+    unknown = set(row) - set(POST_FIELDS) - {"id", "deep_link"}
+    if unknown:
+        raise ValueError(f"فیلد ناشناخته: {', '.join(sorted(unknown))}")
+    title = str(row.get("title") or "").strip()
+    if not title:
+        raise ValueError("عنوان (title) الزامی است")
+    description = str(row.get("description") or "").strip()
+    main_file = _import_file_field(row.get("main_file"), "main_file")
+    if not main_file:
+        raise ValueError("فایل اصلی (main_file) الزامی است")
+    intro_file = _import_file_field(row.get("intro_file"), "intro_file")
+    channels = _import_channels_field(row.get("channels"))
+    # the delivered message must fit: a media caption, or one text message for text posts
+    size = len(post_info_caption(title, description)) + len(main_file.get("text", ""))
+    limit = TEXT_LIMIT if main_file["type"] == "text" else CAPTION_LIMIT
+    if size > limit:
+        raise ValueError(f"متن پست {size} کاراکتر است (حداکثر {limit})")
+    return {
+        "title": title,
+        "description": description,
+        "main_file": main_file,
+        "intro_file": intro_file,
+        "channels": json.dumps(channels, ensure_ascii=False),
+    }
+
+
+def read_import_rows(data, filename=""):
+    """Rows of an uploaded JSON or CSV file (picked by extension, else by content)."""
+    text = data.decode("utf-8-sig")
+    name = filename.lower()
+    is_json = name.endswith(".json") or (not name.endswith(".csv") and text.lstrip().startswith(("[", "{")))
+    if is_json:
+        rows = json.loads(text)
+        if isinstance(rows, dict):
+            rows = rows.get("posts")
+        if not isinstance(rows, list):
+            raise ValueError("JSON باید لیستی از پست‌ها باشد")
+        return rows
+    reader = csv.DictReader(io.StringIO(text, newline=""))
+    missing = {"title", "main_file"} - set(reader.fieldnames or ())
+    if missing:
+        raise ValueError(f"ستون‌های لازم در CSV نیست: {', '.join(sorted(missing))}")
+    return list(reader)
+
+
+def iter_posts(page_size=EXPORT_PAGE_SIZE):
+    """Yield (id, caption, channels) for every post, one short query per page."""
+    last_id = 0
+    while True:
+        conn = db_connect()
+        try:
+            rows = conn.execute(
+                "SELECT id, caption, channels FROM posts WHERE id > ? ORDER BY id LIMIT ?", (last_id, page_size)
+            ).fetchall()
+        finally:
+            conn.close()
+        yield from rows
+        if len(rows) < page_size:
+            return
+        last_id = rows[-1][0]
+
+
+def export_post_row(post_id, caption, channels, bot_username):
+    cap, channel_list = decode_post({"caption": caption, "channels": channels})
+    return {
+        "id": post_id,
+        "title": cap.get("title", ""),
+        "description": cap.get("description", ""),
+        "main_file": cap.get("main_file") or {},
+        "intro_file": cap.get("intro_file") or {},
+        "channels": channel_list,
+        "deep_link": post_deep_link(bot_username, post_id),
+    }
+
+
+def write_posts_export(out, fmt, bot_username):
+    """Write every post to the text stream ``out`` as "json" or "csv"; returns the count."""
+    count = 0
+    if fmt == "csv":
+        writer = csv.DictWriter(out, fieldnames=("id",) + POST_FIELDS + ("deep_link",))
+        writer.writeheader()
+        for row in iter_posts():
+            post = export_post_row(*row, bot_username)
+            for field in ("main_file", "intro_file"):
+                post[field] = json.dumps(post[field], ensure_ascii=False) if post[field] else ""
+            post["channels"] = "\n".join(
+                f"{item.get('name') or item.get('username')} | @{item.get('username')}" for item in post["channels"]
+            )
+            writer.writerow(post)
+            count += 1
+        return count
+    out.write("[")
+    for row in iter_posts():
+        out.write(",\n" if count else "\n")
+        json.dump(export_post_row(*row, bot_username), out, ensure_ascii=False)
+        count += 1
+    out.write("\n]\n")
+    return count
+
+
+@timed
+async def import_posts(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/importposts — create posts in bulk from an attached JSON/CSV file (admins only)."""
+    message = update.message
+    if not (update.effective_user and update.effective_user.username in ADMINS):
+        await message.reply_text("❌ ✨ Unauthorized. ✨")
+        return
+    document = message.document or (message.reply_to_message.document if message.reply_to_message else None)
+    if not document:
+        await message.reply_text(
+            "📎 فایل JSON یا CSV پست‌ها را با کپشن /importposts بفرستید، "
+            "یا روی فایل ارسال‌شده با /importposts پاسخ دهید."
+        )
+        return
+    if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+        await message.reply_text(f"❌ حجم فایل بیشتر از {IMPORT_MAX_BYTES // (1024 * 1024)} مگابایت است.")
+        return
+
+    tg_file = await document.get_file()
+    data = bytes(await tg_file.download_as_bytearray())
+    try:
+        rows = read_import_rows(data, document.file_name or "")
+    except (ValueError, csv.Error) as e:
+        await message.reply_text(f"❌ فایل قابل خواندن نیست: {e}")
+        return
+    if not rows:
+        await message.reply_text("⚠️ فایل هیچ پستی ندارد.")
+        return
+
+    posts, errors = [], []
+    for number, row in enumerate(rows, 1):
+        try:
+            posts.append(validate_post_row(row))
+        except ValueError as e:
+            errors.append(f"ردیف {number}: {e}")
+    if errors:
+        lines = errors[:IMPORT_MAX_ERRORS]
+        if len(errors) > IMPORT_MAX_ERRORS:
+            lines.append(f"… و {len(errors) - IMPORT_MAX_ERRORS} خطای دیگر")
+        await message.reply_text(
+            f"❌ هیچ پستی وارد نشد؛ {len(errors)} ردیف از {len(rows)} ردیف نامعتبر است:\n" + "\n".join(lines)
+        )
+        return
+
+    post_ids = save_posts_db(posts)
+    logger.info("📦 Imported %s post(s) (ids %s-%s)", len(post_ids), post_ids[0], post_ids[-1])
+    summary = f"✅ {len(post_ids)} پست وارد شد (شناسه {post_ids[0]} تا {post_ids[-1]})."
+    links = "\n".join(
+        f"{post_id} — {post['title']}: {post_deep_link(context.bot.username, post_id)}"
+        for post_id, post in zip(post_ids, posts)
+    )
+    if len(summary) + len(links) + 2 <= TEXT_LIMIT:
+        await message.reply_text(f"{summary}\n\n{links}", disable_web_page_preview=True)
+    else:
+        await message.reply_document(
+            document=links.encode(), filename="deep_links.txt", caption=summary,
+        )
+
+
+@timed
+async def export_posts(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/exportposts [json|csv] — every post as a file /importposts accepts (admins only)."""
+    if not (update.effective_user and update.effective_user.username in ADMINS):
+        await update.message.reply_text("❌ ✨ Unauthorized. ✨")
+        return
+    fmt = context.args[0].lower() if context.args else "json"
+    if fmt not in ("json", "csv"):
+        await update.message.reply_text("⚠️ استفاده: /exportposts [json|csv]")
+        return
+    # posts are written page by page to a temporary file, never held in memory together
+    with tempfile.TemporaryFile() as raw:
+        out = io.TextIOWrapper(raw, encoding="utf-8", newline="")
+        count = write_posts_export(out, fmt, context.bot.username)
+        out.flush()
+        out.detach()
+        if not count:
+            await update.message.reply_text("✨ No posts found. ✨")
+            return
+        raw.seek(0)
+        await update.message.reply_document(
+            document=raw, filename=f"posts-{time.strftime('%Y%m%d')}.{fmt}", caption=f"📦 {count} پست",
+        )
+
+
+# ===============================
+# 🔌 Bot API connections
+# ===============================
+# Bot API calls use three separate connection pools, so long polling and broadcasts
+# never take connections away from user-facing sends:
+#   get_updates  one connection for long polling
+#   interactive  replies to users (the default lane)
+#   bulk         broadcasts; a task opts in with request_lane.set("bulk")
+# BOT_API_HTTP_VERSION=2 multiplexes requests over fewer connections but needs the
+# optional h2 package (pip install "python-telegram-bot[http2]").
+BOT_API_BASE_URL = os.getenv("BOT_API_BASE_URL", "https://api.telegram.org/bot")
+BOT_API_BASE_FILE_URL = os.getenv("BOT_API_BASE_FILE_URL", "https://api.telegram.org/file/bot")
+BOT_API_HTTP_VERSION = os.getenv("BOT_API_HTTP_VERSION", "1.1")
+BOT_API_POOL_SIZE = int(os.getenv("BOT_API_POOL_SIZE", 128))
+BOT_API_BULK_POOL_SIZE = int(os.getenv("BOT_API_BULK_POOL_SIZE", 16))
+BOT_API_KEEPALIVE_EXPIRY = float(os.getenv("BOT_API_KEEPALIVE_EXPIRY", 30))  # seconds an idle connection is kept
+BOT_API_CONNECT_TIMEOUT = float(os.getenv("BOT_API_CONNECT_TIMEOUT", 5))
+BOT_API_READ_TIMEOUT = float(os.getenv("BOT_API_READ_TIMEOUT", 5))
+BOT_API_WRITE_TIMEOUT = float(os.getenv("BOT_API_WRITE_TIMEOUT", 20))  # uploads (documents, photos)
+BOT_API_POOL_TIMEOUT = float(os.getenv("BOT_API_POOL_TIMEOUT", 3))  # wait for a free connection
+
+request_lane = contextvars.ContextVar("request_lane", default="interactive")
+
+
+def make_request(lane, pool_size):
+    """An InstrumentedRequest configured from the BOT_API_* settings."""
+    http_version = BOT_API_HTTP_VERSION
+    if http_version == "2":
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            logger.warning("⚠️ BOT_API_HTTP_VERSION=2 needs the h2 package; falling back to HTTP/1.1")
+            http_version = "1.1"
+    return InstrumentedRequest(
+        lane=lane,
+        keepalive_expiry=BOT_API_KEEPALIVE_EXPIRY,
+        connection_pool_size=pool_size,
+        connect_timeout=BOT_API_CONNECT_TIMEOUT,
+        read_timeout=BOT_API_READ_TIMEOUT,
+        write_timeout=BOT_API_WRITE_TIMEOUT,
+        pool_timeout=BOT_API_POOL_TIMEOUT,
+        http_version=http_version,
+    )
+
+
+class _LaneRequest:
+    """Routes each Bot API call to the connection pool of the current request_lane."""
+
+    def __init__(self, lanes):
+        self.lanes = lanes  # lane name -> BaseRequest
+
+    async def initialize(self):
+        await asyncio.gather(*(request.initialize() for request in self.lanes.values()))
+
+    async def shutdown(self):
+        await asyncio.gather(*(request.shutdown() for request in self.lanes.values()))
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        request = self.lanes.get(request_lane.get()) or self.lanes["interactive"]
+        return await request.do_request(url, method, request_data, **kwargs)
+
+
+def build_requests():
+    """(request, get_updates_request) for ApplicationBuilder."""
+    request = LaneRequest({
+        "interactive": make_request("interactive", BOT_API_POOL_SIZE),
+        "bulk": make_request("bulk", BOT_API_BULK_POOL_SIZE),
+    })
+    return request, make_request("get_updates", 1)
+
+
+# ===============================
+# 🚦 Outbound scheduler
+# ===============================
+# Every Bot API call made through the Application's bot passes OutboundScheduler
+# (PTB's rate limiter hook), so sends and edits from handlers, listings and broadcasts
+# share one budget:
+#   - at most SEND_GLOBAL_RATE messages per second overall (Telegram: ~30/s);
+#   - per chat, a token bucket of SEND_CHAT_BURST messages refilled at SEND_CHAT_RATE
+#     per second for private chats and SEND_GROUP_RATE for groups/channels (20/min);
+#   - waiting sends leave in priority order: the interactive lane always goes before
+#     the bulk lane (request_lane, the same variable that picks the connection pool);
+#   - a 429 pauses the chat (or everything, if the call has no chat) for retry_after
+#     and the call is retried up to SEND_MAX_RETRIES times.
+# Calls that are not messages (getChatMember, answerCallbackQuery, ...) are not delayed.
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", 30))
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", 3))
+SEND_GROUP_RATE = float(os.getenv("SEND_GROUP_RATE", 20 / 60))
+SEND_CHAT_BURST = int(os.getenv("SEND_CHAT_BURST", 5))
+SEND_MAX_RETRIES = 3
+SEND_LANES = ("interactive", "bulk")  # highest priority first
+LIMITED_ENDPOINTS = ("send", "edit", "copy", "forward")
+
+
+class _OutboundScheduler:
+    """Rate limiter with global and per-chat limits and priority lanes."""
+
+    # chat buckets are dropped once this many exist and they have refilled completely
+    CHAT_TABLE_LIMIT = 10000
+
+    def __init__(self, global_rate=SEND_GLOBAL_RATE, chat_rate=SEND_CHAT_RATE, group_rate=SEND_GROUP_RATE,
+                 chat_burst=SEND_CHAT_BURST, max_retries=SEND_MAX_RETRIES):
+        self.interval = 1.0 / global_rate
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._queues = {lane: collections.deque() for lane in SEND_LANES}
+        self._waiting = dict.fromkeys(SEND_LANES, 0)
+        self._chats = {}  # chat_id -> (tokens, monotonic time of last update)
+        self._next_slot = 0.0
+        self._paused_until = 0.0
+        self._wakeup = None
+        self._dispatcher = None
+
+    async def initialize(self):
+        # called once by the Application's bot and again by the Updater's (same) bot
+        if self._dispatcher is None:
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self):
+        if self._dispatcher:
+            self._dispatcher.cancel()
+            self._dispatcher = None
+        # nothing is dispatched any more: let whoever still waits go
+        for queue in self._queues.values():
+            while queue:
+                future = queue.popleft()
+                if not future.done():
+                    future.set_result(None)
+
+    def queue_depths(self):
+        return dict(self._waiting)
+
+    def _chat_wait(self, chat_id):
+        """Take a token from the chat's bucket; returns how long to wait until it is valid."""
+        is_group = isinstance(chat_id, str) or chat_id < 0
+        rate = self.group_rate if is_group else self.chat_rate
+        now = time.monotonic()
+        tokens, updated = self._chats.get(chat_id, (self.chat_burst, now))
+        tokens = min(self.chat_burst, tokens + (now - updated) * rate) - 1
+        self._chats[chat_id] = (tokens, now)
+        if len(self._chats) > self.CHAT_TABLE_LIMIT:
+            self._prune_chats(now)
+        return 0.0 if tokens >= 0 else -tokens / rate
+
+    def _prune_chats(self, now):
+        full_after = self.chat_burst / min(self.chat_rate, self.group_rate)
+        for chat_id, (_, updated) in list(self._chats.items()):
+            if now - updated > full_after:
+                del self._chats[chat_id]
+
+    def _pause_chat(self, chat_id, seconds):
+        # a bucket that is `seconds` worth of tokens in debt
+        is_group = isinstance(chat_id, str) or chat_id < 0
+        rate = self.group_rate if is_group else self.chat_rate
+        self._chats[chat_id] = (-seconds * rate, time.monotonic())
+
+    async def _dispatch(self):
+        """Release waiting sends one per global interval, interactive lane first."""
+        while True:
+            queue = next((q for q in self._queues.values() if q), None)
+            if queue is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            delay = max(self._next_slot, self._paused_until) - time.monotonic()
+            if delay > 0:
+                # re-check the lanes afterwards: an interactive send may arrive meanwhile
+                await asyncio.sleep(delay)
+                continue
+            future = queue.popleft()
+            if future.done():  # caller gave up (cancelled)
+                continue
+            future.set_result(None)
+            self._next_slot = time.monotonic() + self.interval
+
+    async def _acquire(self, lane, chat_id):
+        if chat_id is not None:
+            delay = self._chat_wait(chat_id)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        future = asyncio.get_running_loop().create_future()
+        self._queues[lane].append(future)
+        self._wakeup.set()
+        await future
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if not endpoint.startswith(LIMITED_ENDPOINTS) or self._dispatcher is None:
+            return await callback(*args, **kwargs)
+        lane = (rate_limit_args or {}).get("lane") or request_lane.get()
+        if lane not in self._queues:
+            lane = "interactive"
+        chat_id = data.get("chat_id")
+        for attempt in range(self.max_retries + 1):
+            start_time = time.perf_counter()
+            self._waiting[lane] += 1
+            SEND_QUEUE_DEPTH.set(self._waiting[lane], lane)
+            try:
+                await self._acquire(lane, chat_id)
+            finally:
+                self._waiting[lane] -= 1
+                SEND_QUEUE_DEPTH.set(self._waiting[lane], lane)
+                waited = time.perf_counter() - start_time
+                SEND_WAIT.observe(waited, lane)
+                trace = current_trace.get()
+                if trace is not None:
+                    trace.add("send.wait", start_time, waited, lane)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as exc:
+                if attempt == self.max_retries:
+                    raise
+                retry_after = exc.retry_after
+                SEND_RETRIES.inc(lane)
+                logger.warning("⏳ %s to %s hit the rate limit; retrying in %ss", endpoint, chat_id, retry_after)
+                if chat_id is None:
+                    self._paused_until = time.monotonic() + retry_after
+                else:
+                    self._pause_chat(chat_id, retry_after)
+
+
+# ===============================
+# ⚡ Concurrent update processing
+# ===============================
+# Number of updates processed at the same time (across different users)
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", 256))
+
+# set when the process starts shutting down; long-running loops (broadcasts) stop early
+shutdown_requested = asyncio.Event()
+
+
+def serial_key(update):
+    """Updates with the same key are processed strictly in arrival order."""
+    if isinstance(update, Update):
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return update.effective_chat.id
+    return None
+
+
+class _PerUserSerialApplication:
+    """Application that processes updates of different users in parallel, one user at a time.
+
+    Instead of PTB's task per update, the fetcher appends each update to its user's
+    queue and starts one worker per user with pending updates. The worker takes a
+    ``concurrent_updates`` permit only while an update is being processed, so one user's
+    burst or slow handler (membership checks, admin listings) occupies at most one
+    permit and never delays other users, while each user's own updates, including the
+    ``newpost_*`` conversation steps, still run strictly in arrival order.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._serial_queues = {}  # key -> deque of (update, perf_counter when queued)
+        self._tasks = set()  # update and background tasks started via create_task
+        self.abandoned = 0  # updates cancelled at the shutdown deadline
+        self.backlog = set()  # ids of catch-up updates not processed yet (see catch_up)
+        self.backlog_drained = asyncio.Event()
+        self.last_update_at = 0.0  # monotonic time the latest update started (see is_quiet)
+
+    def create_task(self, coroutine, update=None):
+        task = super().create_task(coroutine, update=update)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    @property
+    def pending_tasks(self):
+        return len(self._tasks)
+
+    async def wait_idle(self):
+        """Wait until every queued update is processed and no background task is left."""
+        await self.update_queue.join()
+        while self._tasks:
+            await asyncio.wait(set(self._tasks))
+
+    def abandon(self):
+        """Drop queued updates and cancel running tasks; returns (cancelled, dropped)."""
+        dropped = 0
+        while not self.update_queue.empty():
+            self.update_queue.get_nowait()
+            self.update_queue.task_done()
+            dropped += 1
+        for queue in self._serial_queues.values():
+            for _item in queue:
+                self.update_queue.task_done()
+            dropped += len(queue)
+            queue.clear()
+        tasks = [task for task in self._tasks if not task.done()]
+        for task in tasks:
+            task.cancel()
+        return len(tasks), dropped
+
+    async def _update_fetcher(self):
+        if not self.concurrent_updates:
+            await super()._update_fetcher()
+            return
+        while True:
+            try:
+                update = await self.update_queue.get()
+                if update is _STOP_SIGNAL:
+                    while not self.update_queue.empty():
+                        self.update_queue.task_done()
+                    self.update_queue.task_done()
+                    return
+                if isinstance(update, Update):
+                    note_update_started(update.update_id)
+                item = (update, time.perf_counter())
+                key = serial_key(update)
+                if key is None:
+                    self.create_task(self._process_queued(*item), update=update)
+                    continue
+                queue = self._serial_queues.get(key)
+                if queue is None:
+                    queue = self._serial_queues[key] = collections.deque()
+                    self.create_task(self._drain_serial(key, queue), update=update)
+                queue.append(item)
+            except asyncio.CancelledError:
+                # only Application.stop() (via _STOP_SIGNAL) may end this loop
+                logger.warning("Fetching updates got a CancelledError; ignoring it")
+
+    async def _drain_serial(self, key, queue):
+        """Process one user's queued updates in order; the worker ends when the queue is empty."""
+        try:
+            while queue:
+                await self._process_queued(*queue.popleft())
+        finally:
+            del self._serial_queues[key]
+
+    async def _process_queued(self, update, queued_at):
+        try:
+            async with self._concurrent_updates_sem:
+                await self.process_update(update, queued_at)
+        except Exception:
+            logger.exception("Error while processing update %s", getattr(update, "update_id", "?"))
+        finally:
+            self.update_queue.task_done()
+
+    async def update_persistence(self):
+        await super().update_persistence()
+        if self.persistence:
+            # SQLitePersistence only buffers the changes; write them as one batch per interval
+            await self.persistence.flush()
+
+    async def process_update(self, update, queued_at=None):
+        """Process one update; ``queued_at`` (perf_counter) counts the time it waited in its user's queue."""
+        start_time = time.perf_counter() if queued_at is None else queued_at
+        self.last_update_at = time.monotonic()
+        trace = start_trace(update)
+        # the trace (and UPDATE_LATENCY) also cover the wait in the user's queue
+        trace.started_at -= trace.start - start_time
+        trace.start = start_time
+        trace_token = current_trace.set(trace)
+        try:
+            waited = time.perf_counter() - start_time
+            if waited > 0.001:
+                trace.add("queue.wait", start_time, waited)
+            await super().process_update(update)
+        except asyncio.CancelledError:
+            # cancelled by abandon() at the shutdown deadline; _process_queued still marks the
+            # update as done, so Application.stop() does not wait for it forever
+            self.abandoned += 1
+            logger.warning("⚠️ Abandoned update %s at shutdown", getattr(update, 'update_id', '?'))
+            raise
+        finally:
+            UPDATE_LATENCY.observe(time.perf_counter() - start_time)
+            finish_trace(trace)
+            current_trace.reset(trace_token)
+            update_id = getattr(update, "update_id", None)
+            if update_id is not None:
+                note_update_offset(update_id)
+                if self.backlog:
+                    self.backlog.discard(update_id)
+                    if not self.backlog:
+                        self.backlog_drained.set()
+
+
+# ===============================
+# 📥 Catch-up of the update backlog
+# ===============================
+# Instead of starting with drop_pending_updates=True, updates that arrived while the bot
+# was down are fetched at start-up and handled, unless they are too old to be useful.
+# Telegram forgets an update once it is confirmed: by the next getUpdates offset when
+# polling, by the 200 reply (sent as soon as it is queued) for a webhook, and catch_up
+# confirms each backlog batch before it is processed. Updates still queued or running
+# when the process dies, or abandoned at the shutdown deadline, are therefore lost, not
+# handled again. The persisted offset only prevents double handling of what Telegram
+# does deliver again: it is a low-water mark, the highest update_id at or below which
+# every update has finished, and backlog updates at or below it are skipped. Updates
+# finish out of order (they are processed concurrently), so one that finished above the
+# mark is handled a second time if it comes back.
+CATCHUP = os.getenv("CATCHUP", "1") != "0"
+# oldest backlog update still handled, per kind, in seconds (Telegram keeps updates 24 h)
+CATCHUP_MAX_AGE = {
+    "start_get": float(os.getenv("CATCHUP_MAX_AGE_START", 86400)),  # deep links: always answer
+    "message": float(os.getenv("CATCHUP_MAX_AGE_MESSAGE", 3600)),
+    "callback_query": float(os.getenv("CATCHUP_MAX_AGE_CALLBACK", 300)),  # buttons of stale menus
+    "inline_query": 10,  # Telegram no longer accepts answers to older inline queries
+}
+UPDATE_OFFSET_FLUSH_INTERVAL = 10  # seconds
+# after a week without updates Telegram restarts update_ids at random, so an older offset is ignored
+UPDATE_OFFSET_MAX_AGE = 7 * 86400
+
+_last_update_id = 0  # highest finished update_id
+_updates_in_flight = set()  # update_ids fetched from the update queue and not finished yet
+_last_offset_flush = time.monotonic()
+
+
+def load_update_offset():
+    """Return ``(saved low-water mark, unix time it was saved)``; ``(0, 0)`` if unknown."""
+    try:
+        return int(get_setting("last_update_id", 0)), float(get_setting("last_update_at", 0))
+    except ValueError:
+        return 0, 0.0
+
+
+def note_update_started(update_id):
+    _updates_in_flight.add(update_id)
+
+
+def note_update_offset(update_id):
+    """Remember a processed update_id; the offset is written to the settings table every few seconds."""
+    global _last_update_id
+    _updates_in_flight.discard(update_id)
+    if update_id > _last_update_id:
+        _last_update_id = update_id
+    if time.monotonic() - _last_offset_flush >= UPDATE_OFFSET_FLUSH_INTERVAL:
+        flush_update_offset()
+
+
+def update_low_water_mark():
+    """Highest update_id such that it and every earlier update have finished.
+
+    Updates leave the queue in update_id order, so everything below the lowest one in
+    flight has finished (or was skipped by catch_up).
+    """
+    if _updates_in_flight:
+        return min(_updates_in_flight) - 1
+    return _last_update_id
+
+
+def flush_update_offset():
+    global _last_offset_flush
+    _last_offset_flush = time.monotonic()
+    offset = update_low_water_mark()
+    if offset <= 0:
+        return
+    try:
+        conn = db_connect()
+        conn.executemany(
+            "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+            [("last_update_id", str(offset)), ("last_update_at", str(int(time.time())))],
+        )
+        conn.commit()
+        conn.close()
+    except Exception:
+        logger.exception("Failed to save the update offset")
+
+
+def backlog_kind(update):
+    if update.callback_query:
+        return "callback_query"
+    if update.inline_query:
+        return "inline_query"
+    message = update.message
+    if message and message.text and message.text.startswith("/start get_"):
+        return "start_get"
+    return "message"
+
+
+def backlog_age(update, kind, now, offline_since):
+    """Age of a backlog update in seconds.
+
+    Messages carry their date. Callback and inline queries do not (a button's message
+    can be much older than the press), so they are assumed to be as old as the downtime.
+    """
+    undated = kind in ("callback_query", "inline_query")
+    message = update.effective_message
+    if not undated and message and message.date:
+        return now - message.date.timestamp()
+    if offline_since:
+        return now - offline_since
+    return float("inf") if undated else 0.0
+
+
+async def catch_up(application):
+    """Fetch the pending updates, queue the ones still worth handling; return the counts.
+
+    Must run after application.start() and before polling or the webhook is started.
+    The queued updates are processed concurrently like live ones; a background task
+    logs how long the backlog took to drain.
+    """
+    global _last_update_id
+    started = time.monotonic()
+    last_id, saved_at = load_update_offset()
+    if saved_at and time.time() - saved_at > UPDATE_OFFSET_MAX_AGE:
+        last_id = 0
+    _last_update_id = max(_last_update_id, last_id)
+    counts = collections.Counter()
+    offset = None  # not last_id + 1: an offset makes Telegram forget every earlier update
+    while not shutdown_requested.is_set():
+        updates = await application.bot.get_updates(
+            offset=offset, timeout=0, limit=100, allowed_updates=Update.ALL_TYPES,
+        )
+        if not updates:
+            break
+        now = time.time()
+        for update in updates:
+            if update.update_id <= last_id:
+                counts["duplicate"] += 1
+                continue
+            kind = backlog_kind(update)
+            if backlog_age(update, kind, now, saved_at) > CATCHUP_MAX_AGE[kind]:
+                counts[f"stale_{kind}"] += 1
+                continue
+            counts["queued"] += 1
+            application.backlog.add(update.update_id)
+            await application.update_queue.put(update)
+        # confirms this batch; the empty reply to the last call confirms everything
+        offset = updates[-1].update_id + 1
+    for outcome, value in counts.items():
+        BACKLOG_UPDATES.inc(outcome, amount=value)
+
+    fetched_in = time.monotonic() - started
+    logger.info("📥 Backlog: %s", ", ".join(f"{k}={v}" for k, v in sorted(counts.items())) or "empty")
+    if application.backlog:
+        application.create_task(_report_backlog_drain(application, started, counts["queued"]))
+    else:
+        BACKLOG_DRAIN.set(round(fetched_in, 3))
+    return counts
+
+
+async def _report_backlog_drain(application, started, queued):
+    await application.backlog_drained.wait()
+    elapsed = time.monotonic() - started
+    BACKLOG_DRAIN.set(round(elapsed, 3))
+    logger.info("📥 Backlog of %s update(s) drained in %.2fs", queued, elapsed)
+
+
+# ===============================
+# 💾 Persistence (user_data and conversations)
+# ===============================
+# user_data (newpost drafts, editing_post_id, awaiting_* flags, prev_menu, ...) and the
+# newpost conversation states are kept in the bot database, so a restart does not lose
+# half-finished work. PTB hands over the entries of the users that had updates every
+# PERSISTENCE_FLUSH_INTERVAL seconds; of those, only entries whose pickled value changed
+# are written, in one transaction. Users with empty user_data have no row at all.
+PERSISTENCE_FLUSH_INTERVAL = float(os.getenv("PERSISTENCE_FLUSH_INTERVAL", 10))
+
+
+def _data_digest(blob):
+    return hashlib.blake2b(blob, digest_size=16).digest()
+
+
+class _SQLitePersistence:
+    """BasePersistence on the bot's SQLite database that writes only changed entries."""
+
+    def __init__(self, update_interval=PERSISTENCE_FLUSH_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+            update_interval=update_interval,
+        )
+        self._digests = {}  # user_id -> digest of the value stored (or queued to be stored)
+        self._pending_users = {}  # user_id -> pickle, or None to delete the row
+        self._pending_states = {}  # (name, key JSON) -> state JSON, or None to delete the row
+
+    async def get_user_data(self):
+        conn = db_connect()
+        rows = conn.execute("SELECT user_id, data FROM user_data").fetchall()
+        conn.close()
+        user_data = {}
+        for user_id, blob in rows:
+            try:
+                user_data[user_id] = pickle.loads(blob)
+            except Exception:
+                logger.warning("💾 Dropping unreadable user_data of %s", user_id)
+                self._pending_users[user_id] = None
+                continue
+            self._digests[user_id] = _data_digest(blob)
+        return user_data
+
+    async def update_user_data(self, user_id, data):
+        if not data:
+            if user_id in self._digests:
+                del self._digests[user_id]
+                self._pending_users[user_id] = None
+            return
+        try:
+            blob = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            logger.warning("💾 user_data of %s cannot be stored: %s", user_id, e)
+            return
+        digest = _data_digest(blob)
+        if self._digests.get(user_id) != digest:
+            self._digests[user_id] = digest
+            self._pending_users[user_id] = blob
+
+    async def drop_user_data(self, user_id):
+        self._digests.pop(user_id, None)
+        self._pending_users[user_id] = None
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def get_conversations(self, name):
+        conn = db_connect()
+        rows = conn.execute("SELECT key, state FROM conversations WHERE name = ?", (name,)).fetchall()
+        conn.close()
+        return {tuple(json.loads(key)): json.loads(state) for key, state in rows}
+
+    async def update_conversation(self, name, key, new_state):
+        state = None if new_state is None else json.dumps(new_state)
+        self._pending_states[(name, json.dumps(list(key)))] = state
+
+    # chat_data, bot_data and callback_data are not stored
+    async def get_chat_data(self):
+        return {}
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def get_bot_data(self):
+        return {}
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_callback_data(self, data):
+        pass
+
+    def write_pending(self):
+        """Write the buffered changes in one transaction; returns the number of rows touched."""
+        users, self._pending_users = self._pending_users, {}
+        states, self._pending_states = self._pending_states, {}
+        if not users and not states:
+            return 0
+        conn = db_connect()
+        try:
+            conn.executemany(
+                "INSERT OR REPLACE INTO user_data (user_id, data, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)",
+                [(user_id, blob) for user_id, blob in users.items() if blob is not None],
+            )
+            conn.executemany("DELETE FROM user_data WHERE user_id = ?",
+                             [(user_id,) for user_id, blob in users.items() if blob is None])
+            conn.executemany(
+                "INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)",
+                [(name, key, state) for (name, key), state in states.items() if state is not None],
+            )
+            conn.executemany("DELETE FROM conversations WHERE name = ? AND key = ?",
+                             [(name, key) for (name, key), state in states.items() if state is None])
+            conn.commit()
+        except Exception:
+            logger.exception("💾 Failed to write persistence data")
+            # keep the changes for the next attempt, unless newer ones arrived meanwhile
+            self._pending_users = {**users, **self._pending_users}
+            self._pending_states = {**states, **self._pending_states}
+            return 0
+        finally:
+            conn.close()
+        PERSISTENCE_WRITES.inc("user_data", amount=len(users))
+        PERSISTENCE_WRITES.inc("conversations", amount=len(states))
+        return len(users) + len(states)
+
+    async def flush(self):
+        self.write_pending()
+
+
+def build_application():
+    """Build the Application and register every handler."""
+    request, get_updates_request = build_requests()
+    app = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .application_class(PerUserSerialApplication)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .base_url(BOT_API_BASE_URL)
+        .base_file_url(BOT_API_BASE_FILE_URL)
+        .request(request)
+        .get_updates_request(get_updates_request)
+        .rate_limiter(OutboundScheduler())
+        .persistence(SQLitePersistence())
+        .build()
+    )
+
+    # record user activity (last_seen) before any other handler runs
+    app.add_handler(TypeHandler(Update, track_user_activity), group=-1)
+
+    # basic commands
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("intro", send_intro))
+    app.add_handler(CommandHandler("stats", stats_bot))
+
+    # Conversation for creating new posts (moved into main)
+    newpost_conv = ConversationHandler(
+        entry_points=[
+            CommandHandler("newpost", newpost_start),
+            MessageHandler(filters.Regex(r"^🆕 پست جدید$"), newpost_start),
             MessageHandler(filters.Regex(r"^📣 سیگنال رایگان$"), newpost_start),
         ],
         states={
-            NP_MAIN: [MessageHandler(filters.ALL & ~filters.COMMAND, newpost_main)],
+            NP_MAIN: [CommandHandler("done", newpost_main_done), MessageHandler(filters.ALL & ~filters.COMMAND, newpost_main)],
             NP_INTRO: [MessageHandler(filters.ALL & ~filters.COMMAND, newpost_intro)],
             NP_TITLE: [MessageHandler(filters.TEXT & ~filters.COMMAND, newpost_title)],
             NP_DESC: [MessageHandler(filters.TEXT & ~filters.COMMAND, newpost_desc)],
@@ -2210,6 +4144,8 @@ def main():
         fallbacks=[CommandHandler("cancel", cancel)],
         per_chat=False,
         per_user=True,
+        name="newpost",
+        persistent=True,
     )
     app.add_handler(newpost_conv)
 
@@ -2217,55 +4153,63 @@ def main():
     app.add_handler(CommandHandler("listposts", list_posts))
     app.add_handler(CommandHandler("deletepost", delete_post))
     app.add_handler(CommandHandler("order_member", order_member))
+    app.add_handler(CommandHandler("segment", set_broadcast_segment))
+    app.add_handler(CommandHandler("slow", show_slow_updates))
+    app.add_handler(CommandHandler("importposts", import_posts))
+    app.add_handler(MessageHandler(filters.Document.ALL & filters.CaptionRegex(r"^/importposts\b"), import_posts))
+    app.add_handler(CommandHandler("exportposts", export_posts))
+    app.add_handler(CommandHandler("targets", publish_targets_command))
+    app.add_handler(CommandHandler("search", search_command))
+    app.add_handler(CommandHandler("schedule", schedule_command))
+    app.add_handler(CommandHandler("unschedule", unschedule_command))
+    app.add_handler(CommandHandler("expire", expire_command))
+    app.add_handler(CommandHandler("signals", signals_command))
+    app.add_handler(InlineQueryHandler(inline_query))
    
     # ===============================
     # ✅ Callback Query Handlers
     # ===============================
     app.add_handler(CallbackQueryHandler(broadcast_confirm_handler, pattern=r"^broadcast_confirm$"))
     app.add_handler(CallbackQueryHandler(broadcast_cancel_handler, pattern=r"^broadcast_cancel$"))
+    app.add_handler(CallbackQueryHandler(broadcast_segment_handler, pattern=r"^broadcast_seg_"))
     app.add_handler(CallbackQueryHandler(receive_get_callback, pattern=r"^receive_get_"))
     app.add_handler(CallbackQueryHandler(continue_get_callback, pattern=r"^continue_get_"))
 
     # add specific cancel_support_id callback handler (must be registered before generic handlers)
     app.add_handler(CallbackQueryHandler(cancel_support_id, pattern=r"^cancel_support_id$"))
 
-    app.add_handler(CallbackQueryHandler(menu_callback))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, menu_callback))
-
     # ===============================
-    # ✅ Broadcast Handlers
+    # ✅ ReplyKeyboard / Menu Handler
     # ===============================
-    app.add_handler(MessageHandler(filters.Regex("^ارسال به همه$"), broadcast_start))
-    app.add_handler(MessageHandler(filters.Regex("^❌ لغو ارسال به همه$"), broadcast_cancel_handler))
+    # menu_callback takes every remaining callback query and text message of group 0
+    # (menu texts such as "ارسال به همه" and signal_post_ buttons are routes of
+    # menu_routes), so nothing registered after these is reached for those updates.
+    app.add_handler(CallbackQueryHandler(menu_callback))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, menu_callback))
+    # other messages (e.g. a photo to broadcast) still reach the pending-input routes
     app.add_handler(MessageHandler(filters.ALL & ~filters.COMMAND, handle_menu))
 
-    # ===============================
-      # ===============================
-    # ✅ ReplyKeyboard / Menu Handler
-    # ===============================
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_menu))
-    app.add_handler(CallbackQueryHandler(continue_get_callback, pattern=r"^continue_get_"))
-    app.add_handler(ConversationHandler(
-        entry_points=[MessageHandler(filters.Regex("^🆕 ثبت سیگنال$"), newpost_start)],
-        states={
-            NP_MAIN: [MessageHandler(filters.ALL, newpost_main)],
-            NP_INTRO: [MessageHandler(filters.ALL, newpost_intro)],
-            NP_TITLE: [MessageHandler(filters.TEXT, newpost_title)],
-            NP_DESC: [MessageHandler(filters.TEXT, newpost_desc)],
-            NP_CHANNELS: [MessageHandler(filters.ALL, newpost_channels)],
-        },
-        fallbacks=[CommandHandler("cancel", cancel)],
-    ))
+    return app
 
 
-    app.add_handler(MessageHandler(filters.Regex(r"^\d+$"), set_signal))
-    app.add_handler(CallbackQueryHandler(set_signal_callback, pattern=r"^set_signal_"))
-    app.add_handler(CallbackQueryHandler(menu_callback, pattern=r"^signal_post_"))
+_application = None
 
-    # ===============================
-    # ✅ Run bot
-    # ===============================
-    app.run_polling()
+
+def get_application():
+    """The bot's single Application; built, and the database prepared, on first use.
+
+    Importing bot.py has no side effects: nothing touches the network, the database or
+    the event loop, and python-telegram-bot is not imported, until the runner (or a
+    script) asks for the Application.
+    """
+    global _application
+    if _application is None:
+        if not BOT_TOKEN:
+            raise ValueError("❌ BOT_TOKEN environment variable not set. Please define it before running the bot.")
+        load_telegram()
+        init_db()
+        _application = build_application()
+    return _application
 
 # ===============================
 # 📢 Broadcast handlers
@@ -2274,34 +4218,315 @@ def main():
 # ✅ نسخه جدید و تست‌شده برای ارسال به همه (Broadcast)
 # ============================================================
 
-def get_all_users():
-    """لیست تمام کاربران از دیتابیس را می‌گیرد"""
+# ------------------------------------------------------------
+# 🎯 Broadcast segments
+# ------------------------------------------------------------
+# A segment spec is a short string chosen by the admin:
+#   all            every user
+#   new:<days>     joined (first_seen) in the last N days
+#   active:<days>  active (last_seen) in the last N days
+#   post:<id>      users who requested post <id>
+#   unreached[:<broadcast_id>]  users of that broadcast's segment (default: the latest
+#                  broadcast) it has not reached yet
+# compile_segment() turns a spec into indexed SQL; recipients are then streamed page
+# by page with keyset pagination instead of loading every user id into memory.
+
+SEGMENT_PAGE_SIZE = 500
+
+SEGMENT_BUTTONS = [
+    ("👥 همه", "all"),
+    ("🆕 عضو ۷ روز اخیر", "new:7"),
+    ("🔥 فعال ۷ روز اخیر", "active:7"),
+    ("📭 دریافت‌نکرده‌ها", "unreached"),
+]
+
+
+def _utc_cutoff(days, now=None):
+    now = time.time() if now is None else now
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(now - days * 86400))
+
+
+def get_last_broadcast_id():
+    conn = db_connect()
+    row = conn.execute("SELECT MAX(id) FROM broadcasts").fetchone()
+    conn.close()
+    return row[0] if row else None
+
+
+def get_broadcast(broadcast_id):
+    """``(segment spec, created_at as unix time)`` of a broadcast, or None."""
+    conn = db_connect()
+    row = conn.execute("SELECT segment, created_at FROM broadcasts WHERE id = ?", (broadcast_id,)).fetchone()
+    conn.close()
+    if not row:
+        return None
+    return row[0] or "all", calendar.timegm(time.strptime(row[1], "%Y-%m-%d %H:%M:%S"))
+
+
+def _not_delivered(alias, broadcast_id):
+    """WHERE prefix (and its params) skipping users ``broadcast_id`` already reached."""
+    if not broadcast_id:
+        return "", ()
+    return (
+        "NOT EXISTS (SELECT 1 FROM broadcast_deliveries d "
+        f"WHERE d.broadcast_id = ? AND d.user_id = {alias}.user_id) AND "
+    ), (broadcast_id,)
+
+
+def compile_segment(spec, exclude_broadcast=None, now=None):
+    """Compile a segment spec into SQL. Raises ValueError for an unknown/invalid spec.
+
+    The result is a dict with the SQL needed to count the segment (index-only) and to
+    page through it ordered by an indexed key, plus a Persian label for the admin.
+    With ``exclude_broadcast``, users that broadcast already reached are left out;
+    ``now`` anchors the day windows of new:/active: (default: the current time).
+    """
+    spec = (spec or "all").strip().lower()
+    kind, _, arg = spec.partition(":")
+    cols = "u.user_id, u.username, u.first_seen"
+    if kind == "all":
+        skip, skip_params = _not_delivered("u", exclude_broadcast)
+        return {
+            "spec": "all", "label": "همه کاربران",
+            "count_sql": f"SELECT COUNT(*) FROM users u WHERE {skip}1" if skip else "SELECT COUNT(*) FROM users",
+            "count_params": skip_params,
+            "page_sql": f"SELECT {cols} FROM users u WHERE {skip}u.user_id > ? ORDER BY u.user_id LIMIT ?",
+            "params": skip_params, "key": "user_id",
+        }
+    if kind in ("new", "active"):
+        days = int(arg or 7)
+        if days <= 0:
+            raise ValueError("days must be positive")
+        col = "first_seen" if kind == "new" else "last_seen"
+        cutoff = _utc_cutoff(days, now)
+        label = f"عضو شده در {days} روز اخیر" if kind == "new" else f"فعال در {days} روز اخیر"
+        skip, skip_params = _not_delivered("u", exclude_broadcast)
+        return {
+            "spec": f"{kind}:{days}", "label": label,
+            "count_sql": f"SELECT COUNT(*) FROM users u WHERE {skip}u.{col} >= ?",
+            "count_params": skip_params + (cutoff,),
+            "page_sql": (
+                f"SELECT {cols}, u.{col} FROM users u WHERE {skip}u.{col} >= ? AND (u.{col}, u.user_id) > (?, ?) "
+                f"ORDER BY u.{col}, u.user_id LIMIT ?"
+            ),
+            "params": skip_params + (cutoff,), "key": col,
+        }
+    if kind == "post":
+        post_id = int(arg)
+        skip, skip_params = _not_delivered("r", exclude_broadcast)
+        return {
+            "spec": f"post:{post_id}", "label": f"درخواست‌کنندگان پست {post_id}",
+            "count_sql": f"SELECT COUNT(*) FROM post_requests r WHERE {skip}r.post_id = ?",
+            "count_params": skip_params + (post_id,),
+            "page_sql": (
+                f"SELECT {cols} FROM post_requests r JOIN users u ON u.user_id = r.user_id "
+                f"WHERE {skip}r.post_id = ? AND r.user_id > ? ORDER BY r.user_id LIMIT ?"
+            ),
+            "params": skip_params + (post_id,), "key": "user_id",
+        }
+    if kind == "unreached" and exclude_broadcast is None:
+        broadcast_id = int(arg) if arg else get_last_broadcast_id()
+        if not broadcast_id:
+            raise ValueError("no broadcast to resume")
+        broadcast = get_broadcast(broadcast_id)
+        if broadcast is None:
+            raise ValueError(f"broadcast {broadcast_id} not found")
+        original_spec, created_at = broadcast
+        # the original audience, as it was when the broadcast started, minus its deliveries
+        segment = compile_segment(original_spec, exclude_broadcast=broadcast_id, now=created_at)
+        segment.update({
+            "spec": f"unreached:{broadcast_id}",
+            "label": f"دریافت‌نکرده‌های ارسال #{broadcast_id} ({segment['label']})",
+            # deliveries of a resumed broadcast are recorded under the original id
+            "resume_id": broadcast_id,
+        })
+        return segment
+    raise ValueError(f"unknown segment: {spec}")
+
+
+def count_segment(segment):
+    """Segment size; every count query is answered from an index."""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-        cur.execute("SELECT user_id FROM users")
-        users = [row[0] for row in cur.fetchall()]
+        conn = db_connect()
+        row = conn.execute(segment["count_sql"], segment["count_params"]).fetchone()
         conn.close()
-        return users
-    except Exception as e:
-        logger.exception("get_all_users failed")
-        return []
+        return max(row[0] or 0, 0) if row else 0
+    except Exception:
+        logger.exception("count_segment failed")
+        return 0
+
+
+def iter_segment_users(segment, page_size=SEGMENT_PAGE_SIZE):
+    """Yield (user_id, username, first_seen) rows of a segment, one indexed page at a time.
+
+    Each page is a short query on a fresh connection, so a long broadcast never holds a
+    read transaction open while it is awaiting sends.
+    """
+    by_user_id = segment["key"] == "user_id"
+    last = (0,) if by_user_id else ("", 0)
+    while True:
+        conn = db_connect()
+        try:
+            rows = conn.execute(segment["page_sql"], segment["params"] + last + (page_size,)).fetchall()
+        finally:
+            conn.close()
+        for row in rows:
+            yield row[:3]
+        if len(rows) < page_size:
+            return
+        last = (rows[-1][0],) if by_user_id else (rows[-1][3], rows[-1][0])
+
+
+# ------------------------------------------------------------
+# 🧩 Broadcast templates
+# ------------------------------------------------------------
+# Broadcast text/captions may contain per-recipient placeholders, filled from the same
+# segment row used for iteration (no extra DB reads per user):
+#   {user_id}  {username}  {mention} (@username)  {joined} (join date)  {first_seen}
+# A fallback for empty values can follow a "|", e.g. {username|دوست عزیز}.
+# Braces that do not match a known placeholder are left untouched.
+
+TEMPLATE_FIELDS = {
+    "user_id": lambda row: str(row[0]),
+    "username": lambda row: row[1] or "",
+    "mention": lambda row: f"@{row[1]}" if row[1] else "",
+    "joined": lambda row: (row[2] or "")[:10],
+    "first_seen": lambda row: row[2] or "",
+}
+
+TEMPLATE_HELP = "متغیرهای قابل استفاده: {username} {mention} {user_id} {joined} — مثال: سلام {username|دوست عزیز}"
+
+_TEMPLATE_RE = re.compile(r"\{(" + "|".join(TEMPLATE_FIELDS) + r")(?:\|([^{}]*))?\}")
+
+
+def compile_broadcast_template(text):
+    """Compile a broadcast text once into a render(row) -> str function.
+
+    The template becomes a single %-format string plus a tuple of field getters, so
+    rendering per recipient is one tuple build and one string format.
+    """
+    if not text:
+        return lambda row: text
+    fmt_parts = []
+    getters = []
+    pos = 0
+    for m in _TEMPLATE_RE.finditer(text):
+        fmt_parts.append(text[pos:m.start()].replace("%", "%%"))
+        fmt_parts.append("%s")
+        getter = TEMPLATE_FIELDS[m.group(1)]
+        fallback = m.group(2)
+        if fallback is not None:
+            getter = (lambda g, fb: lambda row: g(row) or fb)(getter, fallback)
+        getters.append(getter)
+        pos = m.end()
+    if not getters:
+        # static text: nothing to render per recipient
+        return lambda row: text
+    fmt_parts.append(text[pos:].replace("%", "%%"))
+    fmt = "".join(fmt_parts)
+    getters = tuple(getters)
+    return lambda row: fmt % tuple(g(row) for g in getters)
+
+
+def create_broadcast(spec):
+    conn = db_connect()
+    cur = conn.cursor()
+    cur.execute("INSERT INTO broadcasts (segment) VALUES (?)", (spec,))
+    broadcast_id = cur.lastrowid
+    conn.commit()
+    conn.close()
+    return broadcast_id
+
+
+def record_broadcast_deliveries(broadcast_id, user_ids):
+    if not user_ids:
+        return
+    try:
+        conn = db_connect()
+        conn.executemany(
+            "INSERT OR IGNORE INTO broadcast_deliveries (broadcast_id, user_id) VALUES (?, ?)",
+            [(broadcast_id, uid) for uid in user_ids],
+        )
+        conn.commit()
+        conn.close()
+    except Exception:
+        logger.exception("Failed to record broadcast deliveries")
+
+
+def broadcast_confirm_markup(selected):
+    """Confirm/cancel buttons plus one button per predefined segment."""
+    seg_buttons = [
+        InlineKeyboardButton(("✔️ " if spec == selected else "") + label, callback_data=f"broadcast_seg_{spec}")
+        for label, spec in SEGMENT_BUTTONS
+    ]
+    return InlineKeyboardMarkup([
+        seg_buttons[:2],
+        seg_buttons[2:],
+        [InlineKeyboardButton("✅ بله، ارسال کن", callback_data="broadcast_confirm"),
+         InlineKeyboardButton("❌ خیر، لغو شود", callback_data="broadcast_cancel")],
+    ])
+
+
+def broadcast_confirm_text(context):
+    """Confirmation prompt showing the selected segment and its size."""
+    segment = compile_segment(context.user_data.get("broadcast_segment", "all"))
+    total = count_segment(segment)
+    message = context.user_data.get("broadcast_message")
+    preview = (getattr(message, "text", None) or getattr(message, "caption", None) or "") if message else ""
+    return (
+        f"آیا مطمئن هستید که این پیام برای «{segment['label']}» ({total} کاربر) ارسال شود؟\n"
+        f"برای مخاطبان دیگر از /segment استفاده کنید (مثلاً /segment post:12).\n\n{preview}"
+    )
+
+
+@timed
+async def broadcast_segment_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin picked a segment button on the broadcast confirmation message."""
+    query = update.callback_query
+    if not query.from_user or query.from_user.username not in ADMINS:
+        await query.answer()
+        return
+    spec = query.data.split("broadcast_seg_", 1)[1]
+    try:
+        segment = compile_segment(spec)
+    except ValueError:
+        await query.answer("⚠️ این گروه در دسترس نیست.", show_alert=True)
+        return
+    await query.answer()
+    context.user_data["broadcast_segment"] = segment["spec"]
+    try:
+        await query.edit_message_text(broadcast_confirm_text(context), reply_markup=broadcast_confirm_markup(spec))
+    except Exception:
+        pass
 
 
-async def broadcast_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """شروع ارسال همگانی برای ادمین"""
-    user = update.effective_user
-    chat_id = update.effective_chat.id if update.effective_chat else None
-    if not user or getattr(user, "username", None) not in ADMINS:
-        if chat_id:
-            await context.bot.send_message(chat_id=chat_id, text="❌ فقط ادمین اجازه ارسال دارد.")
+@timed
+async def set_broadcast_segment(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/segment <spec> — choose the audience of the pending broadcast."""
+    if not (update.effective_user and update.effective_user.username in ADMINS):
+        await update.message.reply_text("❌ ✨ Unauthorized. ✨")
         return
-
-    await context.bot.send_message(chat_id=chat_id, text="📨 لطفاً پیام مورد نظر خود را بفرستید تا به همه ارسال شود.")
-    context.user_data["awaiting_broadcast_text"] = True
-    return
+    if not context.args:
+        await update.message.reply_text(
+            "✨ Usage: /segment all | new:<days> | active:<days> | post:<id> | unreached[:<broadcast_id>] ✨"
+        )
+        return
+    try:
+        segment = compile_segment(context.args[0])
+    except ValueError:
+        await update.message.reply_text("❌ گروه مخاطب نامعتبر است.")
+        return
+    context.user_data["broadcast_segment"] = segment["spec"]
+    if context.user_data.get("broadcast_message"):
+        await update.message.reply_text(
+            broadcast_confirm_text(context), reply_markup=broadcast_confirm_markup(segment["spec"])
+        )
+    else:
+        total = count_segment(segment)
+        await update.message.reply_text(f"✅ مخاطبان ارسال بعدی: «{segment['label']}» ({total} کاربر)")
 
 
+@timed
 async def broadcast_receive_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """دریافت هر نوع پیام از ادمین برای ارسال به همه (متن، عکس، ویدیو، فایل و ...)"""
     if not context.user_data.get("awaiting_broadcast_text"):
@@ -2314,78 +4539,130 @@ async def broadcast_receive_text(update: Update, context: ContextTypes.DEFAULT_T
     context.user_data["broadcast_message"] = message
     context.user_data.pop("awaiting_broadcast_text", None)
 
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("✅ بله، ارسال کن", callback_data="broadcast_confirm"),
-         InlineKeyboardButton("❌ لغو شود", callback_data="broadcast_cancel")]
-    ])
+    context.user_data.setdefault("broadcast_segment", "all")
     await context.bot.send_message(
         chat_id=chat_id,
-        text="آیا مطمئن هستید که می‌خواهید این پیام را برای همه ارسال کنید؟",
-        reply_markup=kb
+        text=broadcast_confirm_text(context),
+        reply_markup=broadcast_confirm_markup(context.user_data["broadcast_segment"])
     )
 
 
 
+@timed
 async def broadcast_confirm_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """ارسال پیام (هر نوعی) به همه کاربران و نمایش گزارش"""
     query = update.callback_query
     await query.answer()
 
+    if not query.from_user or query.from_user.username not in ADMINS:
+        return
+
     message = context.user_data.get("broadcast_message")
     if not message:
         await query.edit_message_text("❌ هیچ پیامی برای ارسال وجود ندارد.")
         return
 
-    users = get_all_users()
+    try:
+        segment = compile_segment(context.user_data.get("broadcast_segment", "all"))
+    except ValueError:
+        await query.edit_message_text("❌ گروه مخاطب نامعتبر است.")
+        return
+    total = count_segment(segment)
+    broadcast_id = segment.get("resume_id") or create_broadcast(segment["spec"])
+    context.user_data.pop("broadcast_message", None)
+    context.user_data.pop("broadcast_segment", None)
+
+    status_msg = await query.edit_message_text(f"📨 در حال ارسال پیام به {total} کاربر ({segment['label']})...")
+
+    # the send loop runs in the background so the admin's own later updates (which are
+    # processed in order per user) are not held up for the whole broadcast
+    context.application.create_task(
+        run_broadcast(context.bot, query.from_user.id, status_msg, message, segment, broadcast_id, total),
+        update=update,
+    )
+
+
+@timed
+async def run_broadcast(bot, admin_chat_id, status_msg, message, segment, broadcast_id, total):
+    """Send one broadcast to every recipient of a segment and report to the admin."""
     success = 0
     failed = 0
-    total = len(users)
-
-    status_msg = await query.edit_message_text(f"📨 در حال ارسال پیام به {total} کاربر...")
+    delivered = []
 
-    for i, uid in enumerate(users, start=1):
-        try:
-            if message.text:
-                await context.bot.send_message(chat_id=uid, text=message.text)
-            elif message.photo:
-                await context.bot.send_photo(chat_id=uid, photo=message.photo[-1].file_id, caption=message.caption or "")
-            elif message.video:
-                await context.bot.send_video(chat_id=uid, video=message.video.file_id, caption=message.caption or "")
-            elif message.document:
-                await context.bot.send_document(chat_id=uid, document=message.document.file_id, caption=message.caption or "")
-            elif message.audio:
-                await context.bot.send_audio(chat_id=uid, audio=message.audio.file_id, caption=message.caption or "")
-            elif message.voice:
-                await context.bot.send_voice(chat_id=uid, voice=message.voice.file_id, caption=message.caption or "")
-            elif message.sticker:
-                await context.bot.send_sticker(chat_id=uid, sticker=message.sticker.file_id)
-            else:
-                failed += 1
-                continue
+    interrupted = False
+    # this task's Bot API calls use the bulk connection pool
+    request_lane.set("bulk")
+    # the task outlives the admin's update: do not keep adding spans to its trace
+    current_trace.set(None)
 
-            success += 1
-        except Exception:
-            failed += 1
-            continue
+    # compiled once per broadcast, rendered per recipient from the segment row
+    render = compile_broadcast_template(message.text or message.caption or "")
 
-        if i % 50 == 0:
+    try:
+        for i, row in enumerate(iter_segment_users(segment), start=1):
+            if shutdown_requested.is_set():
+                interrupted = True
+                break
+            uid = row[0]
             try:
-                await status_msg.edit_text(f"📨 در حال ارسال... {i}/{total}\n✅ موفق: {sent} | 🚫 خطا: {failed}")
-            except Exception:
-                pass
+                if message.text:
+                    await bot.send_message(chat_id=uid, text=render(row))
+                elif message.photo:
+                    await bot.send_photo(chat_id=uid, photo=message.photo[-1].file_id, caption=render(row))
+                elif message.video:
+                    await bot.send_video(chat_id=uid, video=message.video.file_id, caption=render(row))
+                elif message.document:
+                    await bot.send_document(chat_id=uid, document=message.document.file_id, caption=render(row))
+                elif message.audio:
+                    await bot.send_audio(chat_id=uid, audio=message.audio.file_id, caption=render(row))
+                elif message.voice:
+                    await bot.send_voice(chat_id=uid, voice=message.voice.file_id, caption=render(row))
+                elif message.sticker:
+                    await bot.send_sticker(chat_id=uid, sticker=message.sticker.file_id)
+                else:
+                    failed += 1
+                    continue
 
-        await asyncio.sleep(0.05)
+                success += 1
+                delivered.append(uid)
+            except Exception:
+                failed += 1
+                continue
 
-    report = (
-        f"✅ گزارش نهایی:\n\n"
-        f"📨 موفق: {success}\n"
-        f"🚫 ناموفق: {failed}\n"
-        f"👥 کل کاربران: {total}"
-    )
-    await context.bot.send_message(chat_id=query.from_user.id, text=report)
-    context.user_data.pop("broadcast_message", None)
+            if i % 50 == 0:
+                record_broadcast_deliveries(broadcast_id, delivered)
+                delivered = []
+                try:
+                    await status_msg.edit_text(f"📨 در حال ارسال... {i}/{total}\n✅ موفق: {success} | 🚫 خطا: {failed}")
+                except Exception:
+                    pass
+    except asyncio.CancelledError:
+        logger.warning("⚠️ Broadcast #%s abandoned at shutdown after %s/%s recipients", broadcast_id, success + failed, total)
+        raise
+    finally:
+        # also runs when the task is cancelled, so the "unreached" segment stays accurate
+        record_broadcast_deliveries(broadcast_id, delivered)
+
+    if interrupted:
+        logger.info("⏸ Broadcast #%s paused for shutdown after %s/%s recipients", broadcast_id, success + failed, total)
+        report = (
+            f"⏸ ارسال #{broadcast_id} به دلیل راه‌اندازی مجدد ربات متوقف شد.\n\n"
+            f"📨 موفق: {success}\n"
+            f"🚫 ناموفق: {failed}\n"
+            f"👥 کل کاربران: {total}\n\n"
+            f"▶️ برای ادامه: /segment unreached:{broadcast_id}"
+        )
+    else:
+        report = (
+            f"✅ گزارش نهایی (ارسال #{broadcast_id}):\n\n"
+            f"📨 موفق: {success}\n"
+            f"🚫 ناموفق: {failed}\n"
+            f"👥 کل کاربران: {total}"
+        )
+    await bot.send_message(chat_id=admin_chat_id, text=report)
 
 
+@timed
 async def broadcast_cancel_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """لغو ارسال همگانی"""
     query = update.callback_query
@@ -2393,101 +4670,866 @@ async def broadcast_cancel_handler(update: Update, context: ContextTypes.DEFAULT
     chat_id = query.from_user.id
     await context.bot.send_message(chat_id=chat_id, text="❌ ارسال پیام به همه لغو شد.")
     context.user_data.pop("broadcast_message", None)
+    context.user_data.pop("broadcast_segment", None)
     context.user_data.pop("awaiting_broadcast_text", None)
 
 # ============================================================
-import os
-import asyncio
-from aiohttp import web
+# 📤 Publishing posts to channels
+# ============================================================
+# A saved post is published (its intro with the "📥 Receive" deep link) to every
+# publish target at once. The sends run concurrently on the bulk lane, so the
+# OutboundScheduler paces them against the global and per-channel limits, and user
+# replies still go first. Every published message is recorded in post_messages
+# (as are the previews and listings sent to admins), so later edits can reach it.
+# Previews sent to users in private chats (free signals, popular posts) are not: they
+# are sent on every tap, and editing each of them would cost one API call per user.
+# Targets are kept in the "publish_targets" setting (managed with /targets);
+# PUBLISH_TARGETS (comma-separated @channels or chat ids) is used until it is set.
+PUBLISH_TARGETS = os.getenv("PUBLISH_TARGETS", "")
+PUBLISH_CONCURRENCY = int(os.getenv("PUBLISH_CONCURRENCY", 10))
+
+
+def parse_chat_ref(text):
+    """"-100123" -> -100123, "@name" / "name" / "t.me/name" -> "@name"."""
+    text = text.strip()
+    if text.lstrip("-").isdigit():
+        return int(text)
+    username = re.sub(r"^(?:https?://)?(?:t\.me/|@)", "", text)
+    if not re.fullmatch(r"[A-Za-z0-9_]{4,}", username):
+        raise ValueError(f"شناسه کانال نامعتبر است: {text}")
+    return "@" + username
+
+
+def get_publish_targets():
+    stored = get_setting("publish_targets")
+    if stored is not None:
+        return json.loads(stored)
+    return [parse_chat_ref(item) for item in PUBLISH_TARGETS.split(",") if item.strip()]
+
+
+def set_publish_targets(targets):
+    set_setting("publish_targets", json.dumps(targets))
+
+
+def record_post_messages(sent, kind="preview"):
+    """Store the messages posts were sent as, from ``[(post_id, Message), ...]``."""
+    if not sent:
+        return
+    try:
+        conn = db_connect()
+        conn.executemany(
+            "INSERT OR IGNORE INTO post_messages (post_id, chat_id, message_id, kind, media) VALUES (?, ?, ?, ?, ?)",
+            [(post_id, m.chat_id, m.message_id, kind, int(bool(m.photo or m.document))) for post_id, m in sent],
+        )
+        conn.commit()
+        conn.close()
+    except Exception:
+        logger.exception("Failed to record messages of posts %s", sorted({post_id for post_id, _m in sent}))
+
+
+async def publish_post_to_chat(bot, chat_id, post_id):
+    """Publish a post's preview (intro + "📥 Receive" deep link) to a chat or channel; returns the Message."""
+    post = get_post_db(post_id)
+    if not post:
+        raise ValueError(f"post {post_id} not found")
+    cap, _channels = decode_post(post, untitled="بدون عنوان")
+    message = await send_post_preview(bot, chat_id, post_id, cap, bot.username)
+    record_post_messages([(post_id, message)])
+    return message
+
+
+async def publish_post_to_targets(bot, post_id, targets):
+    """Publish a post to all targets concurrently; returns {target: Message or the exception}."""
+    post = get_post_db(post_id)
+    if not post:
+        raise ValueError(f"post {post_id} not found")
+    cap, _channels = decode_post(post, untitled="بدون عنوان")
+    limit = asyncio.Semaphore(PUBLISH_CONCURRENCY)
+
+    async def publish(target):
+        request_lane.set("bulk")  # each gathered coroutine runs in its own task/context
+        async with limit:
+            try:
+                return await send_post_preview(bot, target, post_id, cap, bot.username)
+            except Exception as e:
+                logger.warning("📤 Publishing post %s to %s failed: %s", post_id, target, e)
+                return e
+
+    outcomes = await asyncio.gather(*(publish(target) for target in targets))
+    results = dict(zip(targets, outcomes))
+    sent = [(post_id, m) for m in outcomes if not isinstance(m, Exception)]
+    record_post_messages(sent)
+    PUBLISHED_MESSAGES.inc("sent", amount=len(sent))
+    PUBLISHED_MESSAGES.inc("failed", amount=len(targets) - len(sent))
+    return results
+
+
+def publish_summary(post_id, results):
+    failed = {target: e for target, e in results.items() if isinstance(e, Exception)}
+    lines = [f"📤 انتشار پست {post_id} در {len(results)} مقصد: ✅ {len(results) - len(failed)} موفق، ❌ {len(failed)} ناموفق"]
+    lines += [f"• {target}: {e}" for target, e in failed.items()]
+    return "\n".join(lines)
+
+
+async def publish_targets_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/targets [add|remove <@channel|chat_id>] — manage where new posts are published (admins only)."""
+    if not (update.effective_user and update.effective_user.username in ADMINS):
+        await update.message.reply_text("❌ ✨ Unauthorized. ✨")
+        return
+    args = context.args or []
+    targets = get_publish_targets()
+    if len(args) == 2 and args[0] in ("add", "remove"):
+        try:
+            target = parse_chat_ref(args[1])
+        except ValueError as e:
+            await update.message.reply_text(f"❌ {e}")
+            return
+        if args[0] == "add" and target not in targets:
+            targets.append(target)
+        elif args[0] == "remove" and target in targets:
+            targets.remove(target)
+        set_publish_targets(targets)
+    elif args:
+        await update.message.reply_text("❌ استفاده: /targets [add|remove <@کانال یا chat_id>]")
+        return
+    listing = "\n".join(f"• {target}" for target in targets) or "— (پست‌های جدید در هیچ کانالی منتشر نمی‌شوند)"
+    await update.message.reply_text(f"📤 مقصدهای انتشار:\n{listing}\n\nربات باید در هر کانال ادمین باشد.")
+
+
+# ============================================================
+# 🔄 Updating sent messages after a post edit
+# ============================================================
+# When an admin edits a post's title, description or channels, the messages recorded
+# for it in post_messages are re-rendered and edited in place: previews (channel
+# posts, admin previews) show the title, the admin "details" messages show all three
+# fields, so only the messages showing the edited field are touched. The edits run in a background task on the bulk lane, EDIT_CONCURRENCY at
+# a time, paced by the OutboundScheduler; the admin gets one summary at the end.
+# Messages that no longer exist (deleted, bot removed from the chat) are forgotten.
+EDIT_CONCURRENCY = int(os.getenv("EDIT_CONCURRENCY", 10))
+EDIT_FIELDS_SHOWN = {"preview": ("title",), "details": ("title", "description", "channels")}
+
+
+async def edit_post_message(bot, chat_id, message_id, media, text, reply_markup, parse_mode=None):
+    """Replace the caption (media) or text of a sent message."""
+    if not media:
+        try:
+            return await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text,
+                                               reply_markup=reply_markup, parse_mode=parse_mode)
+        except BadRequest as e:
+            # rows recorded before post_messages.media existed are all media=0
+            if "no text in the message" not in str(e).lower():
+                raise
+    return await bot.edit_message_caption(chat_id=chat_id, message_id=message_id, caption=text,
+                                          reply_markup=reply_markup, parse_mode=parse_mode)
+
+
+@timed
+async def propagate_post_edit(bot, post_id, field, report_chat_id=None):
+    """Edit every recorded message of a post that shows ``field``; returns the count per outcome."""
+    request_lane.set("bulk")
+    # runs after the admin's update was handled: do not add spans to its trace
+    current_trace.set(None)
+    kinds = [kind for kind, fields in EDIT_FIELDS_SHOWN.items() if field in fields]
+    conn = db_connect()
+    rows = conn.execute(
+        f"SELECT chat_id, message_id, kind, media FROM post_messages "
+        f"WHERE post_id = ? AND kind IN ({', '.join('?' * len(kinds))})",
+        (post_id, *kinds),
+    ).fetchall()
+    conn.close()
+    post = get_post_db(post_id)
+    counts = {"edited": 0, "unchanged": 0, "gone": 0, "failed": 0}
+    if not rows or not post:
+        return counts
+
+    cap, channels = decode_post(post, untitled="بدون عنوان")
+    caption_html, text_html, preview_kb = preview_content(post_id, cap, bot.username)
+    details = post_details_caption(post_id, cap, channels)
+    details_kb = post_details_keyboard(post_id)
+    limit = asyncio.Semaphore(EDIT_CONCURRENCY)
+    gone = []
+
+    async def edit(chat_id, message_id, kind, media):
+        if kind == "details":
+            content = (details, details_kb, None)
+        else:
+            content = (caption_html if media else text_html, preview_kb, "HTML")
+        async with limit:
+            try:
+                await edit_post_message(bot, chat_id, message_id, media, *content)
+                return "edited"
+            except BadRequest as e:
+                reason = str(e).lower()
+                if "not modified" in reason:
+                    return "unchanged"
+                if "not found" in reason or "can't be edited" in reason:
+                    gone.append((chat_id, message_id))
+                    return "gone"
+                logger.warning("🔄 Updating message %s/%s of post %s failed: %s", chat_id, message_id, post_id, e)
+                return "failed"
+            except Forbidden:
+                gone.append((chat_id, message_id))
+                return "gone"
+            except Exception as e:
+                logger.warning("🔄 Updating message %s/%s of post %s failed: %s", chat_id, message_id, post_id, e)
+                return "failed"
+
+    for outcome in await asyncio.gather(*(edit(*row) for row in rows)):
+        counts[outcome] += 1
+    for outcome, amount in counts.items():
+        POST_EDIT_MESSAGES.inc(outcome, amount=amount)
+    if gone:
+        conn = db_connect()
+        conn.executemany("DELETE FROM post_messages WHERE post_id = ? AND chat_id = ? AND message_id = ?",
+                         [(post_id, chat_id, message_id) for chat_id, message_id in gone])
+        conn.commit()
+        conn.close()
+
+    if report_chat_id:
+        try:
+            await bot.send_message(chat_id=report_chat_id, text=post_edit_summary(post_id, len(rows), counts))
+        except Exception:
+            logger.exception("Could not send the edit summary of post %s", post_id)
+    return counts
+
+
+def post_edit_summary(post_id, total, counts):
+    return (
+        f"🔄 به‌روزرسانی {total} پیام ارسال‌شده‌ی پست {post_id}:\n"
+        f"✅ ویرایش شد: {counts['edited']}\n"
+        f"➖ بدون تغییر: {counts['unchanged']}\n"
+        f"🗑 دیگر وجود ندارد: {counts['gone']}\n"
+        f"❌ ناموفق: {counts['failed']}"
+    )
+
+
+# ============================================================
+# ⏰ Scheduled jobs (timed publishing, signal rotation)
+# ============================================================
+# Jobs live in the scheduled_jobs table and survive restarts. JobScheduler keeps the
+# pending ones in a min-heap of (run_at, id) and sleeps until the earliest is due, so
+# tens of thousands of pending jobs cost one timer, not one poll each. Adding an
+# earlier job wakes the timer. At start-up jobs that fell due during downtime run
+# right away, oldest first, except:
+#   - of several missed signal rotations only the latest runs (the others are skipped);
+#   - posts more than SCHEDULE_MAX_LATE late are marked missed instead of published.
+# A job that was running when the process died is still pending and runs again.
+SCHEDULE_TIMEZONE = os.getenv("SCHEDULE_TIMEZONE", "Asia/Tehran")  # for times typed in /schedule
+SCHEDULE_MAX_LATE = float(os.getenv("SCHEDULE_MAX_LATE", 6 * 3600))  # seconds
+SCHEDULE_LIST_LIMIT = 20
+
+job_scheduler = None  # the running JobScheduler (set by serve())
+
+
+def schedule_timezone():
+    try:
+        return ZoneInfo(SCHEDULE_TIMEZONE)
+    except (ZoneInfoNotFoundError, ValueError):
+        logger.warning("Unknown SCHEDULE_TIMEZONE %r, using UTC", SCHEDULE_TIMEZONE)
+        return timezone.utc
+
+
+def parse_schedule_time(text, now=None):
+    """Unix time for "+30m" / "+2h" / "+1d" or "YYYY-MM-DD HH:MM" (SCHEDULE_TIMEZONE)."""
+    now = time.time() if now is None else now
+    relative = re.fullmatch(r"\+(\d+)([mhd])", text)
+    if relative:
+        return now + int(relative.group(1)) * {"m": 60, "h": 3600, "d": 86400}[relative.group(2)]
+    try:
+        moment = datetime.strptime(text, "%Y-%m-%d %H:%M")
+    except ValueError:
+        raise ValueError("زمان نامعتبر است")
+    return moment.replace(tzinfo=schedule_timezone()).timestamp()
+
+
+def format_schedule_time(run_at):
+    return datetime.fromtimestamp(run_at, schedule_timezone()).strftime("%Y-%m-%d %H:%M")
+
+
+def schedule_job(run_at, kind, payload):
+    """Store a job and hand it to the running scheduler; returns the job id."""
+    if kind not in SCHEDULED_JOB_KINDS:
+        raise ValueError(f"unknown job kind {kind!r}")
+    conn = db_connect()
+    cur = conn.execute(
+        "INSERT INTO scheduled_jobs (run_at, kind, payload) VALUES (?, ?, ?)",
+        (run_at, kind, json.dumps(payload)),
+    )
+    job_id = cur.lastrowid
+    conn.commit()
+    conn.close()
+    if job_scheduler:
+        job_scheduler.push(run_at, job_id)
+    return job_id
+
+
+def cancel_job(job_id):
+    """Cancel a pending job; its heap entry is dropped when it comes due. Returns True if cancelled."""
+    conn = db_connect()
+    cur = conn.execute("UPDATE scheduled_jobs SET status = 'cancelled' WHERE id = ? AND status = 'pending'", (job_id,))
+    conn.commit()
+    conn.close()
+    return cur.rowcount > 0
+
+
+def finish_job(job_id, status, error=None):
+    conn = db_connect()
+    conn.execute(
+        "UPDATE scheduled_jobs SET status = ?, error = ?, finished_at = CURRENT_TIMESTAMP WHERE id = ?",
+        (status, error, job_id),
+    )
+    conn.commit()
+    conn.close()
+
+
+def pending_jobs(limit=SCHEDULE_LIST_LIMIT):
+    conn = db_connect()
+    rows = conn.execute(
+        "SELECT id, run_at, kind, payload FROM scheduled_jobs WHERE status = 'pending' ORDER BY run_at LIMIT ?",
+        (limit,),
+    ).fetchall()
+    conn.close()
+    return rows
+
+
+async def _run_publish_job(bot, payload):
+    await publish_post_to_chat(bot, payload["chat_id"], payload["post_id"])
+
+
+async def _run_rotate_job(bot, payload):
+    if not get_post_db(payload["post_id"]):
+        raise ValueError(f"post {payload['post_id']} not found")
+    activate_signal(payload["post_id"])
+    logger.info("⏰ Free signal rotated to post %s", payload["post_id"])
+
+
+SCHEDULED_JOB_KINDS = {
+    "publish_post": _run_publish_job,
+    "rotate_signal": _run_rotate_job,
+}
+
+
+class JobScheduler:
+    """Runs scheduled_jobs rows at their time with one timer over a min-heap."""
+
+    def __init__(self, application):
+        self.application = application
+        self._heap = []  # (run_at, job_id); cancelled jobs are skipped when popped
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def load(self):
+        """Read every pending job into the heap, settling missed ones; returns the counts."""
+        now = time.time()
+        conn = db_connect()
+        rows = conn.execute(
+            "SELECT id, run_at, kind FROM scheduled_jobs WHERE status = 'pending' ORDER BY run_at"
+        ).fetchall()
+        superseded = [job_id for job_id, run_at, kind in rows if kind == "rotate_signal" and run_at <= now]
+        superseded = set(superseded[:-1])  # only the latest missed rotation matters
+        expired = {job_id for job_id, run_at, kind in rows if kind == "publish_post" and run_at < now - SCHEDULE_MAX_LATE}
+        conn.executemany(
+            "UPDATE scheduled_jobs SET status = ?, finished_at = CURRENT_TIMESTAMP WHERE id = ?",
+            [("skipped", job_id) for job_id in superseded] + [("missed", job_id) for job_id in expired],
+        )
+        conn.commit()
+        conn.close()
+        self._heap = [(run_at, job_id) for job_id, run_at, kind in rows if job_id not in superseded and job_id not in expired]
+        heapq.heapify(self._heap)
+        SCHEDULED_PENDING.set(len(self._heap))
+        overdue = sum(1 for run_at, _job_id in self._heap if run_at <= now)
+        return {"pending": len(self._heap), "overdue": overdue, "skipped": len(superseded), "missed": len(expired)}
+
+    def start(self):
+        counts = self.load()
+        logger.info("⏰ Scheduler: %s", ", ".join(f"{k}={v}" for k, v in counts.items()))
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    def push(self, run_at, job_id):
+        heapq.heappush(self._heap, (run_at, job_id))
+        SCHEDULED_PENDING.set(len(self._heap))
+        if self._heap[0][1] == job_id:
+            self._wakeup.set()  # new earliest job: re-arm the timer
+
+    async def _run(self):
+        while True:
+            now = time.time()
+            while self._heap and self._heap[0][0] <= now:
+                _run_at, job_id = heapq.heappop(self._heap)
+                # started in due order; a slow publish does not hold up the timer
+                self.application.create_task(self._execute(job_id))
+            SCHEDULED_PENDING.set(len(self._heap))
+            self._wakeup.clear()
+            timeout = self._heap[0][0] - now if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _execute(self, job_id):
+        # background work: bulk connection pool, no trace of the update that scheduled it
+        request_lane.set("bulk")
+        current_trace.set(None)
+        conn = db_connect()
+        row = conn.execute("SELECT kind, payload, status FROM scheduled_jobs WHERE id = ?", (job_id,)).fetchone()
+        conn.close()
+        if not row or row[2] != "pending":
+            return  # cancelled (or already run) after it was queued
+        kind, payload, _status = row
+        try:
+            await SCHEDULED_JOB_KINDS[kind](self.application.bot, json.loads(payload))
+        except Exception as e:
+            logger.warning("⏰ Scheduled job %s (%s) failed: %s", job_id, kind, e)
+            finish_job(job_id, "failed", str(e))
+            SCHEDULED_JOBS.inc(kind, "failed")
+        else:
+            finish_job(job_id, "done")
+            SCHEDULED_JOBS.inc(kind, "done")
+
+
+def describe_job(kind, payload):
+    payload = json.loads(payload)
+    if kind == "publish_post":
+        return f"انتشار پست {payload['post_id']} در {payload['chat_id']}"
+    if kind == "rotate_signal":
+        return f"سیگنال رایگان ← پست {payload['post_id']}"
+    return kind
+
+
+SCHEDULE_USAGE = (
+    "⏰ زمان‌بندی:\n"
+    "/schedule <زمان> post <شناسه پست> <@کانال یا chat_id>\n"
+    "/schedule <زمان> signal <شناسه پست>\n"
+    "/unschedule <شناسه کار>\n\n"
+    f"زمان: «YYYY-MM-DD HH:MM» ({SCHEDULE_TIMEZONE}) یا نسبی مثل +30m، +2h، +1d"
+)
+
+
+@timed
+async def schedule_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/schedule — list pending jobs, or schedule a post publish / signal rotation (admins only)."""
+    if not (update.effective_user and update.effective_user.username in ADMINS):
+        await update.message.reply_text("❌ ✨ Unauthorized. ✨")
+        return
+    args = context.args or []
+    if not args:
+        rows = pending_jobs()
+        lines = [f"#{job_id} — {format_schedule_time(run_at)} — {describe_job(kind, payload)}" for job_id, run_at, kind, payload in rows]
+        await update.message.reply_text(("\n".join(lines) or "✨ کاری در صف نیست.") + "\n\n" + SCHEDULE_USAGE)
+        return
+
+    # "YYYY-MM-DD HH:MM" spans two arguments
+    when, rest = (" ".join(args[:2]), args[2:]) if not args[0].startswith("+") else (args[0], args[1:])
+    try:
+        run_at = parse_schedule_time(when)
+        action = rest[0] if rest else ""
+        if action == "post" and len(rest) == 3:
+            kind, payload = "publish_post", {"post_id": int(rest[1]), "chat_id": parse_chat_ref(rest[2])}
+        elif action == "signal" and len(rest) == 2:
+            kind, payload = "rotate_signal", {"post_id": int(rest[1])}
+        else:
+            raise ValueError("دستور نامعتبر است")
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e}\n\n{SCHEDULE_USAGE}")
+        return
+    if not get_post_db(payload["post_id"]):
+        await update.message.reply_text("❌ پست یافت نشد.")
+        return
+    if run_at <= time.time():
+        await update.message.reply_text("❌ زمان باید در آینده باشد.")
+        return
+
+    job_id = schedule_job(run_at, kind, payload)
+    await update.message.reply_text(
+        f"✅ کار #{job_id} برای {format_schedule_time(run_at)} ثبت شد: {describe_job(kind, json.dumps(payload))}"
+    )
+
+
+async def unschedule_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/unschedule <job id> (admins only)."""
+    if not (update.effective_user and update.effective_user.username in ADMINS):
+        await update.message.reply_text("❌ ✨ Unauthorized. ✨")
+        return
+    if not (context.args and context.args[0].lstrip("#").isdigit()):
+        await update.message.reply_text(SCHEDULE_USAGE)
+        return
+    job_id = int(context.args[0].lstrip("#"))
+    if cancel_job(job_id):
+        await update.message.reply_text(f"✅ کار #{job_id} لغو شد.")
+    else:
+        await update.message.reply_text(f"❌ کار در انتظاری با شناسه #{job_id} پیدا نشد.")
+
+
+# ============================================================
+# 🧹 Database maintenance (post expiry, ANALYZE, incremental vacuum)
+# ============================================================
+# Every MAINTENANCE_INTERVAL seconds a background task:
+#   expire    deletes posts whose expires_at (set with /expire) has passed; active
+#             signal posts are kept until they leave the signal set;
+#   analyze   PRAGMA optimize with a bounded analysis_limit (refreshes sqlite_stat1
+#             for the tables that need it);
+#   vacuum    returns free pages to the file system, VACUUM_STEP_PAGES at a time.
+# Each step waits for a quiet period (no update for MAINTENANCE_QUIET_SECONDS and
+# nothing queued) and runs in a worker thread with its own connection, so the event
+# loop keeps serving updates and the write lock is only held briefly. A round gives
+# up when the bot does not go quiet within MAINTENANCE_INTERVAL. Step timings go to
+# the log and to bot_maintenance_step_duration_seconds.
+# incremental_vacuum needs auto_vacuum=INCREMENTAL; a database created before that is
+# converted by one full VACUUM if it is at most VACUUM_CONVERT_MAX_BYTES.
+MAINTENANCE_INTERVAL = float(os.getenv("MAINTENANCE_INTERVAL", 900))  # seconds
+MAINTENANCE_QUIET_SECONDS = float(os.getenv("MAINTENANCE_QUIET_SECONDS", 10))
+EXPIRE_BATCH = 100
+ANALYSIS_LIMIT = 400  # rows sampled per index by ANALYZE
+VACUUM_STEP_PAGES = 256
+VACUUM_MAX_STEPS = 40  # per round
+VACUUM_CONVERT_MAX_BYTES = 64 * 1024 * 1024
+
+maintenance_task = None  # the running maintenance loop (set by serve())
+
+
+def expire_posts(now=None, limit=EXPIRE_BATCH):
+    """Delete up to ``limit`` expired posts (not active signals); returns their ids."""
+    now = time.time() if now is None else now
+    conn = db_connect()
+    keep = [post_id for post_id, _weight in SIGNAL_POSTS] or [0]
+    ids = [row[0] for row in conn.execute(
+        f"SELECT id FROM posts WHERE expires_at IS NOT NULL AND expires_at <= ? "
+        f"AND id NOT IN ({', '.join('?' * len(keep))}) ORDER BY expires_at LIMIT ?",
+        (now, *keep, limit),
+    )]
+    conn.executemany("DELETE FROM posts WHERE id = ?", [(post_id,) for post_id in ids])
+    conn.executemany("DELETE FROM posts_fts WHERE rowid = ?", [(post_id,) for post_id in ids])
+    conn.executemany("DELETE FROM post_messages WHERE post_id = ?", [(post_id,) for post_id in ids])
+    conn.commit()
+    conn.close()
+    if ids:
+        invalidate_title_index()
+    return ids
+
+
+def set_post_expiry(post_id, expires_at):
+    """Set (or with None clear) a post's expiry; returns False if the post does not exist."""
+    conn = db_connect()
+    cur = conn.execute("UPDATE posts SET expires_at = ? WHERE id = ?", (expires_at, post_id))
+    conn.commit()
+    conn.close()
+    return cur.rowcount > 0
+
+
+def analyze_db():
+    conn = db_connect()
+    conn.execute(f"PRAGMA analysis_limit = {ANALYSIS_LIMIT}")
+    conn.execute("PRAGMA optimize = 0x10002")  # all tables, ANALYZE where needed
+    conn.close()
+
+
+def free_pages():
+    """``(auto_vacuum mode, free pages, page count, page size)``"""
+    conn = db_connect()
+    info = tuple(conn.execute(f"PRAGMA {name}").fetchone()[0]
+                 for name in ("auto_vacuum", "freelist_count", "page_count", "page_size"))
+    conn.close()
+    return info
+
+
+def vacuum_step(pages=VACUUM_STEP_PAGES):
+    conn = db_connect()
+    # execute() would step the pragma once (one page); executescript runs it to completion
+    conn.executescript(f"PRAGMA incremental_vacuum({pages});")
+    conn.close()
+
+
+def convert_to_incremental_vacuum():
+    conn = db_connect()
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+    conn.close()
+
+
+def is_quiet(application):
+    return (time.monotonic() - application.last_update_at >= MAINTENANCE_QUIET_SECONDS
+            and application.update_queue.empty())
+
+
+async def wait_quiet(application, deadline):
+    """Wait for a quiet period; False if the deadline or shutdown comes first."""
+    while not is_quiet(application):
+        if shutdown_requested.is_set() or time.monotonic() >= deadline:
+            return False
+        await asyncio.sleep(1)
+    return not shutdown_requested.is_set()
+
+
+async def run_maintenance(application):
+    """One maintenance round; returns the report lines ("step detail time")."""
+    deadline = time.monotonic() + MAINTENANCE_INTERVAL
+    report = []
+
+    async def step(name, func, *args):
+        if not await wait_quiet(application, deadline):
+            raise TimeoutError(name)
+        start_time = time.perf_counter()
+        result = await asyncio.to_thread(func, *args)
+        elapsed = time.perf_counter() - start_time
+        MAINTENANCE_STEP.observe(elapsed, name)
+        return result, elapsed
+
+    try:
+        expired, total = [], 0.0
+        while True:  # batches of EXPIRE_BATCH, each waiting for a quiet moment
+            batch, elapsed = await step("expire", expire_posts)
+            expired, total = expired + batch, total + elapsed
+            if len(batch) < EXPIRE_BATCH:
+                break
+        report.append(f"expire {len(expired)} post(s) {total * 1e3:.1f}ms")
+        if expired:
+            logger.info("🧹 Expired posts: %s%s", ", ".join(map(str, expired[:50])), " …" if len(expired) > 50 else "")
+
+        _none, elapsed = await step("analyze", analyze_db)
+        report.append(f"analyze {elapsed * 1e3:.1f}ms")
+
+        (mode, free, pages, page_size), _elapsed = await step("freelist", free_pages)
+        if mode != 2 and free:
+            if pages * page_size <= VACUUM_CONVERT_MAX_BYTES:
+                _none, elapsed = await step("convert", convert_to_incremental_vacuum)
+                report.append(f"convert to incremental vacuum ({pages} pages) {elapsed * 1e3:.1f}ms")
+            else:
+                report.append(f"vacuum skipped: {free} free pages, database needs a one-off offline VACUUM")
+        elif free:
+            steps, total = 0, 0.0
+            while free > 0 and steps < VACUUM_MAX_STEPS:
+                _none, elapsed = await step("vacuum", vacuum_step)
+                steps, total = steps + 1, total + elapsed
+                free = max(0, free - VACUUM_STEP_PAGES)
+            report.append(f"vacuum {steps} step(s) of {VACUUM_STEP_PAGES} pages {total * 1e3:.1f}ms, {free} left")
+    except TimeoutError as e:
+        report.append(f"stopped before {e}: not quiet")
+    logger.info("🧹 Maintenance: %s", "; ".join(report))
+    return report
+
+
+async def maintenance_loop(application):
+    current_trace.set(None)
+    while not shutdown_requested.is_set():
+        try:
+            await asyncio.wait_for(shutdown_requested.wait(), MAINTENANCE_INTERVAL)
+            return
+        except asyncio.TimeoutError:
+            pass
+        try:
+            await run_maintenance(application)
+        except Exception:
+            logger.exception("🧹 Maintenance round failed")
+
+
+async def expire_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/expire <post id> <time|off> — delete a post automatically at a time (admins only)."""
+    if not (update.effective_user and update.effective_user.username in ADMINS):
+        await update.message.reply_text("❌ ✨ Unauthorized. ✨")
+        return
+    args = context.args or []
+    usage = f"⌛ استفاده: /expire <شناسه پست> <YYYY-MM-DD HH:MM | +7d | off>\n(زمان به وقت {SCHEDULE_TIMEZONE})"
+    if len(args) < 2 or not args[0].isdigit():
+        await update.message.reply_text(usage)
+        return
+    post_id = int(args[0])
+    when = " ".join(args[1:])
+    try:
+        expires_at = None if when == "off" else parse_schedule_time(when)
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e}\n\n{usage}")
+        return
+    if not set_post_expiry(post_id, expires_at):
+        await update.message.reply_text("❌ پست یافت نشد.")
+    elif expires_at is None:
+        await update.message.reply_text(f"✅ انقضای پست {post_id} برداشته شد.")
+    else:
+        await update.message.reply_text(f"✅ پست {post_id} در {format_schedule_time(expires_at)} حذف می‌شود.")
+
+
+# ============================================================
+# 🌐 Web server (health check + webhook) and runner
+# ============================================================
+# Webhook mode: Telegram POSTs updates to WEBHOOK_PATH on the same aiohttp server that
+# answers Render's health check. Polling mode keeps the old getUpdates loop.
+# The public URL defaults to the one Render provides for web services.
+# aiohttp is imported inside these functions so that importing bot.py stays cheap.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL") or os.getenv("RENDER_EXTERNAL_URL")
+# secret path and secret token are derived from the bot token unless set explicitly
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH") or "/telegram/" + hashlib.sha256((BOT_TOKEN or "").encode()).hexdigest()[:32]
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(f"secret:{BOT_TOKEN}".encode()).hexdigest()
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+# /debug/slow is only served when this is set
+DEBUG_TOKEN = os.getenv("DEBUG_TOKEN")
+
+# Render kills the process 30 s after SIGTERM; in-flight work gets SHUTDOWN_TIMEOUT
+# seconds to finish, then Application.stop() gets SHUTDOWN_STOP_GRACE more
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", 20))
+SHUTDOWN_STOP_GRACE = 5.0
 
-# -------------------------------
-# اجرای async bot و web server
-# -------------------------------
-async def run_bot():
-    print("🚀 Starting Telegram Bot polling...")
-    await application.initialize()
-    await application.start()
-    await application.updater.start_polling()
-    print("✅ Bot is now polling.")
-    await application.updater.idle()
 
 async def handle(request):
+    from aiohttp import web
+
     return web.Response(text="✅ Bot is running on Render (Free Plan)")
 
 
+async def handle_metrics(request):
+    from aiohttp import web
 
-# ==============================
-#  Telegram Bot Section
-# ==============================
-# -----------------------
-# ربات تلگرام
-# -----------------------
+    return web.Response(body=render_metrics().encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("ربات آماده است!")
 
-# ساخت ربات
-app_bot = ApplicationBuilder().token(TOKEN).build()
-app_bot.add_handler(CommandHandler("start", start))
+async def handle_webhook(request):
+    """Receive one update from Telegram and hand it to the Application."""
+    from aiohttp import web
 
-async def runner_main():
-    # Ensure no webhook is set (webhook mode causes getUpdates conflicts)
+    if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), WEBHOOK_SECRET):
+        logger.warning("Rejected webhook call with a missing/invalid secret token")
+        return web.Response(status=403)
+    application = request.app["application"]
     try:
-        await application.bot.delete_webhook()
-        print("Webhook removed (if existed).")
+        update = Update.de_json(await request.json(), application.bot)
     except Exception:
-        # best-effort; continue even if deletion fails
-        pass
-
-    # Run single polling instance (drop_pending_updates to avoid old updates) + web server
-    await asyncio.gather(
-        application.run_polling(drop_pending_updates=True),
-        run_web()
-    )
+        logger.exception("Invalid webhook payload")
+        return web.Response(status=400)
+    await application.update_queue.put(update)
+    return web.Response()
+
+
+async def handle_debug_slow(request):
+    """Slow-update traces as JSON (newest last); needs ?token=<DEBUG_TOKEN>."""
+    from aiohttp import web
+
+    if not hmac.compare_digest(request.query.get("token", ""), DEBUG_TOKEN):
+        return web.Response(status=403)
+    return web.json_response(list(slow_updates))
+
+
+def build_web_app(application):
+    """One aiohttp app for the health check, metrics and the webhook endpoint."""
+    from aiohttp import web
+
+    web_app = web.Application()
+    web_app["application"] = application
+    web_app.router.add_get("/", handle)
+    web_app.router.add_get("/health", handle)
+    web_app.router.add_get("/metrics", handle_metrics)
+    if DEBUG_TOKEN:
+        web_app.router.add_get("/debug/slow", handle_debug_slow)
+    web_app.router.add_post(WEBHOOK_PATH, handle_webhook)
+    return web_app
+
+
+async def shutdown(application, runner):
+    """Stop taking updates, drain in-flight work until SHUTDOWN_TIMEOUT, flush buffers, stop."""
+    deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+    shutdown_requested.set()
+    if application.updater and application.updater.running:
+        await application.updater.stop()
+    if job_scheduler:
+        await job_scheduler.stop()  # no new jobs; ones already started are drained below
+    if maintenance_task:
+        maintenance_task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await maintenance_task
+    # closes the webhook endpoint (Telegram keeps retrying until the new instance is up)
+    await runner.cleanup()
+
+    if application.running:
+        running, queued = application.pending_tasks, application.update_queue.qsize()
+        logger.info("🛑 Shutting down: %s task(s) running, %s update(s) queued", running, queued)
+        try:
+            await asyncio.wait_for(application.wait_idle(), max(0.0, deadline - time.monotonic()))
+            logger.info("✅ Drained %s running task(s) and %s queued update(s)", running, queued)
+        except asyncio.TimeoutError:
+            cancelled, dropped = application.abandon()
+            logger.warning(
+                "⏱ Shutdown deadline (%gs) reached: cancelling %s task(s), dropping %s queued update(s)",
+                SHUTDOWN_TIMEOUT, cancelled, dropped,
+            )
+        try:
+            await asyncio.wait_for(application.stop(), SHUTDOWN_STOP_GRACE)
+        except asyncio.TimeoutError:
+            logger.warning("⏱ Application.stop() did not finish in time; continuing shutdown")
+        if application.abandoned:
+            logger.warning("⚠️ %s update(s) abandoned mid-handler", application.abandoned)
+
+    # buffered writes go to the database last, after every handler has finished
+    flushed = flush_user_activity()
+    logger.info("💾 Flushed %s buffered last_seen update(s)", flushed)
+    flush_update_offset()
+    logger.info("📈 Final counters: %s", metrics_summary())
+    await application.shutdown()
+
+
+async def serve(mode):
+    """Run the bot in "webhook" or "polling" mode next to the web server until SIGTERM/SIGINT."""
+    from aiohttp import web
+
+    application = get_application()
+    # no access log: in webhook mode it would write one line per update
+    runner = web.AppRunner(build_web_app(application), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "0.0.0.0", PORT)
 
-# Logging setup
-logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-                    level=logging.INFO)
-logger = logging.getLogger(__name__)
+    await application.initialize()
+    await application.start()
+    await site.start()
+    logger.info("🌐 Web server listening on port %s", PORT)
+
+    # getUpdates (catch-up, polling) fails with a conflict while a webhook is set
+    await application.bot.delete_webhook()
+    if CATCHUP:
+        await catch_up(application)
+
+    global job_scheduler, maintenance_task
+    job_scheduler = JobScheduler(application)
+    job_scheduler.start()
+    maintenance_task = asyncio.create_task(maintenance_loop(application))
+
+    if mode == "webhook":
+        await application.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+            drop_pending_updates=not CATCHUP,
+        )
+        logger.info("🚀 Receiving updates via webhook")
+    else:
+        await application.updater.start_polling(drop_pending_updates=not CATCHUP)
+        logger.info("🚀 Receiving updates via polling")
 
-# Get bot token from .env
-bot_token = os.getenv("BOT_TOKEN")
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:  # e.g. Windows
+            pass
+    try:
+        await stop.wait()
+    finally:
+        await shutdown(application, runner)
 
-def start(update, context):
-    update.message.reply_text("Hello, I'm your bot!")
-    
-def main():
-    application = Application.builder().token(bot_token).build()
-    
-    application.add_handler(CommandHandler("start", start))
-
-async def start(update, context):
-    await update.message.reply_text("✅ Bot is running on Render Free Plan!")
-
-application.add_handler(CommandHandler("start", start))
-
-# --- بخش اصلی برای ربات
-def run_bot():
-    application.run_polling(drop_pending_updates=True)
-
-# --- بخش ساخت وب‌سرور تقلبی برای Render
-class DummyServer(BaseHTTPRequestHandler):
-    def do_GET(self):
-        self.send_response(200)
-        self.end_headers()
-        self.wfile.write(b"Bot is alive on Render Free Plan!")
-
-def run_webserver():
-    port = int(os.environ.get("PORT", 10000))  # هر پورتی، مثلاً 10000
-    server = HTTPServer(("0.0.0.0", port), DummyServer)
-    print(f"🌐 Dummy web server running on port {port}")
-    server.serve_forever()
-# --- اجرای همزمان ربات و وب‌سرور فیک
-async def main():
-    # اجرا کردن polling در داخل asyncio
-    await application.run_polling(drop_pending_updates=True)
 
 if __name__ == "__main__":
-    loop = asyncio.get_event_loop()
-    loop.create_task(main())  # اجرای تابع اصلی به صورت async
-    run_webserver()  # شروع وب‌سرور
+    parser = argparse.ArgumentParser(description="Best Free Signal bot")
+    mode_group = parser.add_mutually_exclusive_group()
+    mode_group.add_argument("--webhook", dest="mode", action="store_const", const="webhook",
+                            help="receive updates via webhook (needs WEBHOOK_URL or RENDER_EXTERNAL_URL)")
+    mode_group.add_argument("--polling", dest="mode", action="store_const", const="polling",
+                            help="receive updates via getUpdates long polling")
+    cli = parser.parse_args()
+    mode = cli.mode or os.getenv("BOT_MODE") or ("webhook" if WEBHOOK_URL else "polling")
+    if mode == "webhook" and not WEBHOOK_URL:
+        raise SystemExit("❌ Webhook mode needs WEBHOOK_URL (or RENDER_EXTERNAL_URL) to be set.")
+    configure_logging()
+    asyncio.run(serve(mode))